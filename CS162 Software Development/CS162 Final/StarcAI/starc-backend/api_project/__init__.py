@@ -4,6 +4,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
+import click
 import os
 
 # Initialize SQLAlchemy for database operations
@@ -13,19 +14,143 @@ db = SQLAlchemy()
 migrate = Migrate()
 
 # Function to create and configure the Flask application
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
 
     # Configure the app with necessary settings
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default_secret_key')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SQLALCHEMY_DATABASE_URI', 'sqlite:///site.db')
 
+    # Create the tables, and the columns and indexes an existing database is missing, when the app starts. Turn
+    # off where the schema is created beforehand with flask init-db, as gunicorn does before starting its workers
+    app.config['DB_CREATE_ON_START'] = os.environ.get('DB_CREATE_ON_START', 'true').lower() in ('1', 'true', 'yes')
+
+    # Pragmas set on every SQLite connection, an empty value keeps SQLite's default (see database.py)
+    app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '10000')
+    app.config['SQLITE_MMAP_SIZE'] = os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))
+
+    # Connection pool for server databases such as PostgreSQL, per worker process
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+
+    # Size of the background pool that rewrites and scores documents, and how many jobs may wait for it
+    app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 4))
+    app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 100))
+    # Seconds between the stamps a process puts on the rows of its jobs. Queued and running jobs are failed once
+    # three stamps were missed, as the process running them stopped
+    app.config['JOB_HEARTBEAT_SECONDS'] = float(os.environ.get('JOB_HEARTBEAT_SECONDS', 10))
+
+    # Size budget, in characters, of the chunks a document is split into for rewriting and scoring
+    app.config['CHUNK_MAX_CHARS'] = int(os.environ.get('CHUNK_MAX_CHARS', 4000))
+
+    # Seconds of silence after which a rewrite stream sends a keep-alive comment
+    app.config['STREAM_HEARTBEAT_SECONDS'] = float(os.environ.get('STREAM_HEARTBEAT_SECONDS', 15))
+
+    # Limits for uploaded PDFs and the process pool that extracts their pages
+    app.config['PDF_MAX_BYTES'] = int(os.environ.get('PDF_MAX_BYTES', 50 * 1024 * 1024))
+    app.config['PDF_MAX_PAGES'] = int(os.environ.get('PDF_MAX_PAGES', 1000))
+    app.config['PDF_EXTRACT_WORKERS'] = int(os.environ.get('PDF_EXTRACT_WORKERS', min(4, os.cpu_count() or 1)))
+    app.config['PDF_PAGES_PER_TASK'] = int(os.environ.get('PDF_PAGES_PER_TASK', 16))
+
+    # Where exported PDFs are cached, defaulting to starc-pdf-cache in the temp directory, and how many files to keep
+    app.config['PDF_EXPORT_CACHE_DIR'] = os.environ.get('PDF_EXPORT_CACHE_DIR')
+    app.config['PDF_EXPORT_CACHE_MAX_FILES'] = int(os.environ.get('PDF_EXPORT_CACHE_MAX_FILES', 500))
+
+    # Connection settings for the rewrite and scoring cloud functions
+    app.config['GC_FUNCTIONS_URL'] = os.environ.get('GC_FUNCTIONS_URL', 'https://us-central1-starcai.cloudfunctions.net')
+    app.config['GC_TIMEOUT'] = float(os.environ.get('GC_TIMEOUT', 60))
+    app.config['GC_CONNECT_TIMEOUT'] = float(os.environ.get('GC_CONNECT_TIMEOUT', 5))
+    app.config['GC_MAX_RETRIES'] = int(os.environ.get('GC_MAX_RETRIES', 3))
+    app.config['GC_BACKOFF'] = float(os.environ.get('GC_BACKOFF', 0.5))
+    app.config['GC_MAX_IN_FLIGHT'] = int(os.environ.get('GC_MAX_IN_FLIGHT', 8))
+
+    # Limits for the rewrite and score cache, in memory and in the cached_text table
+    app.config['CACHE_MEMORY_ENTRIES'] = int(os.environ.get('CACHE_MEMORY_ENTRIES', 1024))
+    app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 100000))
+    app.config['CACHE_MAX_AGE_DAYS'] = int(os.environ.get('CACHE_MAX_AGE_DAYS', 30))
+
+    # Total size in bytes of the document responses kept in memory, served until their document changes
+    app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+    # Seconds between reloads of revoked tokens, the longest a logout takes to reach the other worker processes
+    app.config['TOKEN_BLOCKLIST_REFRESH_SECONDS'] = float(os.environ.get('TOKEN_BLOCKLIST_REFRESH_SECONDS', 5))
+
+    # Bearer token Prometheus must send to read /metrics, which is closed when unset
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+    # File the spans of requests and processing jobs are appended to, as JSON lines, and the fraction of
+    # traces kept. Nothing is traced when no file is set.
+    app.config['TRACE_FILE'] = os.environ.get('TRACE_FILE')
+    app.config['TRACE_SAMPLE_RATE'] = float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))
+
+    # Where the profiles of requests sent by admins with the X-Profile header are stored, defaulting to
+    # instance/profiles, and how many to keep
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')
+    app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 100))
+
+    # Password hash method and parameters in werkzeug's format, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000,
+    # and the process pool hashes run in, 0 workers hashing on the request thread
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', min(2, os.cpu_count() or 1)))
+    app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 32))
+
+    # Allow tests and scripts to override any of the settings above
+    if test_config:
+        app.config.update(test_config)
+
     # Enable Cross-Origin Resource Sharing (CORS) for the app
     CORS(app)
 
-    # Initialize database and migration functionalities with the app
+    # Initialize database and migration functionalities with the app, with the engine settings of its database
+    from api_project.database import engine_options, configure_engine
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
     db.init_app(app)
     migrate.init_app(app, db)
+    with app.app_context():
+        configure_engine(app)
+
+    # Time every request and count its database queries, for /metrics
+    from api_project.metrics import metrics
+    metrics.init_app(app)
+
+    # Trace requests and the stages of document processing, when a trace file is set
+    from api_project.tracing import tracing
+    tracing.init_app(app)
+
+    # Profile the requests admins ask for
+    from api_project.profiling import profiler
+    profiler.init_app(app)
+
+    # Give the app its own cloud function client, pointed at the configured endpoint
+    from api_project.processing import create_client
+    app.extensions['cloud_client'] = create_client(
+        app.config['GC_FUNCTIONS_URL'],
+        timeout=app.config['GC_TIMEOUT'],
+        connect_timeout=app.config['GC_CONNECT_TIMEOUT'],
+        max_retries=app.config['GC_MAX_RETRIES'],
+        backoff=app.config['GC_BACKOFF'],
+        max_in_flight=app.config['GC_MAX_IN_FLIGHT'],
+        pool_size=app.config['GC_MAX_IN_FLIGHT'],
+    )
+
+    # Set up the rewrite and score cache
+    from api_project.cache import content_cache
+    content_cache.init_app(app)
+
+    # Set up the cache of document responses
+    from api_project.response_cache import response_cache
+    response_cache.init_app(app)
+
+    # Set up the password hashing pool
+    from api_project.passwords import password_hasher
+    password_hasher.init_app(app)
+
+    # Start the background worker pool for document processing
+    from api_project.jobs import jobs
+    jobs.init_app(app)
 
     # Import and register blueprints for different parts of the application
     
@@ -41,14 +166,65 @@ def create_app():
     from api_project.routes.search import search_bp
     app.register_blueprint(search_bp, url_prefix='/api')
 
+    from api_project.routes.metrics import metrics_bp
+    app.register_blueprint(metrics_bp, url_prefix='/metrics')
+
+    from api_project.routes.profiles import profiles_bp
+    app.register_blueprint(profiles_bp, url_prefix='/admin/profiles')
+
+    # Command to create the tables, or add the columns and indexes an existing database is missing,
+    # and fail the jobs left behind by processes that stopped
+    @app.cli.command('init-db')
+    def init_db():
+        from api_project.models import create_schema
+        create_schema()
+        jobs.fail_orphaned()
+
+    # Command to create and fill the full-text search index of a database created before it existed
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index():
+        from api_project import search_index
+        search_index.rebuild()
+
+    # Command to recompute every user's document statistics, for a database created before they were kept
+    # or to correct any drift. Can be run periodically as a reconciliation job.
+    @app.cli.command('rebuild-user-stats')
+    def rebuild_user_stats():
+        from api_project import user_stats
+        user_stats.rebuild()
+
+    # Command to let a user profile requests and read the profiles, or to take that away with --revoke
+    @app.cli.command('set-admin')
+    @click.argument('username')
+    @click.option('--revoke', is_flag=True)
+    def set_admin(username, revoke):
+        from api_project.models import User
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f'No user named {username}')
+        user.is_admin = not revoke
+        db.session.commit()
+
     # Configure JWT settings for the app
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'default_jwt_secret_key')
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = int(os.environ.get('JWT_ACCESS_TOKEN_EXPIRES', 7000))
     jwt = JWTManager(app)    
 
-    # Create all database tables within the application context
-    with app.app_context():
-        db.create_all()
+    # Reject revoked tokens, checked against an in-memory copy of the revoked tokens table
+    from api_project.blocklist import token_blocklist
+    token_blocklist.init_app(app)
+
+    @jwt.token_in_blocklist_loader
+    def check_if_token_revoked(jwt_header, jwt_payload):
+        return token_blocklist.is_revoked(jwt_payload['jti'])
+
+    # Create all database tables, and the columns and indexes an existing database is missing, within the application context,
+    # then fail the jobs left behind by processes that stopped
+    if app.config['DB_CREATE_ON_START']:
+        from api_project.models import create_schema
+        with app.app_context():
+            create_schema()
+            jobs.fail_orphaned()
         
     # Return the configured Flask app instance
     return app
@@ -0,0 +1,90 @@
+# Revoked token check for every authenticated request.
+# Revoked token ids are kept in memory and topped up from the revoked_token_model table at most once per
+# TOKEN_BLOCKLIST_REFRESH_SECONDS, so checking a token costs a dict lookup instead of a query, and a logout in
+# another worker process takes effect here within that delay. Ids are forgotten once the tokens they belong
+# to have expired anyway.
+from datetime import datetime, timedelta
+import threading
+import time
+
+from flask import current_app
+from api_project import db
+from api_project.models import RevokedTokenModel
+
+# Rows are re-read this far back on every refresh, so a revocation committed a little after the time it was
+# stamped with is not missed.
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+# Per-app state: revoked token ids with their revocation time, and when to refresh them next.
+class _BlocklistState:
+    def __init__(self):
+        self.revoked = {}
+        self.loaded_until = None
+        self.next_refresh = 0
+        self.lock = threading.Lock()
+
+
+class TokenBlocklist:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TOKEN_BLOCKLIST_REFRESH_SECONDS', 5)
+        app.extensions['token_blocklist'] = _BlocklistState()
+
+    def _state(self):
+        return current_app.extensions['token_blocklist']
+
+    def is_revoked(self, jti):
+        state = self._state()
+        if time.monotonic() >= state.next_refresh:
+            self.refresh()
+        return jti in state.revoked
+
+    # Revoke a token, right away in this process and through the table for the others.
+    def revoke(self, jti):
+        revoked_token = RevokedTokenModel(jti=jti)
+        revoked_token.add()
+        state = self._state()
+        with state.lock:
+            state.revoked[jti] = revoked_token.revoked_on
+
+    # Load the revocations made since the last refresh and drop the ones whose tokens have expired.
+    def refresh(self):
+        state = self._state()
+        # Only one thread refreshes while the others keep answering from the current set, except for the
+        # first load, which there is no set to answer from yet
+        if not state.lock.acquire(blocking=state.loaded_until is None):
+            return
+        try:
+            if time.monotonic() < state.next_refresh:
+                return
+            started = datetime.utcnow()
+            # Tokens revoked before this were issued earlier still, and can no longer be used
+            expired = _expiry_cutoff(started)
+            since = max(expired, state.loaded_until - REFRESH_OVERLAP) if state.loaded_until else expired
+            rows = db.session.query(RevokedTokenModel.jti, RevokedTokenModel.revoked_on)\
+                             .filter(RevokedTokenModel.revoked_on >= since).all()
+
+            state.revoked.update(rows)
+            for jti in [jti for jti, revoked_on in state.revoked.items() if revoked_on < expired]:
+                del state.revoked[jti]
+            state.loaded_until = started
+            state.next_refresh = time.monotonic() + current_app.config['TOKEN_BLOCKLIST_REFRESH_SECONDS']
+        finally:
+            state.lock.release()
+
+
+# Revocation time before which tokens have expired by now. JWT_ACCESS_TOKEN_EXPIRES is seconds, a timedelta
+# or False for tokens that never expire.
+def _expiry_cutoff(now):
+    expires = current_app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    if expires is False:
+        return datetime.min
+    return now - (expires if isinstance(expires, timedelta) else timedelta(seconds=expires))
+
+
+# Shared blocklist, bound to the app in create_app.
+token_blocklist = TokenBlocklist()
@@ -0,0 +1,235 @@
+# Content-addressed cache for rewrites and scores.
+# Texts are keyed by a hash of their normalized form. Lookups go to an in-process LRU first and then to the
+# cached_text table, so the same content uploaded again, or resubmitted unchanged, skips the cloud functions.
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import threading
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from api_project import db
+from api_project.models import CachedText
+from api_project.processing import rewrite_many, get_scores_batch
+
+SCORE_FIELDS = ('score', 'optimism', 'forecast', 'confidence')
+
+
+# Collapse whitespace so re-flowed copies of the same text share a key.
+def normalize_text(text):
+    return ' '.join(text.split())
+
+
+def content_key(text):
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+# Per-app state: the LRU of cached fields by key, the hit/miss counters and the keys read from the table
+# since the last write, whose last_used is updated by the cache's next commit.
+class _CacheState:
+    def __init__(self, memory_entries, max_entries, max_age, evict_every):
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.writes = 0
+        self.touched = {}
+        self.counters = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'evictions': 0}
+        self.lock = threading.Lock()
+
+
+class ContentCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_MEMORY_ENTRIES', 1024)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 100000)
+        app.config.setdefault('CACHE_MAX_AGE_DAYS', 30)
+        app.config.setdefault('CACHE_EVICT_EVERY', 100)
+        app.extensions['content_cache'] = _CacheState(
+            app.config['CACHE_MEMORY_ENTRIES'],
+            app.config['CACHE_MAX_ENTRIES'],
+            timedelta(days=app.config['CACHE_MAX_AGE_DAYS']),
+            app.config['CACHE_EVICT_EVERY'],
+        )
+
+    def _state(self):
+        return current_app.extensions['content_cache']
+
+    # Rewrite and score texts like processing.rewrite_and_score, only calling the cloud functions for cache misses.
+    def rewrite_and_score(self, texts):
+        texts = list(texts)
+        rewrites = self.rewrite(texts)
+        scores = self.score(texts + rewrites)
+        return rewrites, scores[:len(texts)], scores[len(texts):]
+
+    # Rewrite texts, sending only the ones missing from the cache to the rewrite function, concurrently.
+    # on_result(index, rewrite) is called for cache hits first and then for each miss as it comes back.
+    def rewrite(self, texts, on_result=None):
+        texts = list(texts)
+        rewrites = [entry['rewritten_text'] if entry else None
+                    for entry in self._lookup(texts, ('rewritten_text',))]
+        if on_result:
+            for index, rewrite in enumerate(rewrites):
+                if rewrite is not None:
+                    on_result(index, rewrite)
+
+        missing = self._unique_missing(texts, rewrites)
+        if missing:
+            # Positions of every text sharing a missing key, so duplicates are reported together
+            positions = {}
+            for index, (text, rewrite) in enumerate(zip(texts, rewrites)):
+                if rewrite is None:
+                    positions.setdefault(content_key(text), []).append(index)
+            keys = list(missing)
+
+            def report(position, rewrite):
+                for index in positions[keys[position]]:
+                    on_result(index, rewrite)
+
+            new_rewrites = dict(zip(keys, rewrite_many(missing.values(), report if on_result else None)))
+            self._store({key: {'rewritten_text': text} for key, text in new_rewrites.items()}, ('rewritten_text',))
+            rewrites = [new_rewrites.get(content_key(text)) if rewrite is None else rewrite
+                        for text, rewrite in zip(texts, rewrites)]
+        return rewrites
+
+    # Score texts, sending the ones missing from the cache to the scoring function in one batch.
+    def score(self, texts):
+        texts = list(texts)
+        scores = [[entry[field] for field in SCORE_FIELDS] if entry else None
+                  for entry in self._lookup(texts, SCORE_FIELDS)]
+        missing = self._unique_missing(texts, scores)
+        if missing:
+            new_scores = dict(zip(missing, get_scores_batch(missing.values())))
+            self._store({key: dict(zip(SCORE_FIELDS, values)) for key, values in new_scores.items()}, SCORE_FIELDS)
+            scores = [new_scores.get(content_key(text)) if values is None else values
+                      for text, values in zip(texts, scores)]
+        return scores
+
+    def stats(self):
+        state = self._state()
+        with state.lock:
+            return {**state.counters, 'memory_entries': len(state.memory)}
+
+    # Texts whose lookup missed, de-duplicated by key so each distinct text is only sent once.
+    def _unique_missing(self, texts, found):
+        missing = {}
+        for text, value in zip(texts, found):
+            if value is None:
+                missing.setdefault(content_key(text), text)
+        return missing
+
+    # Return, for each text, the cached fields when all of the requested fields are present, otherwise None.
+    def _lookup(self, texts, fields):
+        state = self._state()
+        keys = [content_key(text) for text in texts]
+        cutoff = datetime.utcnow() - state.max_age
+        results = {}
+
+        with state.lock:
+            for key in keys:
+                entry = state.memory.get(key)
+                if entry is not None and entry['created_on'] >= cutoff and all(entry.get(f) is not None for f in fields):
+                    state.memory.move_to_end(key)
+                    results[key] = entry
+
+        db_keys = set(keys) - set(results)
+        if db_keys:
+            rows = CachedText.query.filter(CachedText.key.in_(db_keys), CachedText.created_on >= cutoff).all()
+            with state.lock:
+                for row in rows:
+                    entry = self._remember(state, row.key, {
+                        'rewritten_text': row.rewritten_text,
+                        **{field: getattr(row, field) for field in SCORE_FIELDS},
+                        'created_on': row.created_on,
+                    })
+                    if all(entry.get(f) is not None for f in fields):
+                        results[row.key] = entry
+                        state.counters['db_hits'] += 1
+
+                # Mark rows read from the table as recently used so size eviction keeps them. Written with the
+                # next store or eviction rather than here, which would commit the caller's session.
+                now = datetime.utcnow()
+                state.touched.update((row.key, now) for row in rows if row.key in results)
+
+        with state.lock:
+            for key in keys:
+                if key not in results:
+                    state.counters['misses'] += 1
+                elif key not in db_keys:
+                    state.counters['memory_hits'] += 1
+
+        return [results.get(key) for key in keys]
+
+    # Merge fields into the LRU entry for a key, evicting the least recently used entries past the limit.
+    def _remember(self, state, key, fields):
+        entry = state.memory.pop(key, {})
+        entry.update({name: value for name, value in fields.items() if value is not None})
+        entry.setdefault('created_on', datetime.utcnow())
+        state.memory[key] = entry
+        while len(state.memory) > state.memory_entries:
+            state.memory.popitem(last=False)
+        return entry
+
+    # Upsert fields for each key into the table and the LRU, committing straight away so results
+    # we paid for survive even if the caller fails later on.
+    def _store(self, values, fields):
+        state = self._state()
+        now = datetime.utcnow()
+        rows = [{'key': key, 'created_on': now, 'last_used': now, **entry} for key, entry in values.items()]
+
+        dialect_insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+        stmt = dialect_insert(CachedText).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['key'],
+            set_={name: stmt.excluded[name] for name in (*fields, 'last_used')},
+        )
+        db.session.execute(stmt)
+        self._write_touched(state)
+        db.session.commit()
+
+        with state.lock:
+            for key, entry in values.items():
+                self._remember(state, key, entry)
+            state.writes += 1
+            evict = state.writes % state.evict_every == 0
+        if evict:
+            self.evict()
+
+    # Drop rows past the maximum age, then the least recently used rows beyond the maximum size.
+    def evict(self):
+        state = self._state()
+        self._write_touched(state)
+        removed = CachedText.query.filter(CachedText.created_on < datetime.utcnow() - state.max_age).delete()
+
+        excess = db.session.query(func.count(CachedText.key)).scalar() - state.max_entries
+        if excess > 0:
+            oldest = db.session.query(CachedText.key).order_by(CachedText.last_used).limit(excess)
+            removed += CachedText.query.filter(CachedText.key.in_(oldest.scalar_subquery())).delete(
+                synchronize_session=False)
+        db.session.commit()
+
+        with state.lock:
+            state.counters['evictions'] += removed
+        return removed
+
+
+    # Update last_used of the rows read since the last write, in the current transaction.
+    def _write_touched(self, state):
+        with state.lock:
+            touched, state.touched = state.touched, {}
+        # One statement per lookup, the keys of a lookup share its time
+        by_time = {}
+        for key, last_used in touched.items():
+            by_time.setdefault(last_used, []).append(key)
+        for last_used, keys in by_time.items():
+            CachedText.query.filter(CachedText.key.in_(keys)).update(
+                {'last_used': last_used}, synchronize_session=False)
+
+
+# Shared cache instance, bound to the app in create_app.
+content_cache = ContentCache()
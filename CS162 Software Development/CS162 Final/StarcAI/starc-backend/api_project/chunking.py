@@ -0,0 +1,68 @@
+# Split long documents into chunks that are rewritten and scored separately.
+# Chunks break on paragraph boundaries where possible, then on sentence boundaries, and only cut
+# inside a sentence when a single sentence is longer than the whole budget.
+import functools
+import re
+from api_project.metrics import timed
+
+
+# Punkt, to convert text to separate sentences. Built on first use, importing nltk takes longer than starting
+# the rest of the app.
+@functools.cache
+def get_tokenizer():
+    from nltk.tokenize import PunktSentenceTokenizer
+    return PunktSentenceTokenizer()
+
+
+# Default size budget of a chunk, in characters.
+DEFAULT_CHUNK_CHARS = 4000
+
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+
+# Return the chunks of text in order, each at most max_chars long.
+@timed
+def split_into_chunks(text, max_chars=DEFAULT_CHUNK_CHARS):
+    chunks = []
+    current = ''
+    for piece in _pieces(text, max_chars):
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ''
+        current += piece
+    chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+# Yield consecutive slices of text, no longer than max_chars, that together make up the whole text.
+def _pieces(text, max_chars):
+    for paragraph in _split_keeping_ends(text, [m.end() for m in PARAGRAPH_BREAK.finditer(text)]):
+        if len(paragraph) <= max_chars:
+            yield paragraph
+            continue
+        sentence_starts = [start for start, _ in get_tokenizer().span_tokenize(paragraph)][1:]
+        for sentence in _split_keeping_ends(paragraph, sentence_starts):
+            if len(sentence) <= max_chars:
+                yield sentence
+            else:
+                yield from _hard_wrap(sentence, max_chars)
+
+
+def _split_keeping_ends(text, boundaries):
+    start = 0
+    for end in boundaries:
+        if end > start:
+            yield text[start:end]
+            start = end
+    if start < len(text):
+        yield text[start:]
+
+
+# Cut an overlong sentence at the last space before the budget, or at the budget itself if there is none.
+def _hard_wrap(sentence, max_chars):
+    while len(sentence) > max_chars:
+        cut = sentence.rfind(' ', 0, max_chars) + 1 or max_chars
+        yield sentence[:cut]
+        sentence = sentence[cut:]
+    if sentence:
+        yield sentence
@@ -0,0 +1,77 @@
+# Shared HTTP client for the Google Cloud functions that rewrite and score text.
+# One keep-alive session is reused for every call so we do not pay a TLS handshake per request,
+# each call has a timeout, failed calls are retried with jittered exponential backoff and the
+# number of requests in flight at once is capped. Calls that must not run twice, like the costly rewrite, are
+# only retried when the function can't have run them: the connection failed or the function answered with an
+# error status. A read timeout may mean it is still working on the first attempt.
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Status codes worth retrying, anything else is returned or raised straight away.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Raised when a cloud function could not be reached or kept failing after all retries.
+class CloudFunctionError(Exception):
+    pass
+
+
+class CloudFunctionClient:
+    def __init__(self, base_url, api_key=None, timeout=60, connect_timeout=5, max_retries=3,
+                 backoff=0.5, max_backoff=8, max_in_flight=8, pool_size=8):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = (connect_timeout, timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        # Keep a pool of open connections per host, blocking instead of opening extra sockets when it is in use.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # POST a JSON payload to a cloud function and return the successful response. Pass idempotent=False for
+    # functions that must not be called again after a read timeout.
+    def post(self, function_name, payload, idempotent=True):
+        url = f'{self.base_url}/{function_name}'
+        params = {'apikey': self.api_key} if self.api_key else None
+        error = None
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self._backoff_delay(attempt))
+
+            with self._in_flight:
+                try:
+                    response = self.session.post(url, params=params, json=payload, timeout=self.timeout)
+                except requests.ConnectionError as e:
+                    error = e
+                    continue
+                except requests.Timeout as e:
+                    if not idempotent:
+                        raise CloudFunctionError(f'{function_name} timed out: {e}') from e
+                    error = e
+                    continue
+
+            if response.status_code in RETRY_STATUSES:
+                error = CloudFunctionError(f'{function_name} returned {response.status_code}')
+                continue
+            if not response.ok:
+                raise CloudFunctionError(f'{function_name} returned {response.status_code}: {response.text}')
+            return response
+
+        raise CloudFunctionError(f'{function_name} failed after {self.max_retries + 1} attempts: {error}') from error
+
+    # Full jitter: sleep a random time up to the exponential backoff for this attempt.
+    def _backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def close(self):
+        self.session.close()
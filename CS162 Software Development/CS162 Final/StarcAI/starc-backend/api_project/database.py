@@ -0,0 +1,49 @@
+# Engine settings for the configured database.
+# On SQLite every new connection gets the SQLITE_* pragmas: write-ahead logging so readers and the writer
+# don't block each other, fewer fsyncs, a wait for locks instead of failing with "database is locked", and
+# memory-mapped reads. Server databases such as PostgreSQL get a sized connection pool whose connections are
+# checked before use, so ones dropped by the server are replaced instead of failing a request.
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from api_project import db
+
+# Config key of each pragma, in the order they are set.
+SQLITE_PRAGMAS = (
+    ('SQLITE_JOURNAL_MODE', 'journal_mode'),
+    ('SQLITE_SYNCHRONOUS', 'synchronous'),
+    ('SQLITE_BUSY_TIMEOUT_MS', 'busy_timeout'),
+    ('SQLITE_MMAP_SIZE', 'mmap_size'),
+)
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+# Options for create_engine, SQLite keeps SQLAlchemy's own pool.
+def engine_options(config):
+    if is_sqlite(config['SQLALCHEMY_DATABASE_URI']):
+        return {}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+# Set the configured pragmas on every connection of the app's SQLite engine. Pragmas set to None or an empty
+# string keep SQLite's default. Must run in the app context, before the engine is first connected.
+def configure_engine(app):
+    engine = db.engine
+    pragmas = [(pragma, app.config.get(key)) for key, pragma in SQLITE_PRAGMAS
+               if app.config.get(key) not in (None, '')]
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas:
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
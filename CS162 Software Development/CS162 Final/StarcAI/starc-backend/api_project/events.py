@@ -0,0 +1,67 @@
+# In-process publish/subscribe of document processing events.
+# A channel is opened when a document's processing job is queued, the pipeline publishes rewrites and scores
+# to it as each backend call completes, and the job closes it when it finishes. Every event is kept until the
+# channel closes, so a subscriber that connects late still receives the events it missed.
+import threading
+
+
+class _Channel:
+    def __init__(self):
+        self.events = []
+        self.closed = False
+        self.condition = threading.Condition()
+
+    # Yield (event, data) pairs as they are published, or None after heartbeat seconds without one.
+    # Stops once the channel is closed and every event was yielded.
+    def listen(self, heartbeat):
+        position = 0
+        while True:
+            with self.condition:
+                if position == len(self.events) and not self.closed:
+                    self.condition.wait(heartbeat)
+                pending = self.events[position:]
+                closed = self.closed
+            position += len(pending)
+            if pending:
+                yield from pending
+            elif closed:
+                return
+            else:
+                yield None
+
+
+class DocumentEvents:
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def open(self, document_id):
+        with self._lock:
+            self._channels[document_id] = _Channel()
+
+    # Channel of a document being processed in this process, or None.
+    def subscribe(self, document_id):
+        with self._lock:
+            return self._channels.get(document_id)
+
+    # Publish an event to the document's channel, does nothing when no channel is open.
+    def publish(self, document_id, event, data):
+        channel = self.subscribe(document_id)
+        if channel is None:
+            return
+        with channel.condition:
+            channel.events.append((event, data))
+            channel.condition.notify_all()
+
+    def close(self, document_id):
+        with self._lock:
+            channel = self._channels.pop(document_id, None)
+        if channel is None:
+            return
+        with channel.condition:
+            channel.closed = True
+            channel.condition.notify_all()
+
+
+# Shared broker for this process.
+document_events = DocumentEvents()
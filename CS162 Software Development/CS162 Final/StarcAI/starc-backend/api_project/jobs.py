@@ -0,0 +1,183 @@
+# Background job runner for document processing.
+# Requests only store the Document and enqueue a job, a bounded pool of worker threads then runs the
+# slow rewrite and scoring calls so the request workers are free to serve other clients. Jobs live in the
+# memory of the process that queued them, which stamps their rows every JOB_HEARTBEAT_SECONDS, so the jobs of
+# a process that stopped can be told apart and failed instead of being polled forever.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import threading
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import func
+from api_project import db
+from api_project.events import document_events
+from api_project.models import ProcessingJob
+from api_project.profiling import profiler
+from api_project.tracing import current_span, span
+
+
+# A queued or running job is taken as orphaned once its heartbeat is this many intervals old.
+MISSED_HEARTBEATS = 3
+ORPHANED_ERROR = 'Interrupted: the process running the job stopped'
+
+
+# Raised when the queue already holds as many jobs as it is allowed to.
+class QueueFull(Exception):
+    pass
+
+
+# Per-app state: the worker pool, a semaphore bounding queued + running jobs, the futures for waiting and the
+# thread stamping their heartbeats while there are any.
+class _JobState:
+    def __init__(self, workers, queue_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='starc-job')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.futures = {}
+        self.heartbeat = None
+        self.lock = threading.Lock()
+
+
+class JobQueue:
+    def __init__(self, app=None):
+        self._current = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOB_WORKERS', 4)
+        app.config.setdefault('JOB_QUEUE_SIZE', 100)
+        app.config.setdefault('JOB_HEARTBEAT_SECONDS', 10)
+        app.extensions['jobs'] = _JobState(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE'])
+
+    def _state(self):
+        return current_app.extensions['jobs']
+
+    # Create the job row for a document and hand the work to the pool. Raises QueueFull when saturated.
+    def submit(self, document, func, *args):
+        state = self._state()
+        if not state.slots.acquire(blocking=False):
+            raise QueueFull()
+
+        job = ProcessingJob(id=uuid.uuid4().hex, document_id=document.id, user_id=document.user_id)
+        db.session.add(job)
+        db.session.commit()
+
+        # Open the document's event stream now, so clients can subscribe while the job is still queued
+        document_events.open(document.id)
+        app = current_app._get_current_object()
+        try:
+            # The job continues the trace of the request that queued it, and is profiled when the request is
+            future = state.executor.submit(self._run, app, state, job.id, document.id, func, args, current_span(),
+                                           profiler.requested_by())
+        except Exception:
+            document_events.close(document.id)
+            state.slots.release()
+            raise
+        with state.lock:
+            state.futures[job.id] = future
+            if state.heartbeat is None:
+                state.heartbeat = threading.Thread(target=self._beat, args=(app, state), daemon=True,
+                                                   name='starc-job-heartbeat')
+                state.heartbeat.start()
+        return job
+
+    # Stamp the rows of this process's jobs every JOB_HEARTBEAT_SECONDS, until none are left.
+    def _beat(self, app, state):
+        while True:
+            time.sleep(app.config['JOB_HEARTBEAT_SECONDS'])
+            with state.lock:
+                job_ids = list(state.futures)
+                if not job_ids:
+                    state.heartbeat = None
+                    return
+            with app.app_context():
+                try:
+                    ProcessingJob.query.filter(ProcessingJob.id.in_(job_ids))\
+                                       .update({'heartbeat_on': datetime.utcnow()}, synchronize_session=False)
+                    db.session.commit()
+                except Exception:
+                    app.logger.exception('Stamping the heartbeat of jobs %s failed', job_ids)
+                finally:
+                    db.session.remove()
+
+    # Run a job inside its own app context and record the outcome on its row.
+    # The document's event stream ends with a 'completed' or 'failed' event.
+    def _run(self, app, state, job_id, document_id, func, args, parent_span=None, profiled_by=None):
+        with app.app_context(), span('job', parent=parent_span, job_id=job_id, document_id=document_id,
+                                     function=func.__name__) as job_span:
+            self._current.job_id = job_id
+            try:
+                self._set_status(job_id, 'running')
+                if profiled_by is None:
+                    func(*args)
+                else:
+                    with profiler.capture(f'job.{func.__name__}', profiled_by, job_id=job_id,
+                                          document_id=document_id):
+                        func(*args)
+                self._set_status(job_id, 'completed')
+                document_events.publish(document_id, 'completed', {'document_id': document_id, 'job_id': job_id})
+            except Exception as e:
+                job_span.record_error(e)
+                db.session.rollback()
+                app.logger.exception('Processing job %s failed', job_id)
+                self._set_status(job_id, 'failed', error=str(e))
+                document_events.publish(document_id, 'failed', {'document_id': document_id, 'job_id': job_id,
+                                                                'error': str(e)})
+            finally:
+                document_events.close(document_id)
+                self._current.job_id = None
+                db.session.remove()
+                state.slots.release()
+                with state.lock:
+                    state.futures.pop(job_id, None)
+
+    def _set_status(self, job_id, status, error=None):
+        job = db.session.get(ProcessingJob, job_id)
+        # The document, and with it the job, may have been deleted while the job was running.
+        if job is None:
+            return
+        job.status = status
+        job.error = error
+        job.heartbeat_on = datetime.utcnow()
+        if status in ('completed', 'failed'):
+            job.finished_on = datetime.utcnow()
+        db.session.commit()
+
+    # Mark the queued and running jobs whose process stopped without finishing them as failed, in their own
+    # transaction. Run on start, and by the routes polling a job. job_id limits this to one job.
+    # Returns the number of jobs marked.
+    def fail_orphaned(self, job_id=None):
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=current_app.config['JOB_HEARTBEAT_SECONDS'] * MISSED_HEARTBEATS)
+        # Rows from before heartbeats were kept only have their creation time
+        query = ProcessingJob.query.filter(
+            ProcessingJob.status.in_(('queued', 'running')),
+            func.coalesce(ProcessingJob.heartbeat_on, ProcessingJob.created_on) < stale,
+        )
+        if job_id is not None:
+            query = query.filter(ProcessingJob.id == job_id)
+        failed = query.update({'status': 'failed', 'error': ORPHANED_ERROR, 'finished_on': now},
+                              synchronize_session=False)
+        db.session.commit()
+        return failed
+
+    # Record page-level progress on the job running in this thread, does nothing outside of a job.
+    def report_progress(self, pages_done, pages_total):
+        job_id = getattr(self._current, 'job_id', None)
+        if job_id is None:
+            return
+        ProcessingJob.query.filter_by(id=job_id).update({'pages_done': pages_done, 'pages_total': pages_total})
+        db.session.commit()
+
+    # Block until a job submitted by this process has finished, used by tests and scripts.
+    def wait(self, job_id, timeout=None):
+        with self._state().lock:
+            future = self._state().futures.get(job_id)
+        if future is not None:
+            future.result(timeout=timeout)
+
+
+# Shared queue instance, bound to the app in create_app.
+jobs = JobQueue()
@@ -0,0 +1,217 @@
+# Performance metrics, served in the Prometheus text format at /metrics.
+# Every request is timed by blueprint and endpoint along with the number and time of the database queries it
+# ran, counted from the engine's cursor events. Calls to the cloud functions, PDF reading and sentence
+# splitting are timed through the timed decorator, wherever they run. The rewrite, score and response cache
+# counters are read at scrape time.
+# Metrics are kept per process and labelled with its pid: with several workers, each scrape shows the worker
+# that answered it.
+import functools
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from api_project import db
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, **extra):
+    pairs = [*zip(names, values), *extra.items()]
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+# One line of a metric read at scrape time rather than kept here.
+def _sample(name, labels, value):
+    return f'{name}{_format_labels(("pid", *labels), (os.getpid(), *labels.values()))} {_format_number(value)}'
+
+
+# A counter per combination of label values.
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = ('pid', *labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        key = (os.getpid(), *label_values)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_format_labels(self.labels, key)} {_format_number(value)}' for key, value in series]
+        return lines
+
+
+# Observations counted into cumulative buckets, with their sum, per combination of label values.
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = ('pid', *labels)
+        self.buckets = (*buckets, float('inf'))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        key = (os.getpid(), *label_values)
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.series[key] = (counts, total + value)
+
+    def render(self):
+        with self.lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self.series.items())
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in series:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le=_format_number(bound))} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_number(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}')
+        return lines
+
+
+REQUESTS = Counter('starc_requests_total', 'Requests answered, by status.',
+                   ('blueprint', 'endpoint', 'method', 'status'))
+REQUEST_DURATION = Histogram('starc_request_duration_seconds', 'Time to answer a request, streams included.',
+                             ('blueprint', 'endpoint', 'method'))
+REQUEST_QUERIES = Histogram('starc_request_db_queries', 'Database queries run by a request.',
+                            ('blueprint', 'endpoint', 'method'), QUERY_COUNT_BUCKETS)
+REQUEST_QUERY_DURATION = Histogram('starc_request_db_seconds', 'Time a request spent in database queries.',
+                                   ('blueprint', 'endpoint', 'method'))
+QUERY_DURATION = Histogram('starc_db_query_duration_seconds',
+                           'Time of each database query, background jobs included.')
+CALL_DURATION = Histogram('starc_call_duration_seconds', 'Time of each call to a timed function.', ('function',))
+CALL_ERRORS = Counter('starc_call_errors_total', 'Calls to a timed function that raised.', ('function',))
+
+REGISTRY = (REQUESTS, REQUEST_DURATION, REQUEST_QUERIES, REQUEST_QUERY_DURATION, QUERY_DURATION, CALL_DURATION,
+            CALL_ERRORS)
+
+
+# Time every call to func as module.function, e.g. processing.get_rewrite, counting the ones that raise.
+def timed(func):
+    name = f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            CALL_ERRORS.inc(name)
+            raise
+        finally:
+            CALL_DURATION.observe(time.perf_counter() - start, name)
+
+    return wrapper
+
+
+# Per-request measurements, kept on g from before_request until the request context is torn down.
+class _RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.status = 500
+
+
+class Metrics:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        # Torn down once a streamed response has been sent, so streams are timed to their end
+        app.teardown_request(self._finish_request)
+        with app.app_context():
+            self._listen(db.engine)
+
+    def _listen(self, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_query(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def end_query(conn, cursor, statement, parameters, context, executemany):
+            self._end_query(conn)
+
+        @event.listens_for(engine, 'handle_error')
+        def failed_query(exception_context):
+            if exception_context.connection is not None:
+                self._end_query(exception_context.connection)
+
+    def _end_query(self, conn):
+        starts = conn.info.get('metrics_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        QUERY_DURATION.observe(elapsed)
+        if has_request_context() and '_request_metrics' in g:
+            g._request_metrics.queries += 1
+            g._request_metrics.query_seconds += elapsed
+
+    def _start_request(self):
+        g._request_metrics = _RequestMetrics()
+
+    def _record_status(self, response):
+        if '_request_metrics' in g:
+            g._request_metrics.status = response.status_code
+        return response
+
+    def _finish_request(self, exception):
+        measured = g.pop('_request_metrics', None)
+        if measured is None:
+            return
+        # Requests that matched no route are counted together
+        labels = (request.blueprint or '', request.endpoint or 'unmatched', request.method)
+        REQUESTS.inc(*labels, measured.status)
+        REQUEST_DURATION.observe(time.perf_counter() - measured.start, *labels)
+        REQUEST_QUERIES.observe(measured.queries, *labels)
+        REQUEST_QUERY_DURATION.observe(measured.query_seconds, *labels)
+
+    # Every metric of this process and the cache counters of the current app, in the Prometheus text format.
+    def render(self):
+        # Imported here, the caches use the timed functions of processing.py
+        from api_project.cache import content_cache
+        from api_project.response_cache import response_cache
+
+        lines = [line for metric in REGISTRY for line in metric.render()]
+        caches = {'content': content_cache.stats(), 'response': response_cache.stats()}
+        lines += ['# HELP starc_cache_events_total Cache lookups by outcome, and evictions.',
+                  '# TYPE starc_cache_events_total counter']
+        for cache, stats in caches.items():
+            for name, value in sorted(stats.items()):
+                if name not in ('memory_entries', 'entries', 'bytes'):
+                    lines.append(_sample('starc_cache_events_total', {'cache': cache, 'event': name}, value))
+        lines += ['# HELP starc_cache_entries Entries held in memory by a cache.', '# TYPE starc_cache_entries gauge']
+        for cache, stats in caches.items():
+            entries = stats['memory_entries'] if 'memory_entries' in stats else stats['entries']
+            lines.append(_sample('starc_cache_entries', {'cache': cache}, entries))
+        lines += ['# HELP starc_response_cache_bytes Size of the bodies held by the response cache.',
+                  '# TYPE starc_response_cache_bytes gauge',
+                  _sample('starc_response_cache_bytes', {}, caches['response']['bytes'])]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
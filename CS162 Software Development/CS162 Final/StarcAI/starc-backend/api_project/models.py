@@ -1,28 +1,42 @@
 from datetime import datetime, timedelta
+import sqlite3
+from sqlalchemy import event, insert_sentinel, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload
+from sqlalchemy.schema import CreateColumn
 from . import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from .passwords import password_hasher
 
 # Create user with username, password, email connected to all their docs
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String, nullable=False)
+    username = db.Column(db.String, nullable=False, index=True)
     password = db.Column(db.String, nullable=False)
-    email = db.Column(db.String, nullable=False)
+    email = db.Column(db.String, nullable=False, index=True)
+    # Admins may profile their requests and read the captures, set with flask set-admin
+    is_admin = db.Column(db.Boolean, default=False, server_default=db.false(), nullable=False)
     documents = db.relationship('Document', backref='user', lazy=True, cascade="all, delete-orphan")
 
-    # Set and check for password using Werkzeug functions.
+    # Set and check for password using Werkzeug functions, run in the password hashing pool.
     
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return password_hasher.verify(self.password, password)
+
+    # Hash the password again when the hashing parameters changed since it was set.
+    def rehash_password_if_needed(self, password):
+        if password_hasher.needs_rehash(self.password):
+            self.set_password(password)
+            return True
+        return False
 
 # Store revoked tokens for logout functionality.
 class RevokedTokenModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     jti = db.Column(db.String(120), unique=True)
-    revoked_on = db.Column(db.DateTime, default=datetime.utcnow)
+    revoked_on = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     def add(self):
         cleanup_revoked_tokens()
@@ -46,17 +60,45 @@ class Document(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     word_count = db.Column(db.Integer, default=0, nullable=False)
-    text_chunks = db.relationship('TextChunks', backref='document', lazy=True, cascade="all, delete-orphan")
+    # Bumped by every change to the title or text, so clients and caches can tell when they are out of date
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    text_chunks = db.relationship('TextChunks', backref='document', lazy=True, cascade="all, delete-orphan", order_by='TextChunks.id')
+    jobs = db.relationship('ProcessingJob', backref='document', lazy=True, cascade="all, delete-orphan")
+
+    # Fetch a document if it belongs to the user, or None, with the related rows the caller reads loaded up front.
+    # Chunks and their sentences take one query each however many there are, scores are joined to the chunks.
+    @classmethod
+    def get_owned(cls, doc_id, user_id, chunks=False, sentences=False, scores=False):
+        query = cls.query.filter_by(id=doc_id, user_id=user_id)
+        if chunks or sentences or scores:
+            text_chunks = selectinload(cls.text_chunks)
+            options = [text_chunks]
+            if sentences:
+                options.append(text_chunks.selectinload(TextChunks.sentences))
+            if scores:
+                options += [text_chunks.joinedload(TextChunks.initial_score),
+                            text_chunks.joinedload(TextChunks.final_score)]
+            query = query.options(*options)
+        return query.first()
+
+    # Names this state of the document for ETags and caches. The upload time tells it apart from a deleted
+    # document whose id SQLite handed out again.
+    @property
+    def version_tag(self):
+        return f'{self.version}.{self.upload_date:%Y%m%d%H%M%S%f}'
 
-# Store a complete piece of text associated with each doc. By segregating docs and its text, we can allow for rewrite and scoring process for a subsection of an entire docs text is an extension feature than rewriting the entire doc.
+# Store a piece of text associated with each doc. Long docs are split into several chunks, in order of id, that are rewritten and scored separately.
 class TextChunks(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     input_text_chunk = db.Column(db.Text, nullable=False)
     rewritten_text = db.Column(db.Text, nullable=False)
-    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False)
-    sentences = db.relationship('Sentence', backref='text_chunk', lazy=True, cascade="all, delete-orphan")
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    # Numbered by SQLAlchemy in each multi-row insert and returned with the ids, so SQLite, which returns them
+    # in no set order, can pair the ids with their rows in one statement
+    _sentinel = insert_sentinel('_sentinel')
+    sentences = db.relationship('Sentence', backref='text_chunk', lazy=True, cascade="all, delete-orphan", order_by='Sentence.id')
     initial_score = db.relationship('InitialScore', backref='text_chunk', uselist=False, cascade="all, delete-orphan")
     final_score = db.relationship('FinalScore', backref='text_chunk', uselist=False, cascade="all, delete-orphan")
 
@@ -68,6 +110,9 @@ class Sentence(db.Model):
     text_chunk_id = db.Column(db.Integer, db.ForeignKey('text_chunks.id'), nullable=False)
     preceding_sentence_id = db.Column(db.Integer, db.ForeignKey('sentence.id'))
 
+    # Sentences are always read by chunk, in order
+    __table_args__ = (db.Index('ix_sentence_text_chunk_id_id', 'text_chunk_id', 'id'),)
+
 # Store scores for original text.
 class InitialScore(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -75,7 +120,7 @@ class InitialScore(db.Model):
     optimism = db.Column(db.Float, nullable=False)
     forecast = db.Column(db.Float, nullable=False)
     confidence = db.Column(db.Float, nullable=False)
-    text_chunk_id = db.Column(db.Integer, db.ForeignKey('text_chunks.id'), nullable=False)
+    text_chunk_id = db.Column(db.Integer, db.ForeignKey('text_chunks.id'), nullable=False, index=True)
 
 # Store scores for rewritten text.
 class FinalScore(db.Model):
@@ -84,4 +129,82 @@ class FinalScore(db.Model):
     optimism = db.Column(db.Float, nullable=False)
     forecast = db.Column(db.Float, nullable=False)
     confidence = db.Column(db.Float, nullable=False)
-    text_chunk_id = db.Column(db.Integer, db.ForeignKey('text_chunks.id'), nullable=False)
+    text_chunk_id = db.Column(db.Integer, db.ForeignKey('text_chunks.id'), nullable=False, index=True)
+
+# Track the background rewrite and scoring of a document so clients can poll for its progress.
+class ProcessingJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    status = db.Column(db.String(20), default='queued', nullable=False)
+    error = db.Column(db.Text)
+    pages_done = db.Column(db.Integer)
+    pages_total = db.Column(db.Integer)
+    created_on = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_on = db.Column(db.DateTime)
+    # Last time the process running the job showed it was alive, see jobs.py
+    heartbeat_on = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Jobs are looked up by document, latest first
+    __table_args__ = (db.Index('ix_processing_job_document_id_created_on', 'document_id', 'created_on'),)
+
+# Cache of rewrites and scores keyed by a hash of the normalized text, so repeated content skips the cloud functions.
+class CachedText(db.Model):
+    key = db.Column(db.String(64), primary_key=True)
+    rewritten_text = db.Column(db.Text)
+    score = db.Column(db.Float)
+    optimism = db.Column(db.Float)
+    forecast = db.Column(db.Float)
+    confidence = db.Column(db.Float)
+    created_on = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    last_used = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+# Running totals of a user's documents and their scores, kept in step by triggers (see user_stats.py) so
+# dashboards read a single row instead of every document and score.
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    document_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    word_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    initial_score_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    initial_score_sum = db.Column(db.Float, default=0, server_default='0', nullable=False)
+    final_score_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    final_score_sum = db.Column(db.Float, default=0, server_default='0', nullable=False)
+
+# Add the columns declared above that are missing from the tables of an existing database, create_all only
+# creates whole tables. Columns that can't be null need a server default to be added. Safe to run on every start.
+def create_missing_columns():
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    definition = CreateColumn(column).compile(dialect=connection.dialect)
+                    table_name = connection.dialect.identifier_preparer.format_table(table)
+                    connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {definition}'))
+
+# Create the indexes declared above that are missing from an existing database, create_all only adds them
+# along with new tables. Safe to run on every start.
+def create_missing_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+# Create the tables, with the search index and statistics triggers created along with them, then the columns
+# and indexes an existing database is missing. Safe to run on every start.
+def create_schema():
+    db.create_all()
+    create_missing_columns()
+    create_missing_indexes()
+
+# Count words the way str.split does, available to SQL on SQLite as word_count(text) so word counts can be
+# recomputed inside an UPDATE.
+def count_text_words(text):
+    return len(text.split()) if text else 0
+
+@event.listens_for(Engine, 'connect')
+def register_sql_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('word_count', 1, count_text_words, deterministic=True)
@@ -0,0 +1,86 @@
+# Password hashing off the request threads.
+# Hashes are deliberately slow, so they run in a small process pool shared by every request in this process:
+# a burst of logins then waits on the pool instead of holding the GIL and stalling every other request. A
+# semaphore bounds hashes queued + running, past which callers get HashQueueFull instead of waiting.
+# The method and its parameters come from PASSWORD_HASH_METHOD, in werkzeug's format, and stored hashes made
+# with other parameters are reported by needs_rehash so login can replace them.
+import threading
+
+from flask import current_app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+from api_project.process_pools import get_pool
+
+
+# Raised when as many hashes are queued as PASSWORD_HASH_QUEUE_SIZE allows.
+class HashQueueFull(Exception):
+    pass
+
+
+# Per-app state: the semaphore bounding queued + running hashes and the method with every parameter spelled out.
+class _HasherState:
+    def __init__(self, method, workers, queue_size):
+        self.method = normalize_method(method)
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max(workers, 1) + queue_size)
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_QUEUE_SIZE', 32)
+        app.extensions['password_hasher'] = _HasherState(app.config['PASSWORD_HASH_METHOD'],
+                                                         app.config['PASSWORD_HASH_WORKERS'],
+                                                         app.config['PASSWORD_HASH_QUEUE_SIZE'])
+
+    def _state(self):
+        return current_app.extensions['password_hasher']
+
+    # Hash a password with the configured method. Raises HashQueueFull when saturated.
+    def hash(self, password):
+        state = self._state()
+        return self._call(state, generate_password_hash, password, state.method)
+
+    # Check a password against a stored hash. Raises HashQueueFull when saturated.
+    def verify(self, stored, password):
+        return self._call(self._state(), check_password_hash, stored, password)
+
+    # Whether a stored hash was made with another method or other parameters than the configured ones.
+    def needs_rehash(self, stored):
+        return stored.split('$', 1)[0] != self._state().method
+
+    # Run a hash function in the pool, or on this thread when PASSWORD_HASH_WORKERS is 0.
+    def _call(self, state, func, *args):
+        if not state.slots.acquire(blocking=False):
+            raise HashQueueFull()
+        try:
+            if state.workers <= 0:
+                return func(*args)
+            return get_pool('passwords', state.workers).submit(func, *args).result()
+        finally:
+            state.slots.release()
+
+
+# Spell out werkzeug's defaults, as they appear at the start of the hashes it makes, e.g. scrypt:32768:8:1.
+def normalize_method(method):
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        if len(args) not in (0, 3):
+            raise ValueError("'scrypt' takes 3 arguments.")
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f'scrypt:{n}:{r}:{p}'
+    if name == 'pbkdf2':
+        if len(args) > 2:
+            raise ValueError("'pbkdf2' takes 2 arguments.")
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    raise ValueError(f"Invalid hash method '{method}'.")
+
+
+# Shared hasher, bound to the app in create_app.
+password_hasher = PasswordHasher()
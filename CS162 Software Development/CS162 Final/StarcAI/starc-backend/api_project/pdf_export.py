@@ -0,0 +1,155 @@
+# PDF export of documents.
+# Text is wrapped to the page width and flows over as many pages as it needs, optionally with the rewritten
+# text in a second column next to the original. Rendered files are cached on disk by document id, content
+# version and layout, so repeated downloads are streamed from the cache instead of being drawn again.
+# reportlab is imported by the functions that draw, on the first export rather than when the app starts.
+import glob
+import os
+import tempfile
+
+from flask import current_app
+
+LAYOUTS = ('original', 'side_by_side')
+
+FONT = 'Helvetica'
+BOLD_FONT = 'Helvetica-Bold'
+FONT_SIZE = 11
+LEADING = 14
+MARGIN = 72
+GUTTER = 24
+
+
+# Draw the document to output, a path or file object. chunks is a list of (original, rewritten) text pairs.
+def render_document_pdf(output, title, chunks, layout='original'):
+    from reportlab.lib.pagesizes import LETTER
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfgen import canvas
+
+    pdf = canvas.Canvas(output, pagesize=LETTER)
+    pdf.setTitle(title)
+    page_width, page_height = LETTER
+
+    side_by_side = layout == 'side_by_side'
+    columns = 2 if side_by_side else 1
+    column_width = (page_width - 2 * MARGIN - GUTTER * (columns - 1)) / columns
+    column_x = [MARGIN + index * (column_width + GUTTER) for index in range(columns)]
+
+    def start_page():
+        pdf.setFont(FONT, FONT_SIZE)
+        return page_height - MARGIN
+
+    y = start_page()
+    pdf.setFont(BOLD_FONT, FONT_SIZE + 3)
+    for line in simpleSplit(title, BOLD_FONT, FONT_SIZE + 3, page_width - 2 * MARGIN):
+        pdf.drawString(MARGIN, y, line)
+        y -= LEADING + 3
+    if side_by_side:
+        pdf.setFont(BOLD_FONT, FONT_SIZE)
+        for x, heading in zip(column_x, ('Original', 'Rewritten')):
+            pdf.drawString(x, y, heading)
+        y -= LEADING
+    pdf.setFont(FONT, FONT_SIZE)
+    y -= LEADING / 2
+
+    for original, rewritten in chunks:
+        texts = (original, rewritten) if side_by_side else (original,)
+        # Each column is wrapped separately and the rows are drawn in step, so a chunk starts level in both columns
+        wrapped = [_wrap(text, column_width) for text in texts]
+        for row in range(max(len(lines) for lines in wrapped)):
+            if y < MARGIN:
+                pdf.showPage()
+                y = start_page()
+            for x, lines in zip(column_x, wrapped):
+                if row < len(lines):
+                    pdf.drawString(x, y, lines[row])
+            y -= LEADING
+        y -= LEADING / 2
+
+    pdf.showPage()
+    pdf.save()
+
+
+# Wrap text to a column width, keeping its line breaks and blank lines between paragraphs.
+def _wrap(text, width):
+    from reportlab.lib.utils import simpleSplit
+
+    lines = []
+    for paragraph in text.split('\n'):
+        lines.extend(simpleSplit(paragraph, FONT, FONT_SIZE, width) or [''])
+    return lines
+
+
+def _cache_dir():
+    directory = current_app.config['PDF_EXPORT_CACHE_DIR'] or os.path.join(tempfile.gettempdir(), 'starc-pdf-cache')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+# Open the cached PDF for a document version, or return None when it has not been rendered. Files are returned
+# open, an open file can still be read after another request evicts it.
+def find_cached_pdf(doc_id, version, layout):
+    try:
+        return open(_cache_path(_cache_dir(), doc_id, version, layout), 'rb')
+    except FileNotFoundError:
+        return None
+
+
+# Open the cached PDF for a document version, rendering it with render(path) on a miss.
+def get_cached_pdf(doc_id, version, layout, render):
+    directory = _cache_dir()
+    path = _cache_path(directory, doc_id, version, layout)
+    cached = find_cached_pdf(doc_id, version, layout)
+    if cached is not None:
+        return cached
+
+    # Render to a temp file and move it into place, so readers never see a half-written file. It is opened
+    # before the move, so evictions from here on can't take it away.
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(handle)
+    try:
+        render(temp_path)
+        cached = open(temp_path, 'rb')
+        os.replace(temp_path, path)
+    except Exception:
+        if cached is not None:
+            cached.close()
+        _remove(temp_path)
+        raise
+
+    # Older versions of the document in the same layout will not be asked for again
+    for stale in glob.glob(os.path.join(directory, f'{doc_id}-*-{layout}.pdf')):
+        if stale != path:
+            _remove(stale)
+    _evict(directory)
+    return cached
+
+
+def _cache_path(directory, doc_id, version, layout):
+    return os.path.join(directory, f'{doc_id}-{version}-{layout}.pdf')
+
+
+# Remove every cached export of a document.
+def discard_cached_pdfs(doc_id):
+    for path in glob.glob(os.path.join(_cache_dir(), f'{doc_id}-*.pdf')):
+        _remove(path)
+
+
+# Keep at most PDF_EXPORT_CACHE_MAX_FILES files, removing the least recently written first.
+def _evict(directory):
+    paths = sorted(glob.glob(os.path.join(directory, '*.pdf')), key=_mtime)
+    for path in paths[:max(0, len(paths) - current_app.config['PDF_EXPORT_CACHE_MAX_FILES'])]:
+        _remove(path)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,112 @@
+# Text extraction for uploaded PDFs.
+# Uploads are spooled to a temp file in fixed-size blocks, checked against size and page limits, and their
+# pages are extracted in a process pool, a batch of pages per task. Page texts are collected in a list and
+# joined once, and progress is reported back after every batch. Opening a PDF reads the whole file and listing
+# its pages loads the whole page tree, so each worker keeps the reader of the upload it is working on.
+from concurrent.futures import as_completed
+import os
+import tempfile
+
+from api_project.metrics import timed
+from api_project.process_pools import get_pool
+
+SPOOL_BLOCK_SIZE = 64 * 1024
+
+# In a worker process, the last file opened by _extract_pages, as ((path, modification time), reader).
+_reader = (None, None)
+
+
+# Raised when an upload is over the configured size or page limit.
+class PdfTooLarge(Exception):
+    pass
+
+
+# Copy an uploaded file to a temp file, raising PdfTooLarge once more than max_bytes were read.
+def spool_upload(stream, max_bytes):
+    spooled = tempfile.NamedTemporaryFile(prefix='starc-upload-', suffix='.pdf', delete=False)
+    try:
+        with spooled:
+            size = 0
+            while True:
+                block = stream.read(SPOOL_BLOCK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if size > max_bytes:
+                    raise PdfTooLarge(f'PDF is larger than {max_bytes} bytes')
+                spooled.write(block)
+    except Exception:
+        os.unlink(spooled.name)
+        raise
+    return spooled.name
+
+
+# Count the pages of a spooled PDF from the count its page tree declares, raising PdfTooLarge above max_pages.
+# The pages themselves are only loaded by the processing job, which checks their real count again.
+@timed
+def count_pages(path, max_pages):
+    page_count = int(_open(path).trailer['/Root']['/Pages']['/Count'])
+    if page_count > max_pages:
+        raise PdfTooLarge(f'PDF has more than {max_pages} pages')
+    return page_count
+
+
+# Extract the text of every page, one line break after each page as before, raising PdfTooLarge above
+# max_pages. progress(pages_done, pages_total) is called after each batch of pages.
+@timed
+def extract_text(path, workers=1, pages_per_task=16, progress=None, max_pages=None):
+    reader = _open(path)
+    page_count = len(reader.pages)
+    if max_pages is not None and page_count > max_pages:
+        raise PdfTooLarge(f'PDF has more than {max_pages} pages')
+    batches = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    page_texts = [None] * len(batches)
+    pages_done = 0
+
+    if workers <= 1 or len(batches) == 1:
+        for index, (start, end) in enumerate(batches):
+            page_texts[index] = _read_pages(reader, start, end)
+            pages_done += end - start
+            if progress:
+                progress(pages_done, page_count)
+    else:
+        pool = get_pool('pdf_extract', workers)
+        futures = {pool.submit(_extract_pages, path, start, end): index for index, (start, end) in enumerate(batches)}
+        for future in as_completed(futures):
+            index = futures[future]
+            page_texts[index] = future.result()
+            start, end = batches[index]
+            pages_done += end - start
+            if progress:
+                progress(pages_done, page_count)
+
+    return ''.join(text + '\n' for batch in page_texts for text in batch)
+
+
+# Worker task: extract a range of pages, reusing the reader of the previous task when it was for the same file.
+def _extract_pages(path, start, end):
+    global _reader
+    key = (path, os.stat(path).st_mtime_ns)
+    opened, reader = _reader
+    if opened != key:
+        reader = _open(path)
+        _reader = (key, reader)
+    return _read_pages(reader, start, end)
+
+
+def _read_pages(reader, start, end):
+    return [reader.pages[number].extract_text() for number in range(start, end)]
+
+
+# pypdf is imported on first use, only uploads need it.
+def _open(path):
+    from pypdf import PdfReader
+    return PdfReader(path)
+
+
+# Remove a spooled upload once it is no longer needed.
+def discard_upload(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
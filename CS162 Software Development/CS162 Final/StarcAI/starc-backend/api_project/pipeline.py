@@ -0,0 +1,385 @@
+# Document processing pipeline: chunking, rewriting, scoring, sentence tokenization and persistence.
+# Used by the processing jobs for new documents and by PUT /docs/<id> for edits. Each stage is traced as a span
+# of the job or request running it.
+from difflib import SequenceMatcher
+import os
+
+from flask import current_app
+from sqlalchemy import case, delete, exists, func, insert, literal, select, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from api_project import db
+from api_project.cache import content_cache, SCORE_FIELDS
+from api_project.chunking import split_into_chunks, get_tokenizer
+from api_project.events import document_events
+from api_project.jobs import jobs
+from api_project.models import Document, TextChunks, Sentence, InitialScore, FinalScore
+from api_project.pdf_extract import extract_text, discard_upload
+from api_project.tracing import current_span, span, traced
+
+
+# Rewrite, score, tokenize and store the text of an existing document. Runs inside a processing job.
+# Each chunk's sentences are published to the document's event stream as soon as its rewrite comes back,
+# followed by the scores of every chunk once they are known and the ids of the sentences once they are stored.
+@traced
+def process_document_text(document_id, text):
+    current_span().set(document_id=document_id, text_length=len(text))
+    with span("chunking", text_length=len(text)) as stage:
+        chunks = split_into_chunks(text, current_app.config["CHUNK_MAX_CHARS"])
+        stage.set(chunks=len(chunks))
+    chunk_sentences = [None] * len(chunks)
+
+    def publish_rewrite(index, rewritten_text):
+        # Pair the sentences of the chunk with the sentences of its rewrite
+        with span("tokenize", chunk_index=index, text_length=len(chunks[index])) as stage:
+            tokenizer = get_tokenizer()
+            chunk_sentences[index] = list(zip(tokenizer.tokenize(chunks[index]), tokenizer.tokenize(rewritten_text)))
+            stage.set(sentences=len(chunk_sentences[index]))
+        document_events.publish(document_id, "rewrite", {
+            "chunk_index": index,
+            "sentences": [
+                {"original_sentence": orig, "rewritten_sentence": rewr} for orig, rewr in chunk_sentences[index]
+            ],
+        })
+
+    with span("rewrite", chunks=len(chunks)):
+        rewrites = content_cache.rewrite(chunks, on_result=publish_rewrite)
+    with span("score", texts=len(chunks) * 2):
+        scores = content_cache.score(chunks + rewrites)
+
+    results = []
+    for index, (chunk, rewritten_text, original_scores_data, rewritten_scores_data) in enumerate(zip(
+        chunks, rewrites, scores[:len(chunks)], scores[len(chunks):]
+    )):
+        document_events.publish(document_id, "scores", {
+            "chunk_index": index,
+            "initial_score": dict(zip(SCORE_FIELDS, original_scores_data)),
+            "final_score": dict(zip(SCORE_FIELDS, rewritten_scores_data)),
+        })
+        results.append(
+            {
+                "text": chunk,
+                "rewritten_text": rewritten_text,
+                "original_scores": original_scores_data,
+                "rewritten_scores": rewritten_scores_data,
+                "sentences": chunk_sentences[index],
+            }
+        )
+
+    # Store everything in a single transaction
+    with span("store", chunks=len(results), sentences=sum(len(result["sentences"]) for result in results)):
+        text_chunk_ids = store_chunks(document_id, results)
+        bump_version(document_id)
+    with span("commit"):
+        db.session.commit()
+    publish_sentence_ids(document_id, text_chunk_ids)
+
+    return {
+        "message": "Document and text chunk processed successfully",
+        "document_id": document_id,
+        "text_chunk_ids": text_chunk_ids,
+    }
+
+
+# Extract the text of a spooled PDF upload, then process it like typed text. Runs inside a processing job.
+@traced
+def process_pdf_upload(document_id, path):
+    current_span().set(document_id=document_id)
+    with span("pdf_extract", bytes=os.path.getsize(path)) as stage:
+        def progress(pages_done, pages_total):
+            stage.set(pages=pages_total)
+            jobs.report_progress(pages_done, pages_total)
+
+        try:
+            text = extract_text(
+                path,
+                workers=current_app.config["PDF_EXTRACT_WORKERS"],
+                pages_per_task=current_app.config["PDF_PAGES_PER_TASK"],
+                progress=progress,
+                max_pages=current_app.config["PDF_MAX_PAGES"],
+            )
+        finally:
+            discard_upload(path)
+        stage.set(text_length=len(text))
+
+    with span("word_count", text_length=len(text)) as stage:
+        document = db.session.get(Document, document_id)
+        document.word_count = len(text.split())
+        stage.set(words=document.word_count)
+    return process_document_text(document_id, text)
+
+
+# Replace the text of a document, only rewriting the sentences that are new or were changed.
+# Sentences matching the stored ones keep their current rewrite, including accepted or reset suggestions.
+# Changed sentences next to each other in a chunk are rewritten together, so the rewrite sees them in context.
+# Returns the number of sentences that were sent to the rewrite function.
+@traced
+def reprocess_document_text(document, new_text):
+    # Kept apart, the cache commits its entries and reading the id of the expired document would reload it
+    document_id = document.id
+    current_span().set(document_id=document_id, text_length=len(new_text))
+    old_sentences = [
+        (sentence.original_text, sentence.rewritten_text)
+        for text_chunk in document.text_chunks
+        for sentence in text_chunk.sentences
+    ]
+
+    with span("chunking", text_length=len(new_text)) as stage:
+        chunks = split_into_chunks(new_text, current_app.config["CHUNK_MAX_CHARS"])
+        stage.set(chunks=len(chunks))
+    with span("tokenize", text_length=len(new_text)) as stage:
+        chunk_sentences = [get_tokenizer().tokenize(chunk) for chunk in chunks]
+        new_sentences = [sentence for sentences in chunk_sentences for sentence in sentences]
+        stage.set(sentences=len(new_sentences))
+
+    # Reuse the rewrites of unchanged sentences and collect the positions of the rest
+    with span("diff", old_sentences=len(old_sentences), sentences=len(new_sentences)) as stage:
+        rewrites = [None] * len(new_sentences)
+        matcher = SequenceMatcher(None, [orig for orig, _ in old_sentences], new_sentences, autojunk=False)
+        for tag, old_start, _, new_start, new_end in matcher.get_opcodes():
+            if tag == "equal":
+                for offset in range(new_end - new_start):
+                    rewrites[new_start + offset] = old_sentences[old_start + offset][1]
+        changed = [i for i, rewrite in enumerate(rewrites) if rewrite is None]
+        stage.set(changed_sentences=len(changed))
+
+    if changed:
+        runs = _changed_runs(chunk_sentences, rewrites)
+        with span("rewrite", sentences=len(changed), runs=len(runs)):
+            run_rewrites = content_cache.rewrite([" ".join(new_sentences[i] for i in run) for run in runs])
+            # A run whose rewrite doesn't split into one sentence per original is sent again sentence by sentence
+            single = []
+            for run, run_rewrite in zip(runs, run_rewrites):
+                sentences = [run_rewrite] if len(run) == 1 else get_tokenizer().tokenize(run_rewrite)
+                if len(sentences) == len(run):
+                    for i, sentence in zip(run, sentences):
+                        rewrites[i] = sentence
+                else:
+                    single.extend(run)
+            if single:
+                for i, rewrite in zip(single, content_cache.rewrite([new_sentences[i] for i in single])):
+                    rewrites[i] = rewrite
+
+    # Rebuild each chunk's rewrite from its sentences and score every chunk, unchanged chunks hit the cache
+    results = []
+    position = 0
+    for chunk, sentences in zip(chunks, chunk_sentences):
+        sentence_rewrites = rewrites[position:position + len(sentences)]
+        position += len(sentences)
+        results.append(
+            {
+                "text": chunk,
+                "rewritten_text": " ".join(sentence_rewrites),
+                "sentences": list(zip(sentences, sentence_rewrites)),
+            }
+        )
+
+    with span("score", texts=len(results) * 2):
+        scores = content_cache.score(
+            [result["text"] for result in results] + [result["rewritten_text"] for result in results]
+        )
+    for result, original_scores_data, rewritten_scores_data in zip(
+        results, scores[:len(results)], scores[len(results):]
+    ):
+        result["original_scores"] = original_scores_data
+        result["rewritten_scores"] = rewritten_scores_data
+
+    # Replace the existing text chunks and related data in a single transaction
+    with span("store", chunks=len(results), sentences=len(new_sentences)):
+        delete_chunks(document_id)
+        db.session.expire(document, ["text_chunks"])
+        store_chunks(document_id, results)
+        bump_version(document_id, word_count=len(new_text.split()))
+    with span("commit"):
+        db.session.commit()
+    return len(changed)
+
+
+# Store processed chunks in order with their scores and sentences, in the current transaction.
+# Rows are written with one executemany insert per table instead of one ORM flush per object.
+def store_chunks(document_id, results):
+    if not results:
+        return []
+
+    # Insert the chunks and get their ids back in the order of the rows, in one statement on SQLite too thanks
+    # to the sentinel column of TextChunks.
+    text_chunk_ids = db.session.scalars(
+        insert(TextChunks).returning(TextChunks.id, sort_by_parameter_order=True),
+        [
+            {
+                "document_id": document_id,
+                "input_text_chunk": result["text"],
+                "rewritten_text": result["rewritten_text"],
+            }
+            for result in results
+        ],
+    ).all()
+    if len(text_chunk_ids) != len(results):
+        raise RuntimeError(f"Inserted {len(results)} chunks but got {len(text_chunk_ids)} ids back")
+
+    # Store the original and rewritten scores
+    for model, scores_key in ((InitialScore, "original_scores"), (FinalScore, "rewritten_scores")):
+        db.session.execute(
+            insert(model),
+            [
+                {
+                    "text_chunk_id": text_chunk_id,
+                    "score": result[scores_key][0],
+                    "optimism": result[scores_key][1],
+                    "forecast": result[scores_key][2],
+                    "confidence": result[scores_key][3],
+                }
+                for text_chunk_id, result in zip(text_chunk_ids, results)
+            ],
+        )
+
+    # Store the sentences
+    sentence_rows = [
+        {"text_chunk_id": text_chunk_id, "original_text": orig, "rewritten_text": rewr}
+        for text_chunk_id, result in zip(text_chunk_ids, results)
+        for orig, rewr in result["sentences"]
+    ]
+    if sentence_rows:
+        db.session.execute(insert(Sentence), sentence_rows)
+
+    return text_chunk_ids
+
+
+# Publish the ids of the stored sentences of each chunk, in order, which the rewrite events were sent without.
+def publish_sentence_ids(document_id, text_chunk_ids):
+    if document_events.subscribe(document_id) is None:
+        return
+    sentence_ids = {text_chunk_id: [] for text_chunk_id in text_chunk_ids}
+    rows = db.session.execute(
+        select(Sentence.text_chunk_id, Sentence.id)
+        .where(Sentence.text_chunk_id.in_(text_chunk_ids))
+        .order_by(Sentence.text_chunk_id, Sentence.id)
+    )
+    for text_chunk_id, sentence_id in rows:
+        sentence_ids[text_chunk_id].append(sentence_id)
+    for index, text_chunk_id in enumerate(text_chunk_ids):
+        document_events.publish(document_id, "stored", {
+            "chunk_index": index,
+            "sentence_ids": sentence_ids[text_chunk_id],
+        })
+
+
+# Delete every text chunk of a document with its sentences and scores, in the current transaction.
+# Chunks already loaded on the document are left in place, expire them if the document is used further.
+def delete_chunks(document_id):
+    for model in (Sentence, InitialScore, FinalScore):
+        db.session.execute(delete(model).where(model.text_chunk_id.in_(_chunk_ids(document_id))))
+    db.session.execute(delete(TextChunks).where(TextChunks.document_id == document_id))
+
+
+# Text of each chunk rebuilt from a column of its sentences in id order, for the chunk being updated. Postgres
+# orders the aggregate itself. group_concat only takes an ORDER BY from SQLite 3.44, so on SQLite the sentences
+# are fed from a subquery ordered by id: an ordered subquery is never flattened into an aggregate query (rule 16
+# of SQLite's query flattener), so its rows are scanned and concatenated in their order.
+def joined_sentences(column):
+    in_chunk = Sentence.text_chunk_id == TextChunks.id
+    if db.engine.dialect.name == "postgresql":
+        joined = select(func.string_agg(column, aggregate_order_by(literal(" "), Sentence.id))).where(in_chunk)
+    else:
+        ordered = select(column.label("text")).where(in_chunk).order_by(Sentence.id).correlate(TextChunks).subquery()
+        joined = select(func.group_concat(ordered.c.text, " "))
+    return select(func.coalesce(joined.correlate(TextChunks).scalar_subquery(), "")).scalar_subquery()
+
+
+# Word count of a document from the text of its chunks, for the document row being updated. Words are split
+# on whitespace as str.split does, by the word_count function registered on SQLite connections or by a regular
+# expression on Postgres.
+def counted_words(document_id):
+    if db.engine.dialect.name == "postgresql":
+        words = func.regexp_split_to_array(func.nullif(func.btrim(TextChunks.input_text_chunk), ""), r"\s+")
+        chunk_words = func.coalesce(func.array_length(words, 1), 0)
+    else:
+        chunk_words = func.word_count(TextChunks.input_text_chunk)
+    return (
+        select(func.coalesce(func.sum(chunk_words), 0))
+        .where(TextChunks.document_id == document_id)
+        .scalar_subquery()
+    )
+
+
+# Mark a document as changed, along with any other values of its row, in the current transaction. The version
+# is incremented by the database, so concurrent changes each get one of their own.
+def bump_version(document_id, **values):
+    db.session.execute(
+        update(Document)
+        .where(Document.id == document_id)
+        .values(version=Document.version + 1, **values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Accept suggested rewrites as the new text, in the current transaction and without loading any sentence.
+# The chunks with a suggestion get their text rebuilt from the rewritten sentences, the sentences take their
+# rewrites as originals and the document's words are recounted with its version bumped. sentence_id limits this to one sentence.
+# Returns the number of sentences that changed.
+def accept_suggestions(document_id, sentence_id=None):
+    suggestions = [Sentence.original_text != Sentence.rewritten_text]
+    if sentence_id is not None:
+        suggestions.append(Sentence.id == sentence_id)
+
+    db.session.execute(
+        update(TextChunks)
+        .where(
+            TextChunks.document_id == document_id,
+            exists().where(Sentence.text_chunk_id == TextChunks.id, *suggestions),
+        )
+        .values(
+            input_text_chunk=joined_sentences(
+                Sentence.rewritten_text if sentence_id is None
+                else case((Sentence.id == sentence_id, Sentence.rewritten_text), else_=Sentence.original_text)
+            )
+        )
+        .execution_options(synchronize_session=False)
+    )
+    changed = db.session.execute(
+        update(Sentence)
+        .where(Sentence.text_chunk_id.in_(_chunk_ids(document_id)), *suggestions)
+        .values(original_text=Sentence.rewritten_text)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if changed:
+        bump_version(document_id, word_count=counted_words(document_id))
+    return changed
+
+
+# Drop suggested rewrites by resetting them to the original text, bumping the document's version, in the
+# current transaction. sentence_id limits this to one sentence. Returns the number of sentences that changed.
+def reset_suggestions(document_id, sentence_id=None):
+    suggestions = [Sentence.original_text != Sentence.rewritten_text]
+    if sentence_id is not None:
+        suggestions.append(Sentence.id == sentence_id)
+    changed = db.session.execute(
+        update(Sentence)
+        .where(Sentence.text_chunk_id.in_(_chunk_ids(document_id)), *suggestions)
+        .values(rewritten_text=Sentence.original_text)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if changed:
+        bump_version(document_id)
+    return changed
+
+
+# Positions of the sentences without a rewrite, grouped in runs of neighbours within the same chunk.
+def _changed_runs(chunk_sentences, rewrites):
+    runs = []
+    position = 0
+    for sentences in chunk_sentences:
+        run = []
+        for i in range(position, position + len(sentences)):
+            if rewrites[i] is None:
+                run.append(i)
+            elif run:
+                runs.append(run)
+                run = []
+        if run:
+            runs.append(run)
+        position += len(sentences)
+    return runs
+
+
+def _chunk_ids(document_id):
+    return select(TextChunks.id).where(TextChunks.document_id == document_id).scalar_subquery()
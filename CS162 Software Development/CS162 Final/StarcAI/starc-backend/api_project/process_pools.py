@@ -0,0 +1,19 @@
+# Process pools for CPU-bound work kept off the request threads, shared by every app in this process.
+# A pool is kept per name and number of workers, so apps configured with different worker counts each get a
+# pool of the size they asked for. Pools are started on first use.
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, workers):
+    with _pools_lock:
+        pool = _pools.get((name, workers))
+        if pool is None:
+            # Spawn rather than fork, the web process has threads running that forked children would inherit
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pools[name, workers] = pool
+        return pool
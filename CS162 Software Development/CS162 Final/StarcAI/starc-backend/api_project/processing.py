@@ -1,40 +1,119 @@
-import requests
-import json
 import os
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+from flask import current_app, has_app_context
+from api_project.cloud_client import CloudFunctionClient
+from api_project.metrics import timed
 load_dotenv()
 
 # Google API Key for function calls
-# Note: this key is editable from cloud console and has preset limits 
+# Note: this key is editable from cloud console and has preset limits
 gc_virtual_api_key = os.environ.get("GC_API_KEY")
 
+# Client for the cloud functions outside of an app, built from the environment on first use or by
+# configure_client. Each app has its own, made by create_app from its GC_* settings.
+_client = None
+_client_lock = threading.RLock()
+
+# Threads used to run independent cloud function calls at the same time, the client still caps what is in flight.
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='starc-gc')
+
+
+# A client for the cloud functions at base_url, or at GC_FUNCTIONS_URL from the environment.
+def create_client(base_url=None, **settings):
+    return CloudFunctionClient(
+        base_url or os.environ.get('GC_FUNCTIONS_URL', 'https://us-central1-starcai.cloudfunctions.net'),
+        api_key=gc_virtual_api_key,
+        **settings,
+    )
+
+
+# Replace the client used outside of an app, for scripts and tests calling these functions directly.
+def configure_client(base_url=None, **settings):
+    global _client
+    new_client = create_client(base_url, **settings)
+    with _client_lock:
+        old_client, _client = _client, new_client
+    if old_client is not None:
+        old_client.close()
+    return new_client
+
+
+# The current app's client, or the one used outside of an app. Threads without the app context, like the
+# ones of _executor, are handed the client by their caller.
+def get_client():
+    if has_app_context() and 'cloud_client' in current_app.extensions:
+        return current_app.extensions['cloud_client']
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                configure_client()
+    return _client
+
+
 # kept dormant now for testing purposes
+@timed
 def get_scoresSA(text):
-    # Constructing the URL with the API key
-    url_SA = f'https://us-central1-starcai.cloudfunctions.net/entry_pointSA?apikey={gc_virtual_api_key}'
-    # Making the POST request with JSON data, this returns a response object in string format here for 'text' 
-    response_SA = requests.post(url_SA, json={'text': text})
+    # Making the POST request with JSON data, this returns a response object in string format here for 'text'
+    response_SA = get_client().post('entry_pointSA', {'text': text})
 
     # Parse the response text to a Python list
-    scores = json.loads(response_SA.text)
+    scores = response_SA.json()
     # Check if the scores are list and convert each element to float to be stored in our database
     if isinstance(scores, list):
         scores = [float(score) for score in scores]
-        
+
     # return the sentiment scores from the cloud function
     # Order: Overall Score, Optimism, Confidence, Strategic Forecasts
     return scores
 
 # base function for placeholder scores
+@timed
 def get_scores(text):
     random_numbers = [random.uniform(1,100) for _ in range(4)]
     return random_numbers
 
-def get_rewrite(original_text):
-    # Constructing the URL with the API key
-    url_GPT = f'https://us-central1-starcai.cloudfunctions.net/entry_pointGPT?apikey={gc_virtual_api_key}'
-    # Making the POST request with JSON data
-    response = requests.post(url_GPT, json={'text': original_text})
+# base function for placeholder batch scores
+@timed
+def get_scores_batch(texts):
+    return [get_scores(text) for text in texts]
+
+@timed
+def get_rewrite(original_text, client=None):
+    # Making the POST request with JSON data, not repeated after a timeout as the rewrite may still be running
+    response = (client or get_client()).post('entry_pointGPT', {'text': original_text}, idempotent=False)
     # return rewritten text from the cloud function
     return response.text
+
+# Rewrite several texts concurrently, returning the rewrites in the order of texts.
+# on_result(index, rewrite) is called in the calling thread as each rewrite comes back.
+@timed
+def rewrite_many(texts, on_result=None):
+    texts = list(texts)
+    client = get_client()
+    if len(texts) == 1:
+        rewrites = [get_rewrite(texts[0], client)]
+        if on_result:
+            on_result(0, rewrites[0])
+        return rewrites
+    if on_result is None:
+        return list(_executor.map(get_rewrite, texts, [client] * len(texts)))
+
+    rewrites = [None] * len(texts)
+    futures = {_executor.submit(get_rewrite, text, client): index for index, text in enumerate(texts)}
+    for future in as_completed(futures):
+        index = futures[future]
+        rewrites[index] = future.result()
+        on_result(index, rewrites[index])
+    return rewrites
+
+# Rewrite several texts concurrently, then score every original and rewrite in one batch call.
+# Returns the rewrites, the original scores and the rewritten scores, each in the order of texts.
+@timed
+def rewrite_and_score(texts):
+    texts = list(texts)
+    rewrites = rewrite_many(texts)
+    scores = get_scores_batch(texts + rewrites)
+    return rewrites, scores[:len(texts)], scores[len(texts):]
@@ -0,0 +1,196 @@
+# Opt-in profiling of single requests with cProfile.
+# A request sent by an admin with the X-Profile header runs under the profiler, and so does the processing job
+# it queues, if any, as a capture of its own. Each capture is stored in PROFILE_DIR as a .prof file readable
+# with pstats or snakeviz, next to a .json file with its endpoint, user, time and duration, and admins list
+# and download them through routes/profiles.py. The capture's id is sent back in the X-Profile-Capture header,
+# or "busy" when another capture was running: only one runs at a time per process, the profiler slows down
+# everything it watches. The oldest captures are removed past PROFILE_MAX_FILES.
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+
+from flask import current_app, g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from api_project import db
+from api_project.models import User
+
+PROFILE_HEADER = 'X-Profile'
+CAPTURE_HEADER = 'X-Profile-Capture'
+
+# Seconds a job queued by a profiled request waits for that request's capture to end before it starts its own.
+JOB_CAPTURE_WAIT = 10
+
+CAPTURE_ID = re.compile(r'^\d{8}T\d{12}-[0-9a-f]{8}$')
+
+
+def is_admin(user_id):
+    user = db.session.get(User, user_id) if user_id is not None else None
+    return user is not None and user.is_admin
+
+
+# Per-app state: where captures are stored and the lock letting one capture run at a time.
+class _ProfilingState:
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+        self.lock = threading.Lock()
+
+
+# A capture being recorded, the profiler with the details stored next to its stats.
+class _Capture:
+    def __init__(self, endpoint, user_id, details):
+        now = datetime.utcnow()
+        self.id = f'{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}'
+        self.metadata = {'id': self.id, 'endpoint': endpoint, 'user_id': user_id, 'created_on': now.isoformat(),
+                         'pid': os.getpid(), **details}
+        self.profiler = cProfile.Profile()
+        self.start = time.perf_counter()
+
+
+class Profiler:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_DIR', None)
+        app.config.setdefault('PROFILE_MAX_FILES', 100)
+        directory = app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles')
+        app.extensions['profiling'] = _ProfilingState(directory, app.config['PROFILE_MAX_FILES'])
+        app.before_request(self._start_request)
+        app.after_request(self._record_response)
+        # Torn down once a streamed response has been sent, so streams are profiled to their end
+        app.teardown_request(self._finish_request)
+
+    def _state(self):
+        return current_app.extensions['profiling']
+
+    # The user id of the capture running for the current request, for the job it queues, or None.
+    def requested_by(self):
+        capture = g.get('_profile')
+        return capture.metadata['user_id'] if isinstance(capture, _Capture) else None
+
+    # Profile the block as a capture of its own, waiting up to wait seconds for a capture running in another
+    # thread. The block runs unprofiled when that one does not end in time. Yields the capture or None.
+    @contextmanager
+    def capture(self, endpoint, user_id, wait=JOB_CAPTURE_WAIT, **details):
+        state = self._state()
+        if not state.lock.acquire(timeout=wait):
+            yield None
+            return
+        running = self._begin(endpoint, user_id, details)
+        try:
+            yield running
+        finally:
+            self._end(state, running)
+
+    # Stored captures, newest first.
+    def list_captures(self):
+        captures = []
+        for path in sorted(glob.glob(os.path.join(self._state().directory, '*.json')), reverse=True):
+            try:
+                with open(path) as metadata:
+                    captures.append(json.load(metadata))
+            except FileNotFoundError:
+                continue
+        return captures
+
+    # Path of the stats of a stored capture, or None when there is no such capture.
+    def capture_path(self, capture_id):
+        if not CAPTURE_ID.match(capture_id):
+            return None
+        path = os.path.join(self._state().directory, f'{capture_id}.prof')
+        return path if os.path.exists(path) else None
+
+    # The functions of a capture by cumulative time, as printed by pstats.
+    def summary(self, path, limit=50):
+        output = io.StringIO()
+        pstats.Stats(path, stream=output).sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    def _start_request(self):
+        if PROFILE_HEADER not in request.headers:
+            return
+        # Only admins may profile, requests with a missing or invalid token are left for the route to answer
+        try:
+            verify_jwt_in_request(optional=True)
+            user_id = get_jwt_identity()
+        except Exception:
+            return
+        if not is_admin(user_id):
+            return
+
+        state = self._state()
+        if not state.lock.acquire(blocking=False):
+            g._profile = 'busy'
+            return
+        g._profile = self._begin(request.endpoint or 'unmatched', user_id,
+                                 {'method': request.method, 'path': request.path})
+
+    def _record_response(self, response):
+        capture = g.get('_profile')
+        if isinstance(capture, _Capture):
+            capture.metadata['status'] = response.status_code
+            response.headers[CAPTURE_HEADER] = capture.id
+        elif capture == 'busy':
+            response.headers[CAPTURE_HEADER] = 'busy'
+        return response
+
+    def _finish_request(self, exception):
+        capture = g.pop('_profile', None)
+        if isinstance(capture, _Capture):
+            self._end(self._state(), capture)
+
+    # Start profiling, holding the state's lock.
+    def _begin(self, endpoint, user_id, details):
+        capture = _Capture(endpoint, user_id, details)
+        try:
+            capture.profiler.enable()
+        except Exception:
+            self._state().lock.release()
+            raise
+        return capture
+
+    # Stop profiling, store the capture and release the state's lock.
+    def _end(self, state, capture):
+        try:
+            capture.profiler.disable()
+            capture.metadata['duration_ms'] = round((time.perf_counter() - capture.start) * 1000, 3)
+            self._save(state, capture)
+        except OSError:
+            current_app.logger.exception('Could not store profile %s', capture.id)
+        finally:
+            state.lock.release()
+
+    # Write the stats, then the metadata that lists them, each moved into place once complete.
+    def _save(self, state, capture):
+        os.makedirs(state.directory, exist_ok=True)
+        path = os.path.join(state.directory, capture.id)
+        capture.profiler.dump_stats(f'{path}.prof.tmp')
+        os.replace(f'{path}.prof.tmp', f'{path}.prof')
+        with open(f'{path}.json.tmp', 'w') as metadata:
+            json.dump(capture.metadata, metadata)
+        os.replace(f'{path}.json.tmp', f'{path}.json')
+        self._evict(state)
+
+    # Keep at most PROFILE_MAX_FILES captures, ids sort by time so the oldest go first.
+    def _evict(self, state):
+        paths = sorted(glob.glob(os.path.join(state.directory, '*.json')))
+        for path in paths[:max(0, len(paths) - state.max_files)]:
+            for stale in (path, path[:-len('.json')] + '.prof'):
+                try:
+                    os.unlink(stale)
+                except FileNotFoundError:
+                    pass
+
+
+profiler = Profiler()
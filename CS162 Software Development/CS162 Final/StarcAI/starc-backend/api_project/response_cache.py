@@ -0,0 +1,92 @@
+# Conditional and cached responses for the read endpoints of a document.
+# Every change to a document bumps its version, so its version tag names one state of its content. Responses
+# carry it in their ETag: a client sending it back in If-None-Match gets a 304 after a single lookup of the
+# document row, and other requests get the body from an in-process LRU keyed by endpoint, document and version,
+# which is only built from the chunks and sentences on a miss. Bodies of older versions are never asked for
+# again and age out of the LRU.
+from collections import OrderedDict
+import threading
+
+from flask import current_app, request
+
+
+# Per-app state: the LRU of response bodies by key, their total size and the hit/miss counters.
+class _ResponseCacheState:
+    def __init__(self, max_bytes):
+        self.bodies = OrderedDict()
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.counters = {'not_modified': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        self.lock = threading.Lock()
+
+
+class ResponseCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.extensions['response_cache'] = _ResponseCacheState(app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+    def _state(self):
+        return current_app.extensions['response_cache']
+
+    # Answer a read of a document the request's endpoint serves, loaded without its chunks. build() returns the
+    # response and status like a route, and is only called when neither the client nor the cache has the body
+    # of this version. Only 200 responses are cached.
+    def respond(self, document, build):
+        state = self._state()
+        etag = f'{document.id}-{document.version_tag}'
+        if request.if_none_match.contains_weak(etag):
+            with state.lock:
+                state.counters['not_modified'] += 1
+            return self._response(etag, status=304)
+
+        key = (request.endpoint, etag)
+        with state.lock:
+            body = state.bodies.get(key)
+            if body is not None:
+                state.bodies.move_to_end(key)
+                state.counters['hits'] += 1
+            else:
+                state.counters['misses'] += 1
+
+        if body is None:
+            response, status = build()
+            if status != 200:
+                return response, status
+            body = response.get_data()
+            self._remember(state, key, body)
+        return self._response(etag, body, mimetype='application/json')
+
+    def stats(self):
+        state = self._state()
+        with state.lock:
+            return {**state.counters, 'entries': len(state.bodies), 'bytes': state.size}
+
+    # Browsers keep the body but check back on every use, other users' caches must not keep it at all.
+    def _response(self, etag, *args, **kwargs):
+        response = current_app.response_class(*args, **kwargs)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    # Add a body, evicting the least recently used ones past the size limit. Bodies larger than the whole
+    # cache are not kept.
+    def _remember(self, state, key, body):
+        if len(body) > state.max_bytes:
+            return
+        with state.lock:
+            previous = state.bodies.pop(key, None)
+            if previous is not None:
+                state.size -= len(previous)
+            state.bodies[key] = body
+            state.size += len(body)
+            while state.size > state.max_bytes:
+                _, evicted = state.bodies.popitem(last=False)
+                state.size -= len(evicted)
+                state.counters['evictions'] += 1
+
+
+response_cache = ResponseCache()
@@ -1,6 +1,8 @@
 # Import neccesary libraries.
 from flask import Blueprint, request, jsonify
-from api_project.models import User, RevokedTokenModel
+from api_project.models import User
+from api_project.blocklist import token_blocklist
+from api_project.passwords import HashQueueFull
 from api_project import db
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt
 from werkzeug.security import generate_password_hash
@@ -29,7 +31,10 @@ def register():
         return jsonify({"message": "Email already registered"}), 400
 
     new_user = User(username=username, email=email)
-    new_user.set_password(password)
+    try:
+        new_user.set_password(password)
+    except HashQueueFull:
+        return jsonify({"message": "Too many requests, try again later"}), 503
 
     db.session.add(new_user)
     db.session.commit()
@@ -45,7 +50,19 @@ def login():
 
     user = User.query.filter((User.username == login_identifier) | (User.email == login_identifier)).first()
 
-    if user and user.check_password(password):
+    try:
+        authenticated = user is not None and user.check_password(password)
+    except HashQueueFull:
+        return jsonify({"message": "Too many requests, try again later"}), 503
+
+    if authenticated:
+        # Passwords set with older hashing parameters are upgraded while the plain password is at hand,
+        # or on a later login when the hashing pool is busy
+        try:
+            if user.rehash_password_if_needed(password):
+                db.session.commit()
+        except HashQueueFull:
+            pass
         access_token = create_access_token(identity=user.id)
         return jsonify(access_token=access_token), 200
 
@@ -57,8 +74,7 @@ def login():
 def logout():
     jti = get_jwt()['jti']
     try:
-        revoked_token = RevokedTokenModel(jti=jti)
-        revoked_token.add()
+        token_blocklist.revoke(jti)
         return jsonify({"message": "Access token has been revoked"}), 200
     except Exception as e:
         return jsonify({"message": "Something went wrong"}), 500
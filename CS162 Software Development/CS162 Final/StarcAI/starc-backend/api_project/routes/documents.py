@@ -1,78 +1,55 @@
 # Import necesary libraries.
-from flask import Blueprint, request, jsonify, send_file
-from api_project.models import Document, TextChunks, Sentence, InitialScore, FinalScore
-from api_project import db
+from flask import Blueprint, request, jsonify, send_file, current_app
+from api_project.models import Document, ProcessingJob
+from api_project import db, user_stats
+from api_project.jobs import jobs, QueueFull
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from werkzeug.utils import secure_filename
-from pypdf import PdfReader
-from api_project.processing import get_scores, get_rewrite
-from nltk.tokenize import PunktSentenceTokenizer
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import LETTER
-import io
-
-# Set up Punkt to convert text to separate sentences.
-tokenizer = PunktSentenceTokenizer()
+from api_project.pdf_extract import spool_upload, count_pages, discard_upload, PdfTooLarge
+from api_project.pipeline import process_document_text, process_pdf_upload, reprocess_document_text, delete_chunks, bump_version
+from api_project.pdf_export import LAYOUTS, render_document_pdf, find_cached_pdf, get_cached_pdf, discard_cached_pdfs
+from api_project.response_cache import response_cache
+from api_project.tracing import span
 
 documents_bp = Blueprint("docs", __name__)
 
 
 # Generic function to process a document through writing the text of by uploading a pdf.
 def process_document(user_id, title, text):
-    # Create and save the new document
+    new_document = create_document_record(user_id, title, text)
+    return process_document_text(new_document.id, text)
+
+
+# Create and save the new document so it can be returned to the client before processing.
+def create_document_record(user_id, title, text):
     new_document = Document(title=title, user_id=user_id, word_count=len(text.split()))
     db.session.add(new_document)
-    db.session.commit()
-
-    # Process the text chunk
-    new_text_chunk = TextChunks(document_id=new_document.id, input_text_chunk=text)
-    original_scores_data = get_scores(text)
-    rewritten_text = get_rewrite(text)
-    rewritten_scores_data = get_scores(rewritten_text)
+    with span("commit"):
+        db.session.commit()
+    return new_document
 
-    new_text_chunk.rewritten_text = rewritten_text
-    db.session.add(new_text_chunk)
-    db.session.commit()
 
-    # Store the original and rewritten scores
-    initial_score = InitialScore(
-        text_chunk_id=new_text_chunk.id,
-        score=original_scores_data[0],
-        optimism=original_scores_data[1],
-        forecast=original_scores_data[2],
-        confidence=original_scores_data[3],
-    )
+# Queue the processing of a stored document, returning the 202 response for the client.
+def submit_document(new_document, message, func, *args):
+    try:
+        job = jobs.submit(new_document, func, *args)
+    except QueueFull:
+        db.session.delete(new_document)
+        db.session.commit()
+        return jsonify({"message": "Processing queue is full, try again later"}), 503
 
-    final_score = FinalScore(
-        text_chunk_id=new_text_chunk.id,
-        score=rewritten_scores_data[0],
-        optimism=rewritten_scores_data[1],
-        forecast=rewritten_scores_data[2],
-        confidence=rewritten_scores_data[3],
+    return (
+        jsonify(
+            {
+                "message": message,
+                "document_id": new_document.id,
+                "job_id": job.id,
+                "status_url": f"/docs/jobs/{job.id}",
+            }
+        ),
+        202,
     )
 
-    db.session.add(initial_score)
-    db.session.add(final_score)
-    db.session.commit()
-
-    # Tokenize and store sentences
-    original_sentences = tokenizer.tokenize(text)
-    rewritten_sentences = tokenizer.tokenize(rewritten_text)
-
-    for orig, rewr in zip(original_sentences, rewritten_sentences):
-        sentence = Sentence(
-            text_chunk_id=new_text_chunk.id, original_text=orig, rewritten_text=rewr
-        )
-        db.session.add(sentence)
-
-    db.session.commit()
-
-    return {
-        "message": "Document and text chunk processed successfully",
-        "document_id": new_document.id,
-        "text_chunk_id": new_text_chunk.id,
-    }
-
 
 # Post doc by writing text.
 @documents_bp.route("", methods=["POST"])
@@ -86,8 +63,10 @@ def create_document():
     if not title or not text:
         return jsonify({"message": "Title and text are required"}), 400
 
-    result = process_document(user_id, title, text)
-    return jsonify(result), 200
+    new_document = create_document_record(user_id, title, text)
+    return submit_document(
+        new_document, "Document accepted for processing", process_document_text, new_document.id, text
+    )
 
 
 # Post doc by PDF.
@@ -107,35 +86,81 @@ def upload_pdf():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
 
+        # Spool the upload to a temp file and check it against the size and page limits
         try:
-            # Read the PDF content
-            pdf_reader = PdfReader(file)
-            text_content = ""
-            for page in pdf_reader.pages:
-                text_content += page.extract_text() + "\n"
-
-            # Get the user ID
-            user_id = get_jwt_identity()
-
-            # Use the process_document function to handle document processing
-            result = process_document(user_id, filename, text_content)
+            path = spool_upload(file.stream, current_app.config["PDF_MAX_BYTES"])
+        except PdfTooLarge as e:
+            return jsonify({"message": "PDF file is too large", "error": str(e)}), 413
 
-            return (
-                jsonify({"message": "PDF uploaded and document processed", **result}),
-                201,
-            )
+        try:
+            count_pages(path, current_app.config["PDF_MAX_PAGES"])
+        except PdfTooLarge as e:
+            discard_upload(path)
+            return jsonify({"message": "PDF file is too large", "error": str(e)}), 413
         except Exception as e:
+            discard_upload(path)
             # Return a JSON response with the error message and a 400 status code
             response = jsonify(message="Could not read PDF file", error=str(e))
             response.status_code = 400
             return response
 
+        # Get the user ID
+        user_id = get_jwt_identity()
+
+        # Store the document and queue the text extraction and processing, which report page progress on the job
+        new_document = create_document_record(user_id, filename, "")
+        response = submit_document(
+            new_document, "PDF uploaded and queued for processing", process_pdf_upload, new_document.id, path
+        )
+        if response[1] != 202:
+            discard_upload(path)
+        return response
+
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {"pdf"}
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# Poll the status of a processing job started by POST /docs or POST /docs/pdf.
+@documents_bp.route("/jobs/<job_id>", methods=["GET"])
+@jwt_required()
+def get_job_status(job_id):
+    user_id = get_jwt_identity()
+
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=user_id).first()
+    if not job:
+        return jsonify({"message": "Job not found or access denied"}), 404
+
+    # A job whose process stopped would stay queued or running forever
+    if job.status in ("queued", "running") and jobs.fail_orphaned(job.id):
+        db.session.refresh(job)
+
+    return (
+        jsonify(
+            {
+                "job_id": job.id,
+                "document_id": job.document_id,
+                "status": job.status,
+                "error": job.error,
+                "pages_done": job.pages_done,
+                "pages_total": job.pages_total,
+                "created_on": job.created_on.isoformat(),
+                "finished_on": job.finished_on.isoformat() if job.finished_on else None,
+            }
+        ),
+        200,
+    )
+
+
+# Get the totals of the user's documents for the dashboard, read from their maintained statistics.
+@documents_bp.route("/stats", methods=["GET"])
+@jwt_required()
+def get_user_stats():
+    user_id = get_jwt_identity()
+    return jsonify(user_stats.get(user_id)), 200
+
+
 # Delete doc.
 @documents_bp.route("/<int:doc_id>", methods=["DELETE"])
 @jwt_required()
@@ -143,13 +168,16 @@ def delete_document(doc_id):
     user_id = get_jwt_identity()
 
     # Retrieve the document to be deleted
-    document = Document.query.filter_by(id=doc_id, user_id=user_id).first()
+    document = Document.get_owned(doc_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Delete the document, since cascading is opted in the database, all associated content will also be deleted.
+    # Delete the chunks with their sentences and scores in a few statements, instead of letting the cascade
+    # load and delete them one row at a time, then the document and its jobs.
+    delete_chunks(doc_id)
     db.session.delete(document)
     db.session.commit()
+    discard_cached_pdfs(doc_id)
 
     return jsonify({"message": "Document and related data deleted successfully"}), 200
 
@@ -161,8 +189,8 @@ def update_document(doc_id):
     user_id = get_jwt_identity()
     data = request.get_json()
 
-    # Retrieve the document to be updated
-    document = Document.query.filter_by(id=doc_id, user_id=user_id).first()
+    # Retrieve the document to be updated, with the sentences that edits are compared against
+    document = Document.get_owned(doc_id, user_id, sentences=True)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
@@ -170,8 +198,11 @@ def update_document(doc_id):
     new_text = data.get("text")
 
     # Update the title if provided
-    if title != document.title:
+    if title and title != document.title:
         document.title = title
+        bump_version(doc_id)
+        with span("commit"):
+            db.session.commit()
         return (
             jsonify(
                 {"message": "Title updated successfully", "document_id": document.id}
@@ -179,60 +210,19 @@ def update_document(doc_id):
             200,
         )
 
-    # If new text is provided, handle the text chunk and related data
+    # If new text is provided, replace the text chunks, only rewriting the sentences that changed
+    rewritten_sentences = 0
     if new_text:
-        # Delete existing text chunk and related data
-        existing_text_chunk = TextChunks.query.filter_by(
-            document_id=document.id
-        ).first()
-        if existing_text_chunk:
-            db.session.delete(existing_text_chunk)
-            db.session.commit()
-
-        # Create a new text chunk
-        new_text_chunk = TextChunks(document_id=document.id, input_text_chunk=new_text)
-        rewritten_text = get_rewrite(new_text)
-        new_text_chunk.rewritten_text = rewritten_text
-        db.session.add(new_text_chunk)
-        db.session.commit()
-
-        # Calculate and save scores
-        original_scores_data = get_scores(new_text)
-        rewritten_scores_data = get_scores(rewritten_text)
-
-        initial_score = InitialScore(
-            text_chunk_id=new_text_chunk.id,
-            score=original_scores_data[0],
-            optimism=original_scores_data[1],
-            forecast=original_scores_data[2],
-            confidence=original_scores_data[3],
-        )
-        db.session.add(initial_score)
-
-        final_score = FinalScore(
-            text_chunk_id=new_text_chunk.id,
-            score=rewritten_scores_data[0],
-            optimism=rewritten_scores_data[1],
-            forecast=rewritten_scores_data[2],
-            confidence=rewritten_scores_data[3],
-        )
-        db.session.add(final_score)
-        document.word_count = len(new_text_chunk.input_text_chunk.split())
-        db.session.commit()
-
-        # Tokenize and store new sentences
-        original_sentences = tokenizer.tokenize(new_text)
-        rewritten_sentences = tokenizer.tokenize(rewritten_text)
-
-        for orig, rewr in zip(original_sentences, rewritten_sentences):
-            new_sentence = Sentence(
-                text_chunk_id=new_text_chunk.id, original_text=orig, rewritten_text=rewr
-            )
-            db.session.add(new_sentence)
-        db.session.commit()
+        rewritten_sentences = reprocess_document_text(document, new_text)
 
     return (
-        jsonify({"message": "Text updated successfully", "document_id": document.id}),
+        jsonify(
+            {
+                "message": "Text updated successfully",
+                "document_id": doc_id,
+                "rewritten_sentences": rewritten_sentences,
+            }
+        ),
         200,
     )
 
@@ -243,35 +233,39 @@ def update_document(doc_id):
 def get_original_scores(doc_id):
     user_id = get_jwt_identity()
 
-    # Retrieve the document to ensure it belongs to the user
-    document = Document.query.filter_by(id=doc_id, user_id=user_id).first()
+    # Retrieve the document to ensure it belongs to the user, its chunks and their scores are only loaded
+    # when the response is not cached
+    document = Document.get_owned(doc_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Fetch the text chunk related to the document
-    text_chunk = TextChunks.query.filter_by(document_id=doc_id).first()
-    if not text_chunk:
-        return jsonify({"message": "Text chunk not found for the given document"}), 404
+    def build():
+        # Fetch the text chunks related to the document
+        text_chunks = Document.get_owned(doc_id, user_id, scores=True).text_chunks
+        if not text_chunks:
+            return jsonify({"message": "Text chunk not found for the given document"}), 404
 
-    # Fetch and return the original scores
-    initial_scores = InitialScore.query.filter_by(text_chunk_id=text_chunk.id).all()
-    if not initial_scores:
-        return (
-            jsonify({"message": "No initial scores found for the given document"}),
-            404,
-        )
+        # Return the original scores of every chunk, in document order
+        initial_scores = [c.initial_score for c in text_chunks if c.initial_score]
+        if not initial_scores:
+            return (
+                jsonify({"message": "No initial scores found for the given document"}),
+                404,
+            )
 
-    scores_list = [
-        {
-            "score": score.score,
-            "optimism": score.optimism,
-            "forecast": score.forecast,
-            "confidence": score.confidence,
-        }
-        for score in initial_scores
-    ]
+        scores_list = [
+            {
+                "score": score.score,
+                "optimism": score.optimism,
+                "forecast": score.forecast,
+                "confidence": score.confidence,
+            }
+            for score in initial_scores
+        ]
 
-    return jsonify(scores_list), 200
+        return jsonify(scores_list), 200
+
+    return response_cache.respond(document, build)
 
 
 # Get document text and wordcount to display on home page.
@@ -280,35 +274,35 @@ def get_original_scores(doc_id):
 def get_document_details(doc_id):
     user_id = get_jwt_identity()
 
-    # Retrieve the document to ensure it belongs to the user
-    document = Document.query.filter_by(id=doc_id, user_id=user_id).first()
+    # Retrieve the document to ensure it belongs to the user, its chunks and their sentences are only loaded
+    # when the response is not cached
+    document = Document.get_owned(doc_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Fetch the text chunk related to the document
-    text_chunk = TextChunks.query.filter_by(document_id=doc_id).first()
-    if not text_chunk:
-        return jsonify({"message": "Text chunk not found for the given document"}), 404
-
-    # Fetch and order the sentences related to the text chunk
-    sentences = (
-        Sentence.query.filter_by(text_chunk_id=text_chunk.id)
-        .order_by(Sentence.id)
-        .all()
-    )
-    if not sentences:
-        return jsonify({"message": "No sentences found for the given document"}), 404
+    def build():
+        # Fetch the text chunks related to the document
+        text_chunks = Document.get_owned(doc_id, user_id, sentences=True).text_chunks
+        if not text_chunks:
+            return jsonify({"message": "Text chunk not found for the given document"}), 404
+
+        # The sentences of all the text chunks, in order
+        sentences = [sentence for c in text_chunks for sentence in c.sentences]
+        if not sentences:
+            return jsonify({"message": "No sentences found for the given document"}), 404
+
+        # Prepare the response data
+        document_details = {
+            "title": document.title,
+            "word_count": document.word_count,
+            "sentences_combined": ". ".join(
+                [sentence.original_text for sentence in sentences]
+            ).replace("\n", " "),
+        }
 
-    # Prepare the response data
-    document_details = {
-        "title": document.title,
-        "word_count": document.word_count,
-        "sentences_combined": ". ".join(
-            [sentence.original_text for sentence in sentences]
-        ).replace("\n", " "),
-    }
+        return jsonify(document_details), 200
 
-    return jsonify(document_details), 200
+    return response_cache.respond(document, build)
 
 
 # Download doc as a pdf file.
@@ -317,30 +311,45 @@ def get_document_details(doc_id):
 def get_document_as_pdf(doc_id):
     user_id = get_jwt_identity()
 
-    # Retrieve the document and its text
-    document = Document.query.filter_by(id=doc_id, user_id=user_id).first()
+    # Pick the layout, the original text alone or with the rewritten text next to it
+    layout = request.args.get("layout", "original")
+    if layout not in LAYOUTS:
+        return jsonify({"message": f"Layout must be one of {', '.join(LAYOUTS)}"}), 400
+
+    # Retrieve the document, its text is only loaded when this version is not in the export cache yet
+    document = Document.get_owned(doc_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    text_chunk = TextChunks.query.filter_by(document_id=doc_id).first()
-    if not text_chunk:
-        return jsonify({"message": "Text chunk not found for the given document"}), 404
-
-    # Create a PDF from the text
-    pdf_buffer = io.BytesIO()
-    p = canvas.Canvas(pdf_buffer, pagesize=LETTER)
-    text = text_chunk.input_text_chunk
-
-    # Can customize the PDF generation here
-    p.drawString(72, 720, text)
-
-    p.showPage()
-    p.save()
+    version = document.version_tag
+    cached = find_cached_pdf(doc_id, version, layout)
+    if cached is None:
+        # Load the text, with the rewritten sentences when they are exported too
+        text_chunks = Document.get_owned(
+            doc_id, user_id, chunks=True, sentences=layout == "side_by_side"
+        ).text_chunks
+        if not text_chunks:
+            return jsonify({"message": "Text chunk not found for the given document"}), 404
+
+        chunks = [
+            (
+                text_chunk.input_text_chunk,
+                " ".join(sentence.rewritten_text for sentence in text_chunk.sentences)
+                if layout == "side_by_side"
+                else None,
+            )
+            for text_chunk in text_chunks
+        ]
+        cached = get_cached_pdf(
+            doc_id,
+            version,
+            layout,
+            lambda output: render_document_pdf(output, document.title, chunks, layout),
+        )
 
-    # Return the PDF as a response
-    pdf_buffer.seek(0)
+    # Stream the PDF from the cache, send_file closes it once sent
     return send_file(
-        pdf_buffer,
+        cached,
         as_attachment=True,
         download_name=f"{document.title}.pdf",
         mimetype="application/pdf",
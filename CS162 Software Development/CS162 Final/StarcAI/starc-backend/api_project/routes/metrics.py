@@ -0,0 +1,34 @@
+# Import necesary libraries.
+import hmac
+from flask import Blueprint, Response, current_app, jsonify, request
+from api_project.cache import content_cache
+from api_project.metrics import metrics
+
+# Define the Blueprint for 'metrics'
+metrics_bp = Blueprint('metrics', __name__)
+
+
+# Whether the request may read the metrics: it sent METRICS_TOKEN. Nobody may while none is set.
+def has_metrics_token():
+    token = current_app.config['METRICS_TOKEN']
+    sent = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode())
+
+
+# Serve the performance metrics of this process to Prometheus. Scrapers can't log in, so they send
+# METRICS_TOKEN as a bearer token. The route is closed until one is set.
+@metrics_bp.route('', methods=['GET'])
+def get_metrics():
+    if not has_metrics_token():
+        return jsonify({"message": "Invalid metrics token"}), 401
+
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Hit and miss counters of the rewrite and score cache, also exported by /metrics, behind the same token.
+@metrics_bp.route('/cache', methods=['GET'])
+def get_cache_stats():
+    if not has_metrics_token():
+        return jsonify({"message": "Invalid metrics token"}), 401
+
+    return jsonify(content_cache.stats()), 200
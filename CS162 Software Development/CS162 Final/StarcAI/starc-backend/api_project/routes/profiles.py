@@ -0,0 +1,41 @@
+# Import necesary libraries.
+import functools
+from flask import Blueprint, Response, jsonify, request, send_file
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from api_project.profiling import profiler, is_admin
+
+# Define the Blueprint for 'profiles'
+profiles_bp = Blueprint('profiles', __name__)
+
+
+# Let only admins through, after checking their token.
+def admin_required(view):
+    @functools.wraps(view)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        if not is_admin(get_jwt_identity()):
+            return jsonify({"message": "Admin access required"}), 403
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+# List the stored profiles of requests and jobs, newest first.
+@profiles_bp.route('', methods=['GET'])
+@admin_required
+def list_profiles():
+    return jsonify(profiler.list_captures()), 200
+
+
+# Download a profile as a .prof file for pstats or snakeviz, or with ?format=text its functions by cumulative time.
+@profiles_bp.route('/<capture_id>', methods=['GET'])
+@admin_required
+def get_profile(capture_id):
+    path = profiler.capture_path(capture_id)
+    if path is None:
+        return jsonify({"message": "Profile not found"}), 404
+
+    if request.args.get('format') == 'text':
+        return Response(profiler.summary(path), content_type='text/plain; charset=utf-8')
+    return send_file(path, as_attachment=True, download_name=f'{capture_id}.prof',
+                     mimetype='application/octet-stream')
@@ -1,43 +1,143 @@
 # Import necesary libraries.
-from flask import Blueprint, jsonify
-from api_project.models import Document, TextChunks, Sentence
+import json
+import time
+from flask import Blueprint, Response, current_app, jsonify, stream_with_context
+from api_project.events import document_events
+from api_project.jobs import jobs
+from sqlalchemy import exists, select
+from api_project.models import Document, TextChunks, Sentence, ProcessingJob
+from api_project.pipeline import accept_suggestions, reset_suggestions
+from api_project.response_cache import response_cache
 from api_project import db
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
 # Define the Blueprint for 'rewrite'
 rewrite_bp = Blueprint('fix', __name__)
 
+# How often a stream checks on a job that is running in another process.
+STREAM_POLL_SECONDS = 1
+
+# Whether a document has any text chunks, checked without loading them.
+def has_text_chunks(document_id):
+    return db.session.scalar(select(exists().where(TextChunks.document_id == document_id)))
+
+# Whether a sentence is in one of the text chunks of a document.
+def has_sentence(document_id, sentence_id):
+    return db.session.scalar(select(exists().where(Sentence.id == sentence_id,
+                                                   Sentence.text_chunk_id == TextChunks.id,
+                                                   TextChunks.document_id == document_id)))
+
+# Format one Server-Sent Event, None gives a comment line that keeps idle connections open.
+def format_event(event, data=None):
+    if event is None:
+        return ": keep-alive\n\n"
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Events for a document whose processing has already been stored: its chunks, their scores, the ids of their
+# sentences as a job sends them once stored, and 'completed'.
+def stored_events(document):
+    for index, text_chunk in enumerate(document.text_chunks):
+        yield "rewrite", {
+            "chunk_index": index,
+            "sentences": [{
+                "sentence_id": sentence.id,
+                "original_sentence": sentence.original_text,
+                "rewritten_sentence": sentence.rewritten_text
+            } for sentence in text_chunk.sentences]
+        }
+        scores = {}
+        for key, score in (("initial_score", text_chunk.initial_score), ("final_score", text_chunk.final_score)):
+            if score:
+                scores[key] = {"score": score.score, "optimism": score.optimism,
+                               "forecast": score.forecast, "confidence": score.confidence}
+        yield "scores", {"chunk_index": index, **scores}
+        yield "stored", {"chunk_index": index, "sentence_ids": [sentence.id for sentence in text_chunk.sentences]}
+    yield "completed", {"document_id": document.id}
+
+# Stream the rewrites and scores of a document as its processing job produces them.
+@rewrite_bp.route('/<int:document_id>/stream', methods=['GET'])
+@jwt_required()
+def stream_rewrites(document_id):
+    user_id = get_jwt_identity()
+
+    # Retrieve the document to ensure it belongs to the user
+    document = Document.get_owned(document_id, user_id)
+    if not document:
+        return jsonify({"message": "Document not found or access denied"}), 404
+
+    heartbeat = current_app.config["STREAM_HEARTBEAT_SECONDS"]
+    channel = document_events.subscribe(document_id)
+
+    def generate():
+        # A job in this process publishes every result as it is produced, events missed so far are replayed first
+        if channel is not None:
+            for event in channel.listen(heartbeat):
+                yield format_event(*event) if event else format_event(None)
+            return
+
+        # Otherwise wait for a job running elsewhere to finish, then send what it stored
+        waited = 0
+        while True:
+            job = ProcessingJob.query.filter_by(document_id=document_id)\
+                                     .order_by(ProcessingJob.created_on.desc()).first()
+            if job is None or job.status not in ("queued", "running"):
+                break
+            time.sleep(STREAM_POLL_SECONDS)
+            waited += STREAM_POLL_SECONDS
+            if waited >= heartbeat:
+                waited = 0
+                yield format_event(None)
+                # A job whose process stopped would be waited for forever
+                jobs.fail_orphaned(job.id)
+            # End the read transaction so the next poll sees the job's latest status
+            db.session.rollback()
+
+        if job is not None and job.status == "failed":
+            yield format_event("failed", {"document_id": document_id, "job_id": job.id, "error": job.error})
+            return
+        db.session.expire(document)
+        stored = Document.get_owned(document_id, user_id, sentences=True, scores=True)
+        for event, data in stored_events(stored):
+            yield format_event(event, data)
+
+    # Disable proxy buffering so every event reaches the client as soon as it is written
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @rewrite_bp.route('/<int:document_id>', methods=['GET'])
 @jwt_required()
 def get_rewritten_sentences(document_id):
     user_id = get_jwt_identity()
 
-    # Retrieve the document to ensure it belongs to the user
-    document = Document.query.filter_by(id=document_id, user_id=user_id).first()
+    # Retrieve the document to ensure it belongs to the user, its chunks and their sentences are only loaded
+    # when the response is not cached
+    document = Document.get_owned(document_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Fetch the text chunk related to the document
-    text_chunk = TextChunks.query.filter_by(document_id=document_id).first()
-    if not text_chunk:
-        return jsonify({"message": "Text chunk not found for the given document"}), 404
+    def build():
+        # Fetch the text chunks related to the document
+        text_chunks = Document.get_owned(document_id, user_id, sentences=True).text_chunks
+        if not text_chunks:
+            return jsonify({"message": "Text chunk not found for the given document"}), 404
+
+        # Filter the sentences of every chunk where original and rewritten sentences are different
+        sentences = [sentence for c in text_chunks for sentence in c.sentences
+                     if sentence.original_text != sentence.rewritten_text]
 
-    # Fetch and filter the sentences where original and rewritten sentences are different
-    sentences = Sentence.query.filter_by(text_chunk_id=text_chunk.id)\
-                              .filter(Sentence.original_text != Sentence.rewritten_text)\
-                              .all()
+        if not sentences:
+            return jsonify({"message": "No rewritten sentences found for the given document"}), 404
 
-    if not sentences:
-        return jsonify({"message": "No rewritten sentences found for the given document"}), 404
+        # Prepare the response data
+        rewritten_sentences_data = [{
+            "sentence_id": sentence.id,
+            "original_sentence": sentence.original_text,
+            "rewritten_sentence": sentence.rewritten_text
+        } for sentence in sentences]
 
-    # Prepare the response data
-    rewritten_sentences_data = [{
-        "sentence_id": sentence.id,
-        "original_sentence": sentence.original_text,
-        "rewritten_sentence": sentence.rewritten_text
-    } for sentence in sentences]
+        return jsonify(rewritten_sentences_data), 200
 
-    return jsonify(rewritten_sentences_data), 200
+    return response_cache.respond(document, build)
 
 @rewrite_bp.route('/<int:document_id>/<int:sentence_id>', methods=['PUT'])
 @jwt_required()
@@ -45,31 +145,20 @@ def update_sentence(document_id, sentence_id):
     user_id = get_jwt_identity()
 
     # Validate the document
-    document = Document.query.filter_by(id=document_id, user_id=user_id).first()
+    document = Document.get_owned(document_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Fetch the text chunk and sentence related to the document
-    text_chunk = TextChunks.query.filter_by(document_id=document_id).first()
-    if not text_chunk:
+    # Check the text chunks and the sentence, which can be in any chunk of the document
+    if not has_text_chunks(document_id):
         return jsonify({"message": "Text chunk not found for the given document"}), 404
 
-    sentence = Sentence.query.filter_by(id=sentence_id, text_chunk_id=text_chunk.id).first()
-    if not sentence:
+    if not has_sentence(document_id, sentence_id):
         return jsonify({"message": "Sentence not found"}), 404
 
-    # Update the sentence, this will make it stop showing up as a suggetion.
-    if sentence.original_text != sentence.rewritten_text:
-        sentence.original_text = sentence.rewritten_text
-        db.session.commit()
-
-    # Update the original_text in TextChunks
-    updated_sentences = [s.original_text for s in text_chunk.sentences]
-    text_chunk.original_text_chunk = " ".join(updated_sentences)
-    db.session.commit()
-
-    # Update the word count of the document
-    document.word_count = len(text_chunk.original_text_chunk.split())
+    # Update the sentence, this will make it stop showing up as a suggetion. The input text of its chunk
+    # and the word count of the document are updated along with it.
+    accept_suggestions(document_id, sentence_id)
     db.session.commit()
 
     return jsonify({"message": "Sentence and document updated successfully"}), 200
@@ -80,21 +169,19 @@ def reset_sentence_to_original(document_id, sentence_id):
     user_id = get_jwt_identity()
 
     # Validate the document
-    document = Document.query.filter_by(id=document_id, user_id=user_id).first()
+    document = Document.get_owned(document_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Fetch the text chunk and sentence related to the document
-    text_chunk = TextChunks.query.filter_by(document_id=document_id).first()
-    if not text_chunk:
+    # Check the text chunks and the sentence, which can be in any chunk of the document
+    if not has_text_chunks(document_id):
         return jsonify({"message": "Text chunk not found for the given document"}), 404
 
-    sentence = Sentence.query.filter_by(id=sentence_id, text_chunk_id=text_chunk.id).first()
-    if not sentence:
+    if not has_sentence(document_id, sentence_id):
         return jsonify({"message": "Sentence not found"}), 404
 
     # Update the rewritten text to match the original text
-    sentence.rewritten_text = sentence.original_text
+    reset_suggestions(document_id, sentence_id)
     db.session.commit()
 
     return jsonify({"message": "Sentence reset to original text successfully"}), 200
@@ -105,27 +192,17 @@ def accept_all_suggestions(document_id):
     user_id = get_jwt_identity()
 
     # Validate the document
-    document = Document.query.filter_by(id=document_id, user_id=user_id).first()
+    document = Document.get_owned(document_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Fetch the text chunk related to the document
-    text_chunk = TextChunks.query.filter_by(document_id=document_id).first()
-    if not text_chunk:
+    # Check the document has text chunks
+    if not has_text_chunks(document_id):
         return jsonify({"message": "Text chunk not found for the given document"}), 404
 
-    # Update all sentences
-    for sentence in text_chunk.sentences:
-        sentence.original_text = sentence.rewritten_text
-    db.session.commit()
-
-    # Update the original text in TextChunks
-    updated_sentences = [s.original_text for s in text_chunk.sentences]
-    text_chunk.original_text_chunk = " ".join(updated_sentences)
-    db.session.commit()
-
-    # Update the word count of the document
-    document.word_count = len(text_chunk.original_text_chunk.split())
+    # Update all sentences of every chunk, the input text of each chunk and the word count of the document,
+    # in a few statements however many sentences there are
+    accept_suggestions(document_id)
     db.session.commit()
 
     return jsonify({"message": "All suggestions accepted successfully"}), 200
@@ -136,18 +213,16 @@ def delete_all_suggestions(document_id):
     user_id = get_jwt_identity()
 
     # Validate the document
-    document = Document.query.filter_by(id=document_id, user_id=user_id).first()
+    document = Document.get_owned(document_id, user_id)
     if not document:
         return jsonify({"message": "Document not found or access denied"}), 404
 
-    # Fetch the text chunk related to the document
-    text_chunk = TextChunks.query.filter_by(document_id=document_id).first()
-    if not text_chunk:
+    # Check the document has text chunks
+    if not has_text_chunks(document_id):
         return jsonify({"message": "Text chunk not found for the given document"}), 404
 
-    # Reset rewritten text for all sentences
-    for sentence in text_chunk.sentences:
-        sentence.rewritten_text = sentence.original_text
+    # Reset rewritten text for all sentences of every chunk in one statement
+    reset_suggestions(document_id)
     db.session.commit()
 
     return jsonify({"message": "All suggestions deleted successfully"}), 200
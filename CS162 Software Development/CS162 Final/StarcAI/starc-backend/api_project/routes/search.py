@@ -1,54 +1,101 @@
 # Import necesary libraries, register blueprints.
+import base64
+import html
+import json
 from flask import Blueprint, request, jsonify
+from sqlalchemy import func, null, select
 from api_project.models import Document
+from api_project import db, search_index
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
 search_bp = Blueprint('search_bp', __name__)
 
+# Largest page a client can ask for.
+MAX_PAGE_SIZE = 100
+
+# Opaque cursor for the next page: the sort key of the last document sent, as url-safe base64 JSON.
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+# Sort key from a cursor, raises ValueError for anything that encode_cursor did not produce.
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(key, dict) or not isinstance(key.get('id'), int) or \
+            not isinstance(key.get('rank', 0), (int, float)):
+        raise ValueError('Invalid cursor')
+    return key
+
 # Search a users docs to show on the documents page.
+# Pages are fetched with keyset pagination: each response carries a next_cursor to pass back for the next page.
 @search_bp.route('/search', methods=['GET'])
 @jwt_required()
 def search_documents():
     user_id = get_jwt_identity()  # Get the user ID from the JWT token
 
     query_text = request.args.get('q', '')
-    page = request.args.get('page', 1, type=int)
-    limit = request.args.get('limit', 12, type=int)
+    limit = max(1, min(request.args.get('limit', 12, type=int), MAX_PAGE_SIZE))
+    include_total = request.args.get('include_total', 'false').lower() in ('1', 'true', 'yes')
+    cursor = request.args.get('cursor')
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
-    # Check if there are any documents in the database for the user
-    total_docs_count = Document.query.count()
-    if total_docs_count == 0:
+    # Check if the user has any documents
+    if not db.session.query(Document.query.filter_by(user_id=user_id).exists()).scalar():
         return jsonify({"message": "No docs found"}), 204
 
-    # Filter documents by user ID and query text, and calculate total number of matching documents
-    total_count = Document.query.filter(
-        Document.user_id == user_id,
-        Document.title.like(f'%{query_text}%')
-    ).count()
+    # Rank the user's documents by how well their title and text match, using the full-text index
+    if search_index.is_available() and search_index.build_match_query(query_text):
+        if after is not None and 'rank' not in after:
+            return jsonify({"message": "Invalid cursor"}), 400
+        results, next_key, total_count = search_index.search(
+            user_id, query_text, limit, (after['rank'], after['id']) if after else None, include_total)
+        next_cursor = encode_cursor({'rank': next_key[0], 'id': next_key[1]}) if next_key else None
 
-    if total_count == 0:
-        return jsonify({"message": "No matching documents found"}), 200
+    # Without the index, or without any words to look for, filter titles by user ID and query text, in id order
+    else:
+        matches = select(
+            Document.id, Document.title, Document.word_count,
+            (func.count().over() if include_total else null()).label('total')
+        ).where(
+            Document.user_id == user_id,
+            Document.title.like(f'%{query_text}%')
+        ).subquery()
 
-    # Perform a paginated search filtered by user ID
-    matching_documents = Document.query.filter(
-        Document.user_id == user_id,
-        Document.title.like(f'%{query_text}%')
-    ).limit(limit).offset((page - 1) * limit).all()
+        # One row more than the page tells whether there is a next page
+        rows = db.session.execute(
+            select(matches).where(matches.c.id > (after['id'] if after else 0)).order_by(matches.c.id).limit(limit + 1)
+        ).all()
+        next_cursor = encode_cursor({'id': rows[limit - 1].id}) if len(rows) > limit else None
+        rows = rows[:limit]
 
-    # Construct a list of dictionaries with document id, title, and word count
-    results = [{
-        'id': doc.id,
-        'title': doc.title,
-        'word_count': doc.word_count
-    } for doc in matching_documents]
+        total_count = None
+        if include_total:
+            total_count = rows[0].total if rows else db.session.query(func.count()).select_from(matches).scalar()
+
+        # Construct a list of dictionaries with document id, title, and word count, the snippet being the
+        # title escaped as HTML like the snippets of the index
+        results = [{
+            'id': doc.id,
+            'title': doc.title,
+            'word_count': doc.word_count,
+            'snippet': html.escape(doc.title)
+        } for doc in rows]
+
+    if not results and after is None:
+        return jsonify({"message": "No matching documents found"}), 200
 
     # Include pagination information in the response
     response = {
-        "total_items": total_count,
-        "total_pages": (total_count + limit - 1) // limit,  # Calculate total pages
-        "current_page": page,
         "page_size": limit,
+        "next_cursor": next_cursor,
         "results": results
     }
+    if include_total:
+        response["total_items"] = total_count
 
     return jsonify(response), 200
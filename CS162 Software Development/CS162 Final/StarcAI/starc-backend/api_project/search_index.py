@@ -0,0 +1,209 @@
+# Full-text search over document titles and text on SQLite.
+# Titles and text chunks are indexed in two FTS5 tables that triggers keep in step with the document and
+# text_chunks tables, so every insert, edit and delete is reflected without any application code. Each row
+# carries its owner's id as an indexed token, letting FTS5 restrict a search to one user's documents.
+# On other databases search falls back to a LIKE filter on titles.
+import html
+import re
+
+from sqlalchemy import DDL, bindparam, event, text
+from api_project import db
+from api_project.models import Document, TextChunks
+
+# Snippet markers around matched terms, the ellipsis for cut text and the snippet length in tokens. FTS5
+# wraps the terms in private use characters, which are swapped for the tags once the text is HTML escaped.
+SNIPPET_OPEN = '<mark>'
+SNIPPET_CLOSE = '</mark>'
+SNIPPET_OPEN_MARKER = '\ue000'
+SNIPPET_CLOSE_MARKER = '\ue001'
+SNIPPET_ELLIPSIS = '...'
+SNIPPET_TOKENS = 12
+
+# Matching titles and chunks ranked per search, each the most recent ones. Bounds the ranking work for users
+# with many matches, their older documents are only found by more specific queries.
+MAX_CANDIDATES = 1000
+
+# Title matches count double when ranking against matches in the text.
+TITLE_WEIGHT = 2.0
+
+TITLE_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS document_title_fts USING fts5(title, owner)",
+    """CREATE TRIGGER IF NOT EXISTS document_title_fts_insert AFTER INSERT ON document BEGIN
+        INSERT INTO document_title_fts(rowid, title, owner) VALUES (new.id, new.title, new.user_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS document_title_fts_update AFTER UPDATE OF title ON document BEGIN
+        UPDATE document_title_fts SET title = new.title WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS document_title_fts_delete AFTER DELETE ON document BEGIN
+        DELETE FROM document_title_fts WHERE rowid = old.id;
+    END""",
+]
+
+TEXT_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS text_chunk_fts USING fts5(body, owner, document_id UNINDEXED)",
+    """CREATE TRIGGER IF NOT EXISTS text_chunk_fts_insert AFTER INSERT ON text_chunks BEGIN
+        INSERT INTO text_chunk_fts(rowid, body, owner, document_id)
+        VALUES (new.id, new.input_text_chunk, (SELECT user_id FROM document WHERE id = new.document_id), new.document_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS text_chunk_fts_update AFTER UPDATE OF input_text_chunk ON text_chunks BEGIN
+        UPDATE text_chunk_fts SET body = new.input_text_chunk WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS text_chunk_fts_delete AFTER DELETE ON text_chunks BEGIN
+        DELETE FROM text_chunk_fts WHERE rowid = old.id;
+    END""",
+]
+
+# Rank of every matching document: the lowest (best) bm25 rank of its title and its chunks, out of the
+# MAX_CANDIDATES most recent matches of each. FTS5 walks rowids in descending order natively, and only works
+# out bm25 for the rows the LIMIT lets through.
+# SQLite takes the bare source and match_rowid columns from the row that produced min(rank), the best match.
+RANKED_SQL = f"""
+    SELECT document_id, min(rank) AS rank, source, match_rowid FROM (
+        SELECT * FROM (
+            SELECT rowid AS document_id, bm25(document_title_fts, {TITLE_WEIGHT}, 0.0) AS rank,
+                   'title' AS source, rowid AS match_rowid
+            FROM document_title_fts WHERE document_title_fts MATCH :title_match
+            ORDER BY rowid DESC LIMIT :candidates
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT document_id, bm25(text_chunk_fts, 1.0, 0.0, 0.0) AS rank,
+                   'body' AS source, rowid AS match_rowid
+            FROM text_chunk_fts WHERE text_chunk_fts MATCH :body_match
+            ORDER BY rowid DESC LIMIT :candidates
+        )
+    ) GROUP BY document_id
+"""
+
+# One page of matching documents, best first, starting after the (rank, id) of the previous page's last row.
+# The keyset condition lets a deep page cost the same as the first. With a total, the window counts every
+# match in the same pass, before the page is cut.
+PAGE_SQL = {
+    with_total: text(f"""
+        SELECT * FROM (
+            SELECT d.id, d.title, d.word_count, m.rank, m.source, m.match_rowid,
+                   {'count(*) OVER ()' if with_total else 'NULL'} AS total
+            FROM ({RANKED_SQL}) AS m JOIN document AS d ON d.id = m.document_id
+            WHERE d.user_id = :user_id
+        ) WHERE rank > :after_rank OR (rank = :after_rank AND id > :after_id)
+        ORDER BY rank, id
+        LIMIT :limit
+    """)
+    for with_total in (False, True)
+}
+
+COUNT_SQL = text(f"SELECT count(*) FROM ({RANKED_SQL})")
+
+# Snippets of the best matches of the documents on a page, by source. FTS5 re-runs the whole match for each
+# rowid it is asked to look up, so the match is run once and snippets are only built for the wanted rows.
+SNIPPETS_SQL = {
+    source: text(f"""
+        SELECT rowid, snippet FROM (
+            SELECT rowid, CASE WHEN rowid IN :rowids
+                          THEN snippet({table}, 0, :open, :close, :ellipsis, :tokens) END AS snippet
+            FROM {table} WHERE {table} MATCH :match
+        ) WHERE snippet IS NOT NULL
+    """).bindparams(bindparam('rowids', expanding=True))
+    for source, table in (('title', 'document_title_fts'), ('body', 'text_chunk_fts'))
+}
+
+
+# Listener running statements one at a time, sqlite3 only executes a single statement per call.
+def _create_on_sqlite(statements):
+    def create(target, connection, **kw):
+        if connection.dialect.name == 'sqlite':
+            for statement in statements:
+                connection.execute(text(statement))
+    return create
+
+
+# Create the index tables and triggers along with the tables they follow, and drop them before those tables.
+for table, statements, fts_table in ((Document.__table__, TITLE_INDEX_DDL, 'document_title_fts'),
+                                     (TextChunks.__table__, TEXT_INDEX_DDL, 'text_chunk_fts')):
+    event.listen(table, 'after_create', _create_on_sqlite(statements))
+    event.listen(table, 'before_drop', DDL(f'DROP TABLE IF EXISTS {fts_table}').execute_if(dialect='sqlite'))
+
+
+def is_available():
+    return db.engine.dialect.name == 'sqlite'
+
+
+# Turn free text into an FTS5 query: every word must appear, the last one possibly still being typed.
+# Only the last word is a prefix, prefix queries merge the postings of every matching term and are much slower
+# on common words. Quoting each word keeps FTS5 operators and punctuation in the user's text from being interpreted.
+def build_match_query(query_text):
+    terms = [f'"{term}"' for term in re.findall(r'\w+', query_text)]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+# Search the titles and text of a user's documents, best matches first, limit at a time.
+# after is the (rank, id) key of the last document of the previous page, or None for the first page.
+# Returns dicts of id, title, word_count and snippet, the key to continue after when there are more
+# matches, or None, and the total number of matches when with_total is set. Only the documents of the
+# MAX_CANDIDATES most recent matching titles and chunks are ranked, paged through and counted.
+def search(user_id, query_text, limit, after=None, with_total=False):
+    terms = build_match_query(query_text)
+    owner = f'owner : "{int(user_id)}"'
+    match = {'title_match': f'{owner} AND title : ({terms})', 'body_match': f'{owner} AND body : ({terms})',
+             'candidates': MAX_CANDIDATES}
+    after_rank, after_id = after or (float('-inf'), 0)
+
+    # One row more than the page tells whether there is a next page
+    rows = db.session.execute(PAGE_SQL[with_total], {
+        **match, 'user_id': user_id, 'after_rank': after_rank, 'after_id': after_id, 'limit': limit + 1,
+    }).all()
+    next_key = (rows[limit - 1].rank, rows[limit - 1].id) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    total = None
+    if with_total:
+        # Past the last page the window has no row to report the count on, count on its own
+        total = rows[0].total if rows else db.session.execute(COUNT_SQL, match).scalar()
+    if not rows:
+        return [], None, total
+
+    snippets = {}
+    for source, statement in SNIPPETS_SQL.items():
+        rowids = [row.match_rowid for row in rows if row.source == source]
+        # An empty IN would still run the whole match, skip it
+        if not rowids:
+            continue
+        for rowid, snippet in db.session.execute(statement, {
+            'match': match[f'{source}_match'],
+            'rowids': rowids,
+            'open': SNIPPET_OPEN_MARKER,
+            'close': SNIPPET_CLOSE_MARKER,
+            'ellipsis': SNIPPET_ELLIPSIS,
+            'tokens': SNIPPET_TOKENS,
+        }):
+            snippets[source, rowid] = mark_snippet(snippet)
+
+    results = [{
+        'id': row.id,
+        'title': row.title,
+        'word_count': row.word_count,
+        'snippet': snippets.get((row.source, row.match_rowid))
+    } for row in rows]
+    return results, next_key, total
+
+
+# HTML escape a snippet from FTS5, then turn its markers into the tags around matched terms.
+def mark_snippet(snippet):
+    return html.escape(snippet).replace(SNIPPET_OPEN_MARKER, SNIPPET_OPEN).replace(SNIPPET_CLOSE_MARKER, SNIPPET_CLOSE)
+
+
+# Create the index on an existing database and fill it from the current documents and text chunks.
+def rebuild():
+    for statement in ['DROP TABLE IF EXISTS document_title_fts', 'DROP TABLE IF EXISTS text_chunk_fts']:
+        db.session.execute(text(statement))
+    for statement in TITLE_INDEX_DDL + TEXT_INDEX_DDL:
+        db.session.execute(text(statement))
+    db.session.execute(text(
+        "INSERT INTO document_title_fts(rowid, title, owner) SELECT id, title, user_id FROM document"))
+    db.session.execute(text(
+        """INSERT INTO text_chunk_fts(rowid, body, owner, document_id)
+        SELECT c.id, c.input_text_chunk, d.user_id, c.document_id
+        FROM text_chunks AS c JOIN document AS d ON d.id = c.document_id"""))
+    db.session.commit()
@@ -0,0 +1,172 @@
+# Span tracing of requests and of the document processing pipeline.
+# A span times one stage along with attributes such as the text length or the number of sentences or pages,
+# and the span open in the current context is the parent of the spans started inside it. Every request is the
+# root of a trace, and a processing job continues the trace of the request that queued it, so one slow upload
+# or edit is broken down into its PDF extraction, chunking, rewrite and scoring calls, tokenization, storing
+# and commits.
+# Finished spans are appended to TRACE_FILE, one JSON object per line using the field names of OTLP spans with
+# the attributes as a plain object. Whether a trace is kept is decided once at its root with TRACE_SAMPLE_RATE.
+# Without a file nothing is traced.
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import json
+import os
+import random
+import time
+
+from flask import current_app, g, has_app_context, request
+
+_current_span = ContextVar('starc_current_span', default=None)
+
+
+# Per-app state: the file spans are appended to and the fraction of traces kept.
+class _TracingState:
+    def __init__(self, path, sample_rate, logger):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.logger = logger
+
+    # Append one span as a single write, so lines of several threads or worker processes don't interleave.
+    def export(self, record):
+        line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError:
+            self.logger.exception('Could not write span to %s', self.path)
+
+
+# One timed stage. Spans of traces that are not sampled are still kept in the context, so their children know
+# not to record either.
+class Span:
+    def __init__(self, name, trace_id, parent_id, exporter, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.exporter = exporter
+        self.attributes = dict(attributes)
+        self.error = None
+        self.start = time.time_ns()
+
+    @property
+    def sampled(self):
+        return self.exporter is not None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_error(self, exception):
+        self.error = f'{type(exception).__name__}: {exception}'
+
+    def finish(self):
+        if self.exporter is None:
+            return
+        end = time.time_ns()
+        self.exporter.export({
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'startTimeUnixNano': self.start,
+            'endTimeUnixNano': end,
+            'durationMs': round((end - self.start) / 1e6, 3),
+            'attributes': self.attributes,
+            'status': {'code': 'STATUS_CODE_ERROR', 'message': self.error} if self.error
+            else {'code': 'STATUS_CODE_OK'},
+            'resource': {'service.name': 'starc-backend', 'process.pid': os.getpid()},
+        })
+
+
+def current_span():
+    return _current_span.get()
+
+
+# Start a span under parent, by default the span of the current context. A span without a parent starts a new
+# trace, which is sampled when the current app traces at all.
+def _start(name, parent, attributes):
+    parent = parent or _current_span.get()
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.exporter, attributes)
+    state = current_app.extensions.get('tracing') if has_app_context() else None
+    sampled = state is not None and random.random() < state.sample_rate
+    return Span(name, os.urandom(16).hex(), None, state if sampled else None, attributes)
+
+
+# Time the block as a span, the child of the current span or of parent, e.g.
+#   with span('store', sentences=42) as stage: ...
+# Exceptions leaving the block mark the span as failed.
+@contextmanager
+def span(name, parent=None, **attributes):
+    current = _start(name, parent, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.finish()
+
+
+# Trace every call to func as a span named module.function, like metrics.timed.
+def traced(func):
+    name = f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class Tracing:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRACE_FILE', None)
+        app.config.setdefault('TRACE_SAMPLE_RATE', 1.0)
+        path = app.config['TRACE_FILE']
+        if not path:
+            app.extensions.pop('tracing', None)
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        app.extensions['tracing'] = _TracingState(path, app.config['TRACE_SAMPLE_RATE'], app.logger)
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        # Torn down once a streamed response has been sent, so streams are traced to their end
+        app.teardown_request(self._finish_request)
+
+    def _start_request(self):
+        request_span = _start(request.endpoint or 'unmatched', None, {
+            'http.method': request.method,
+            'http.route': request.url_rule.rule if request.url_rule else None,
+        })
+        g._trace = (request_span, _current_span.set(request_span))
+
+    def _record_status(self, response):
+        if '_trace' in g:
+            g._trace[0].set(**{'http.status_code': response.status_code})
+        return response
+
+    def _finish_request(self, exception):
+        trace = g.pop('_trace', None)
+        if trace is None:
+            return
+        request_span, token = trace
+        if exception is not None:
+            request_span.record_error(exception)
+        _current_span.reset(token)
+        request_span.finish()
+
+
+tracing = Tracing()
@@ -0,0 +1,123 @@
+# Per-user document statistics for the dashboard.
+# Every user's document count, word count and score totals are kept in the user_stats table by triggers on
+# the document and score tables, so each insert, edit and delete adjusts the totals in the same transaction
+# without any application code, and reading them is a primary key lookup. rebuild() recomputes the table from
+# scratch, for databases created before it existed or to correct any drift.
+# On other databases the triggers are not installed and the statistics are aggregated on every read.
+from sqlalchemy import delete, event, func, insert, literal, select, text
+from api_project import db
+from api_project.models import User, Document, TextChunks, InitialScore, FinalScore, UserStats
+
+# Owner of the chunk a score row belongs to, as seen from a trigger on that score table.
+_SCORE_OWNER = """(SELECT d.user_id FROM text_chunks AS c JOIN document AS d ON d.id = c.document_id
+                   WHERE c.id = {row}.text_chunk_id)"""
+
+STATS_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS user_stats_document_insert AFTER INSERT ON document BEGIN
+        INSERT INTO user_stats(user_id) VALUES (new.user_id) ON CONFLICT(user_id) DO NOTHING;
+        UPDATE user_stats SET document_count = document_count + 1, word_count = word_count + new.word_count
+        WHERE user_id = new.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_stats_document_update AFTER UPDATE OF word_count ON document BEGIN
+        UPDATE user_stats SET word_count = word_count - old.word_count + new.word_count
+        WHERE user_id = new.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_stats_document_delete AFTER DELETE ON document BEGIN
+        UPDATE user_stats SET document_count = document_count - 1, word_count = word_count - old.word_count
+        WHERE user_id = old.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_stats_user_delete AFTER DELETE ON "user" BEGIN
+        DELETE FROM user_stats WHERE user_id = old.id;
+    END""",
+]
+
+for table in ('initial_score', 'final_score'):
+    STATS_DDL += [
+        f"""CREATE TRIGGER IF NOT EXISTS user_stats_{table}_insert AFTER INSERT ON {table} BEGIN
+            UPDATE user_stats SET {table}_count = {table}_count + 1, {table}_sum = {table}_sum + new.score
+            WHERE user_id = {_SCORE_OWNER.format(row='new')};
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS user_stats_{table}_update AFTER UPDATE OF score ON {table} BEGIN
+            UPDATE user_stats SET {table}_sum = {table}_sum - old.score + new.score
+            WHERE user_id = {_SCORE_OWNER.format(row='new')};
+        END""",
+        # Scores are deleted before their chunks, the chunk still leads to the owner
+        f"""CREATE TRIGGER IF NOT EXISTS user_stats_{table}_delete AFTER DELETE ON {table} BEGIN
+            UPDATE user_stats SET {table}_count = {table}_count - 1, {table}_sum = {table}_sum - old.score
+            WHERE user_id = {_SCORE_OWNER.format(row='old')};
+        END""",
+    ]
+
+
+# The triggers span several tables, so they are created once every table exists. Dropping the tables drops them.
+@event.listens_for(db.metadata, 'after_create')
+def create_triggers(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for statement in STATS_DDL:
+            connection.execute(text(statement))
+
+
+def is_maintained():
+    return db.engine.dialect.name == 'sqlite'
+
+
+# Totals of every user, or of one user, aggregated from the documents and scores themselves.
+def _aggregate(user_id=None):
+    def owned(query):
+        return query.where(Document.user_id == user_id) if user_id is not None else query
+
+    documents = owned(select(
+        Document.user_id, func.count().label('count'), func.sum(Document.word_count).label('words')
+    )).group_by(Document.user_id).subquery()
+    scores = [
+        owned(select(
+            Document.user_id, func.count().label('count'), func.sum(model.score).label('total')
+        ).join(TextChunks, TextChunks.id == model.text_chunk_id).join(Document, Document.id == TextChunks.document_id))
+        .group_by(Document.user_id).subquery()
+        for model in (InitialScore, FinalScore)
+    ]
+    initial, final = scores
+    users = select(User.id)
+    if user_id is not None:
+        users = users.where(User.id == user_id)
+    users = users.subquery()
+
+    return select(
+        users.c.id.label('user_id'),
+        func.coalesce(documents.c.count, 0).label('document_count'),
+        func.coalesce(documents.c.words, 0).label('word_count'),
+        func.coalesce(initial.c.count, 0).label('initial_score_count'),
+        func.coalesce(initial.c.total, literal(0.0)).label('initial_score_sum'),
+        func.coalesce(final.c.count, 0).label('final_score_count'),
+        func.coalesce(final.c.total, literal(0.0)).label('final_score_sum'),
+    ).select_from(users)\
+     .outerjoin(documents, documents.c.user_id == users.c.id)\
+     .outerjoin(initial, initial.c.user_id == users.c.id)\
+     .outerjoin(final, final.c.user_id == users.c.id)
+
+
+# Dashboard statistics of a user: document and word counts, and the average original and rewritten score
+# over every scored chunk, None before anything was scored.
+def get(user_id):
+    if is_maintained():
+        # Read the row itself, a UserStats object in the session would not see the triggers' changes
+        row = db.session.execute(select(UserStats.__table__).where(UserStats.user_id == user_id)).first()
+    else:
+        row = db.session.execute(_aggregate(user_id)).first()
+    if row is None:
+        return {'document_count': 0, 'word_count': 0, 'average_initial_score': None, 'average_final_score': None}
+    return {
+        'document_count': row.document_count,
+        'word_count': row.word_count,
+        'average_initial_score': row.initial_score_sum / row.initial_score_count if row.initial_score_count else None,
+        'average_final_score': row.final_score_sum / row.final_score_count if row.final_score_count else None,
+    }
+
+
+# Recompute every user's statistics from the documents and scores, replacing the maintained totals.
+def rebuild():
+    db.session.execute(delete(UserStats))
+    columns = ['user_id', 'document_count', 'word_count', 'initial_score_count', 'initial_score_sum',
+               'final_score_count', 'final_score_sum']
+    db.session.execute(insert(UserStats).from_select(columns, _aggregate()))
+    db.session.commit()
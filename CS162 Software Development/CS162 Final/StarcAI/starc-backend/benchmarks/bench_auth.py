@@ -0,0 +1,103 @@
+# Benchmark: document requests served during a burst of logins.
+# Runs the app on a threaded local server, then has some clients log in over and over while others read a
+# document, once with passwords hashed on the request threads and once in the password hashing pool. Reports
+# login throughput and rejections, and the document request latency the logins cause.
+#
+# Run from starc-backend: python -m benchmarks.bench_auth [seconds] [login clients] [document clients]
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+from api_project import create_app, db
+from api_project.models import User, Document, TextChunks
+
+DEFAULT_SECONDS = 10
+DEFAULT_LOGIN_CLIENTS = 8
+DEFAULT_DOCUMENT_CLIENTS = 4
+PASSWORD = 'benchmark-password'
+
+
+def setup(app):
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        document = Document(title='Benchmark', user_id=user.id, word_count=200)
+        db.session.add(document)
+        db.session.commit()
+        db.session.add(TextChunks(document_id=document.id, input_text_chunk='Revenue grew this quarter. ' * 40,
+                                  rewritten_text=''))
+        db.session.commit()
+        return document.id
+
+
+def login(url):
+    return requests.post(f'{url}/auth/login', json={'login_identifier': 'bench', 'password': PASSWORD})
+
+
+# Call request(session) in a loop until stop is set, collecting (status, seconds) pairs.
+def client_loop(request, stop, results):
+    with requests.Session() as session:
+        while not stop.is_set():
+            start = time.perf_counter()
+            status = request(session).status_code
+            results.append((status, time.perf_counter() - start))
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] if timings else float('nan')
+
+
+def run(label, workers, seconds, login_clients, document_clients):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "bench.db")}',
+                          'PASSWORD_HASH_WORKERS': workers})
+        document_id = setup(app)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}'
+        headers = {'Authorization': f'Bearer {login(url).json()["access_token"]}'}
+
+        stop = threading.Event()
+        logins, documents = [], []
+        clients = [threading.Thread(target=client_loop, args=(
+            lambda session: session.post(f'{url}/auth/login', json={'login_identifier': 'bench', 'password': PASSWORD}),
+            stop, logins)) for _ in range(login_clients)]
+        clients += [threading.Thread(target=client_loop, args=(
+            lambda session: session.get(f'{url}/docs/{document_id}', headers=headers), stop, documents))
+            for _ in range(document_clients)]
+        for client in clients:
+            client.start()
+        time.sleep(seconds)
+        stop.set()
+        for client in clients:
+            client.join()
+        server.shutdown()
+
+    succeeded = [timing for status, timing in logins if status == 200]
+    rejected = sum(1 for status, _ in logins if status == 503)
+    timings = sorted(timing for _, timing in documents)
+    print(f'{label:>8} {len(succeeded) / seconds:>10.1f} {rejected:>9} {len(timings) / seconds:>9.1f} '
+          f'{percentile(timings, 0.5) * 1000:>9.1f} {percentile(timings, 0.95) * 1000:>9.1f} '
+          f'{percentile(timings, 0.99) * 1000:>9.1f}')
+
+
+def main(seconds, login_clients, document_clients):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    workers = min(2, os.cpu_count() or 1)
+    print(f'{seconds}s, {login_clients} login clients, {document_clients} document clients, {workers} hash workers')
+    print(f'{"hashing":>8} {"logins/s":>10} {"rejected":>9} {"docs/s":>9} {"p50 (ms)":>9} {"p95 (ms)":>9} {"p99 (ms)":>9}')
+    run('inline', 0, seconds, login_clients, document_clients)
+    run('pool', workers, seconds, login_clients, document_clients)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [DEFAULT_SECONDS, DEFAULT_LOGIN_CLIENTS, DEFAULT_DOCUMENT_CLIENTS][len(args):]))
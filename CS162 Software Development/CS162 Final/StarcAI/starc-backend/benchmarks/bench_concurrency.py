@@ -0,0 +1,154 @@
+# Benchmark: throughput of concurrent readers and writers against one SQLite database.
+# Serves wsgi:app with gunicorn, one worker process and then several, once with SQLite's default settings and
+# once with the SQLITE_* pragmas. Writers rename their own document over and over while readers fetch
+# documents and dashboard statistics. Reports requests per second, failed requests (mostly "database is
+# locked") and latencies for each combination.
+#
+# Run from starc-backend: python -m benchmarks.bench_concurrency [seconds] [writers] [readers] [workers]
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from api_project import create_app, db
+from api_project.models import User, Document
+from api_project.pipeline import store_chunks
+
+DEFAULT_SECONDS = 10
+DEFAULT_WRITERS = 4
+DEFAULT_READERS = 8
+DEFAULT_WORKERS = min(4, (os.cpu_count() or 1) + 1)
+PASSWORD = 'benchmark-password'
+PORT = 5077
+SENTENCES = 40
+
+DEFAULT_PRAGMAS = {'SQLITE_JOURNAL_MODE': '', 'SQLITE_SYNCHRONOUS': '', 'SQLITE_BUSY_TIMEOUT_MS': '',
+                   'SQLITE_MMAP_SIZE': ''}
+TUNED_PRAGMAS = {}
+
+# Cheap hashes and no background pools to speak of, only the requests are measured
+SERVER_ENV = {'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000', 'PASSWORD_HASH_WORKERS': '0', 'JOB_WORKERS': '1',
+              'PDF_EXTRACT_WORKERS': '1'}
+
+
+# A user with one document per client, each with its chunk and sentences stored.
+def setup(uri, pragmas, documents):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'PASSWORD_HASH_METHOD': SERVER_ENV['PASSWORD_HASH_METHOD'],
+                      'PASSWORD_HASH_WORKERS': 0, **pragmas})
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        document_ids = []
+        for number in range(documents):
+            document = Document(title=f'Document {number}', user_id=user.id, word_count=SENTENCES * 4)
+            db.session.add(document)
+            db.session.commit()
+            sentences = [(f'Revenue grew {i} percent.', f'Revenue grew by {i} percent.') for i in range(SENTENCES)]
+            store_chunks(document.id, [{
+                'text': ' '.join(orig for orig, _ in sentences),
+                'rewritten_text': ' '.join(rewr for _, rewr in sentences),
+                'original_scores': [50.0, 60.0, 70.0, 80.0],
+                'rewritten_scores': [55.0, 65.0, 75.0, 85.0],
+                'sentences': sentences,
+            }])
+            db.session.commit()
+            document_ids.append(document.id)
+        db.session.remove()
+        db.engine.dispose()
+    return document_ids
+
+
+def start_server(uri, pragmas, workers):
+    env = {**os.environ, **SERVER_ENV, **pragmas, 'SQLALCHEMY_DATABASE_URI': uri}
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{PORT}',
+         '--workers', str(workers), 'wsgi:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f'http://127.0.0.1:{PORT}'
+    for _ in range(300):
+        try:
+            response = requests.post(f'{url}/auth/login', json={'login_identifier': 'bench', 'password': PASSWORD})
+            if response.status_code == 200:
+                return server, url, {'Authorization': f'Bearer {response.json()["access_token"]}'}
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+# Call request(session, count) in a loop until stop is set, collecting (status, seconds) pairs.
+def client_loop(request, stop, results):
+    count = 0
+    with requests.Session() as session:
+        while not stop.is_set():
+            start = time.perf_counter()
+            status = request(session, count).status_code
+            results.append((status, time.perf_counter() - start))
+            count += 1
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] if timings else float('nan')
+
+
+def run(label, pragmas, workers, seconds, writers, readers):
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = f'sqlite:///{os.path.join(tmp, "bench.db")}'
+        document_ids = setup(uri, pragmas, max(writers, readers))
+        server, url, headers = start_server(uri, pragmas, workers)
+        try:
+            stop = threading.Event()
+            writes, reads = [], []
+
+            def rename(document_id):
+                return lambda session, count: session.put(
+                    f'{url}/docs/{document_id}', json={'title': f'Renamed {count}'}, headers=headers)
+
+            def read(document_id):
+                return lambda session, count: session.get(
+                    f'{url}/docs/{document_id}' if count % 2 else f'{url}/docs/stats', headers=headers)
+
+            clients = [threading.Thread(target=client_loop, args=(rename(document_ids[i]), stop, writes))
+                       for i in range(writers)]
+            clients += [threading.Thread(target=client_loop, args=(read(document_ids[i]), stop, reads))
+                        for i in range(readers)]
+            for client in clients:
+                client.start()
+            time.sleep(seconds)
+            stop.set()
+            for client in clients:
+                client.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    for kind, results in (('writes', writes), ('reads', reads)):
+        failed = sum(1 for status, _ in results if status >= 500)
+        timings = sorted(timing for status, timing in results if status < 500)
+        print(f'{label:>18} {workers:>7} {kind:>6} {len(timings) / seconds:>8.1f} {failed:>7} '
+              f'{percentile(timings, 0.5) * 1000:>9.1f} {percentile(timings, 0.95) * 1000:>9.1f} '
+              f'{percentile(timings, 0.99) * 1000:>9.1f}')
+
+
+def main(seconds, writers, readers, workers):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    print(f'{seconds}s, {writers} writers, {readers} readers')
+    print(f'{"sqlite settings":>18} {"workers":>7} {"kind":>6} {"req/s":>8} {"failed":>7} '
+          f'{"p50 (ms)":>9} {"p95 (ms)":>9} {"p99 (ms)":>9}')
+    for label, pragmas in (('defaults', DEFAULT_PRAGMAS), ('WAL + pragmas', TUNED_PRAGMAS)):
+        for worker_count in sorted({1, workers}):
+            run(label, pragmas, worker_count, seconds, writers, readers)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [DEFAULT_SECONDS, DEFAULT_WRITERS, DEFAULT_READERS, DEFAULT_WORKERS][len(args):]))
@@ -0,0 +1,86 @@
+# Benchmark: time to persist a processed document against its sentence count.
+# Compares the old persistence (one ORM object per row and four commits) with pipeline.store_chunks
+# (one executemany insert per table in one transaction) on an on-disk SQLite database.
+#
+# Run from starc-backend: python -m benchmarks.bench_persistence [sentence counts...]
+import os
+import sys
+import tempfile
+import time
+
+from api_project import create_app, db
+from api_project.models import User, Document, TextChunks, Sentence, InitialScore, FinalScore
+from api_project.pipeline import store_chunks
+
+DEFAULT_COUNTS = [100, 500, 2000, 5000]
+SCORES = [50.0, 60.0, 70.0, 80.0]
+
+
+def make_results(sentence_count):
+    sentences = [(f'Original sentence number {i}.', f'Rewritten sentence number {i}.') for i in range(sentence_count)]
+    return [{
+        'text': ' '.join(orig for orig, _ in sentences),
+        'rewritten_text': ' '.join(rewr for _, rewr in sentences),
+        'original_scores': SCORES,
+        'rewritten_scores': SCORES,
+        'sentences': sentences,
+    }]
+
+
+# The persistence stage as process_document wrote it before: an ORM object per row and a commit per step.
+def store_per_object(document_id, results):
+    result = results[0]
+    new_text_chunk = TextChunks(document_id=document_id, input_text_chunk=result['text'])
+    new_text_chunk.rewritten_text = result['rewritten_text']
+    db.session.add(new_text_chunk)
+    db.session.commit()
+
+    db.session.add(InitialScore(text_chunk_id=new_text_chunk.id, score=SCORES[0], optimism=SCORES[1],
+                                forecast=SCORES[2], confidence=SCORES[3]))
+    db.session.add(FinalScore(text_chunk_id=new_text_chunk.id, score=SCORES[0], optimism=SCORES[1],
+                              forecast=SCORES[2], confidence=SCORES[3]))
+    db.session.commit()
+
+    for orig, rewr in result['sentences']:
+        db.session.add(Sentence(text_chunk_id=new_text_chunk.id, original_text=orig, rewritten_text=rewr))
+    db.session.commit()
+
+
+def store_bulk(document_id, results):
+    store_chunks(document_id, results)
+    db.session.commit()
+
+
+def time_store(store, user_id, sentence_count, repeats=3):
+    results = make_results(sentence_count)
+    best = float('inf')
+    for _ in range(repeats):
+        document = Document(title='Benchmark', user_id=user_id, word_count=0)
+        db.session.add(document)
+        db.session.commit()
+        start = time.perf_counter()
+        store(document.id, results)
+        best = min(best, time.perf_counter() - start)
+        db.session.expunge_all()
+    return best
+
+
+def main(counts):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "bench.db")}'})
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench', email='bench@example.com', password='x')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+
+            print(f'{"sentences":>10} {"per-object (ms)":>16} {"bulk (ms)":>10} {"speedup":>8}')
+            for count in counts:
+                before = time_store(store_per_object, user_id, count)
+                after = time_store(store_bulk, user_id, count)
+                print(f'{count:>10} {before * 1000:>16.1f} {after * 1000:>10.1f} {before / after:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
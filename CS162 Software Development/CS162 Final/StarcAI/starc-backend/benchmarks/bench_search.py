@@ -0,0 +1,131 @@
+# Benchmark: document search on a large on-disk SQLite database.
+# Fills the database with generated documents spread over many users, one text chunk each, then times the
+# old LIKE title filter (count plus one page) against the FTS5 search for common and rare words. Common words
+# appear in most documents and are the worst case for the index, which also searches and ranks the text.
+# Also times listing one user's documents at increasing page depth, LIMIT/OFFSET against keyset pagination,
+# and the FTS5 search for a common word at the same depths, each page continuing after the previous one's key.
+#
+# Run from starc-backend: python -m benchmarks.bench_search [document count] [user count]
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import insert, select
+from api_project import create_app, db, search_index
+from api_project.models import User, Document, TextChunks
+
+DEFAULT_DOCUMENTS = 1000000
+DEFAULT_USERS = 1000
+PAGE_SIZE = 12
+PAGE_DEPTHS = [1, 10, 40, 80]
+BATCH_SIZE = 10000
+WORDS = ['revenue', 'growth', 'forecast', 'margin', 'strategy', 'market', 'quarter', 'outlook', 'risk', 'capital',
+         'customer', 'product', 'region', 'guidance', 'demand', 'supply', 'pricing', 'cost', 'investment', 'cash']
+RARE_WORD = 'zeppelin'
+
+
+def fill(document_count, user_count):
+    rng = random.Random(0)
+    db.session.execute(insert(User), [
+        {'username': f'user{number}', 'email': f'user{number}@example.com', 'password': 'x'}
+        for number in range(user_count)
+    ])
+    for start in range(0, document_count, BATCH_SIZE):
+        rows = range(start, min(start + BATCH_SIZE, document_count))
+        document_ids = db.session.scalars(insert(Document).returning(Document.id, sort_by_parameter_order=True), [
+            {'title': ' '.join(rng.choices(WORDS, k=4)) + (f' {RARE_WORD}' if number % 10000 == 0 else ''),
+             'user_id': number % user_count + 1, 'word_count': 20}
+            for number in rows
+        ]).all()
+        db.session.execute(insert(TextChunks), [
+            {'document_id': document_id, 'input_text_chunk': ' '.join(rng.choices(WORDS, k=20)), 'rewritten_text': ''}
+            for document_id in document_ids
+        ])
+        db.session.commit()
+
+
+def like_search(user_id, query_text, limit=12):
+    query = Document.query.filter(Document.user_id == user_id, Document.title.like(f'%{query_text}%'))
+    return query.count(), query.limit(limit).all()
+
+
+def fts_search(user_id, query_text, limit=12):
+    return search_index.search(user_id, query_text, limit)
+
+
+def offset_page(user_id, page):
+    return Document.query.filter(Document.user_id == user_id).order_by(Document.id)\
+                         .limit(PAGE_SIZE).offset((page - 1) * PAGE_SIZE).all()
+
+
+def keyset_page(user_id, after_id):
+    return db.session.execute(select(Document.id, Document.title, Document.word_count).where(
+        Document.user_id == user_id, Document.id > after_id).order_by(Document.id).limit(PAGE_SIZE + 1)).all()
+
+
+def time_call(call, repeats=5):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def time_search(search, query_text, user_count, repeats=20):
+    timings = []
+    for number in range(repeats):
+        start = time.perf_counter()
+        search(number % user_count + 1, query_text)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(document_count, user_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "bench.db")}'})
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            fill(document_count, user_count)
+            print(f'Filled {document_count} documents for {user_count} users in {time.perf_counter() - start:.1f}s')
+
+            print(f'{"query":>16} {"LIKE (ms)":>10} {"FTS5 (ms)":>10}')
+            for query_text in ('forecast', 'forecast margin', RARE_WORD):
+                before = time_search(like_search, query_text, user_count)
+                after = time_search(fts_search, query_text, user_count)
+                print(f'{query_text:>16} {before * 1000:>10.2f} {after * 1000:>10.2f}')
+
+            # The id after which each page starts, as the cursors of the previous pages would give it
+            ids = db.session.scalars(select(Document.id).where(Document.user_id == 1).order_by(Document.id)).all()
+            print(f'{"page":>16} {"OFFSET (ms)":>12} {"keyset (ms)":>12}')
+            for page in PAGE_DEPTHS:
+                if (page - 1) * PAGE_SIZE >= len(ids):
+                    break
+                after_id = ids[(page - 1) * PAGE_SIZE - 1] if page > 1 else 0
+                before = time_call(lambda: offset_page(1, page))
+                after = time_call(lambda: keyset_page(1, after_id))
+                print(f'{page:>16} {before * 1000:>12.2f} {after * 1000:>12.2f}')
+
+            # The key each search page starts after, following the keys of the pages before it
+            keys = [None]
+            while len(keys) < max(PAGE_DEPTHS):
+                _, next_key, _ = search_index.search(1, 'forecast', PAGE_SIZE, keys[-1])
+                if next_key is None:
+                    break
+                keys.append(next_key)
+            print(f'{"search page":>16} {"FTS5 (ms)":>12}')
+            for page in PAGE_DEPTHS:
+                if page > len(keys):
+                    break
+                after = time_call(lambda: search_index.search(1, 'forecast', PAGE_SIZE, keys[page - 1]))
+                print(f'{page:>16} {after * 1000:>12.2f}')
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [DEFAULT_DOCUMENTS, DEFAULT_USERS][len(args):]))
@@ -0,0 +1,57 @@
+# Benchmark: time to import the app and to create it, as a worker process or test run pays on every start.
+# Each run is a fresh interpreter against an existing SQLite database, once with the schema checked by
+# create_app and once with DB_CREATE_ON_START off, as gunicorn workers run after flask init-db. Reports the
+# median time to import api_project with its routes, to run create_app and of the whole process, and which of
+# the heavy libraries only needed by some requests were loaded along the way.
+#
+# Run from starc-backend: python -m benchmarks.bench_startup [runs]
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_RUNS = 10
+HEAVY_MODULES = ('nltk', 'pypdf', 'reportlab')
+
+CHILD = f'''
+import json, sys, time
+start = time.perf_counter()
+import api_project, api_project.routes.documents, api_project.routes.rewrites
+imported = time.perf_counter()
+api_project.create_app()
+created = time.perf_counter()
+print(json.dumps({{"import": imported - start, "create_app": created - imported,
+                  "heavy": [name for name in {HEAVY_MODULES!r} if name in sys.modules]}}))
+'''
+
+
+def run_child(env):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD], env=env, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - start
+    return result
+
+
+def main(runs):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "startup.db")}',
+               'PASSWORD_HASH_WORKERS': '0'}
+        # Create the database once, so every run finds the schema in place
+        run_child({**env, 'DB_CREATE_ON_START': 'true'})
+
+        print(f'{runs} runs, medians')
+        print(f'{"schema on start":>16} {"import (ms)":>12} {"create_app (ms)":>16} {"process (ms)":>13}  heavy modules')
+        for label, create in (('checked', 'true'), ('init-db', 'false')):
+            results = [run_child({**env, 'DB_CREATE_ON_START': create}) for _ in range(runs)]
+            median = lambda key: statistics.median(result[key] for result in results) * 1000
+            heavy = ', '.join(results[-1]['heavy']) or 'none'
+            print(f'{label:>16} {median("import"):>12.1f} {median("create_app"):>16.1f} {median("process"):>13.1f}  {heavy}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS)
@@ -0,0 +1,93 @@
+# Benchmark: time to accept every suggestion of a document against its sentence count.
+# Compares the old accept-all (every sentence loaded and changed through the ORM, then each chunk's text
+# joined and the words counted in Python) with pipeline.accept_suggestions (set-based UPDATEs) on an on-disk
+# SQLite database. Documents are split into chunks of 50 sentences, as a long document would be.
+#
+# Run from starc-backend: python -m benchmarks.bench_suggestions [sentence counts...]
+import os
+import sys
+import tempfile
+import time
+
+from api_project import create_app, db
+from api_project.models import User, Document
+from api_project.pipeline import store_chunks, accept_suggestions
+
+DEFAULT_COUNTS = [100, 1000, 5000, 20000]
+SENTENCES_PER_CHUNK = 50
+SCORES = [50.0, 60.0, 70.0, 80.0]
+
+
+def make_document(user_id, sentence_count):
+    document = Document(title='Benchmark', user_id=user_id, word_count=sentence_count * 4)
+    db.session.add(document)
+    db.session.commit()
+    results = []
+    for start in range(0, sentence_count, SENTENCES_PER_CHUNK):
+        sentences = [(f'Original sentence number {i}.', f'Rewritten sentence number {i}.')
+                     for i in range(start, min(start + SENTENCES_PER_CHUNK, sentence_count))]
+        results.append({
+            'text': ' '.join(orig for orig, _ in sentences),
+            'rewritten_text': ' '.join(rewr for _, rewr in sentences),
+            'original_scores': SCORES,
+            'rewritten_scores': SCORES,
+            'sentences': sentences,
+        })
+    store_chunks(document.id, results)
+    db.session.commit()
+    return document.id
+
+
+# Accept-all as the route did it before: the document's sentences loaded and updated one object at a time.
+def accept_per_object(document_id):
+    document = db.session.get(Document, document_id)
+    text_chunks = document.text_chunks
+    for text_chunk in text_chunks:
+        for sentence in text_chunk.sentences:
+            sentence.original_text = sentence.rewritten_text
+    db.session.commit()
+
+    for text_chunk in text_chunks:
+        text_chunk.input_text_chunk = ' '.join(s.original_text for s in text_chunk.sentences)
+    db.session.commit()
+
+    document.word_count = sum(len(text_chunk.input_text_chunk.split()) for text_chunk in text_chunks)
+    db.session.commit()
+
+
+def accept_set_based(document_id):
+    accept_suggestions(document_id)
+    db.session.commit()
+
+
+def time_accept(accept, user_id, sentence_count, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        document_id = make_document(user_id, sentence_count)
+        db.session.expunge_all()
+        start = time.perf_counter()
+        accept(document_id)
+        best = min(best, time.perf_counter() - start)
+        db.session.expunge_all()
+    return best
+
+
+def main(counts):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(tmp, "bench.db")}'})
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench', email='bench@example.com', password='x')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+
+            print(f'{"sentences":>10} {"per-object (ms)":>16} {"set-based (ms)":>15} {"speedup":>8}')
+            for count in counts:
+                before = time_accept(accept_per_object, user_id, count)
+                after = time_accept(accept_set_based, user_id, count)
+                print(f'{count:>10} {before * 1000:>16.1f} {after * 1000:>15.1f} {before / after:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
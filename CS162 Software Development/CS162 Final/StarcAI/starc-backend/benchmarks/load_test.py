@@ -0,0 +1,299 @@
+# Load test: throughput and tail latency of every blueprint under scripted client scenarios.
+# Starts a local stand-in for the entry_pointGPT and entry_pointSA cloud functions with the given latency,
+# serves wsgi:app against it with gunicorn (or the threaded development server with --workers 0) on a fresh
+# SQLite database, then runs simulated clients for a while. Each client logs in as its own user, creates the
+# documents it needs and repeats its scenario:
+#   register_login  registers a new user and logs in as them
+#   upload_pdf      uploads a PDF, polls its processing job until done and reads the result
+#   poll_details    revalidates a document's details and scores with their ETags, as a client open on it would
+#   accept          lists a document's suggestions and accepts one, editing the text back when none are left
+#   search          searches the client's documents for a word
+# Prints requests per second and p50/p95/p99 latencies per endpoint and per scenario as JSON.
+#
+# Run from starc-backend: python -m benchmarks.load_test [--seconds 30] [--clients 10] [--latency 0.2] ...
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+from api_project import create_app
+from api_project.pdf_export import render_document_pdf
+from tests.stub_server import CloudFunctionStub
+
+SCENARIOS = ('register_login', 'upload_pdf', 'poll_details', 'accept', 'search')
+PASSWORD = 'load-test-password'
+JOB_POLL_SECONDS = 0.2
+WORDS = ['revenue', 'growth', 'forecast', 'margin', 'strategy', 'market', 'quarter', 'outlook']
+
+# Cheap password hashes, so logins measure the app rather than the hashing parameters
+SERVER_CONFIG = {'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000'}
+
+
+def document_text(number, sentences=12):
+    return ' '.join(f'Our {WORDS[(number + i) % len(WORDS)]} improved in quarter {i} of report {number}.'
+                    for i in range(sentences))
+
+
+def make_pdf():
+    output = io.BytesIO()
+    render_document_pdf(output, 'Quarterly Report', [(document_text(number), None) for number in range(20)])
+    return output.getvalue()
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] if timings else None
+
+
+# Latencies and statuses of every request, by endpoint, and the durations of finished scenario iterations.
+class Recorder:
+    def __init__(self):
+        self.requests = {}
+        self.iterations = {}
+        self.lock = threading.Lock()
+
+    def record_request(self, endpoint, status, seconds):
+        with self.lock:
+            self.requests.setdefault(endpoint, []).append((status, seconds))
+
+    def record_iteration(self, scenario, seconds):
+        with self.lock:
+            self.iterations.setdefault(scenario, []).append((200, seconds))
+
+    def report(self, seconds):
+        return {
+            'endpoints': {name: summarize(results, seconds) for name, results in sorted(self.requests.items())},
+            'scenarios': {name: summarize(results, seconds) for name, results in sorted(self.iterations.items())},
+            'total': summarize([result for results in self.requests.values() for result in results], seconds),
+        }
+
+
+# Counts, rate and latency percentiles of (status, seconds) pairs. Errors are server errors and failed
+# connections (status 0), other statuses are answers the scenarios expect.
+def summarize(results, seconds):
+    timings = sorted(timing for _, timing in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    milliseconds = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': len(results),
+        'errors': sum(1 for status, _ in results if status == 0 or status >= 500),
+        'rps': round(len(results) / seconds, 2),
+        'p50_ms': milliseconds(percentile(timings, 0.5)),
+        'p95_ms': milliseconds(percentile(timings, 0.95)),
+        'p99_ms': milliseconds(percentile(timings, 0.99)),
+        'max_ms': milliseconds(timings[-1] if timings else None),
+        'statuses': statuses,
+    }
+
+
+# One simulated client with its own user and connection. Requests made while setting up are not recorded.
+class Client:
+    def __init__(self, url, name, recorder, pdf):
+        self.url = url
+        self.name = name
+        self.recorder = recorder
+        self.pdf = pdf
+        self.session = requests.Session()
+        self.headers = {}
+        self.recording = False
+        self.counter = itertools.count()
+        self.etags = {}
+
+    def request(self, endpoint, method, path, headers=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f'{self.url}{path}', headers={**self.headers, **(headers or {})},
+                                            timeout=120, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        if self.recording:
+            self.recorder.record_request(endpoint, status, time.perf_counter() - start)
+        return response
+
+    def register_and_login(self, username):
+        self.request('POST /auth/register', 'POST', '/auth/register',
+                     json={'username': username, 'email': f'{username}@example.com', 'password': PASSWORD})
+        response = self.request('POST /auth/login', 'POST', '/auth/login',
+                                json={'login_identifier': username, 'password': PASSWORD})
+        if response is not None and response.status_code == 200:
+            self.headers = {'Authorization': f'Bearer {response.json()["access_token"]}'}
+
+    def wait_for_job(self, job_id):
+        while True:
+            response = self.request('GET /docs/jobs/<id>', 'GET', f'/docs/jobs/{job_id}')
+            if response is None or response.status_code != 200 or \
+                    response.json()['status'] not in ('queued', 'running'):
+                return
+            time.sleep(JOB_POLL_SECONDS)
+
+    def create_document(self, number):
+        response = self.request('POST /docs', 'POST', '/docs',
+                                json={'title': f'Report {number}', 'text': document_text(number)})
+        data = response.json()
+        self.wait_for_job(data['job_id'])
+        return data['document_id']
+
+    def setup(self):
+        self.register_and_login(self.name)
+        self.documents = [self.create_document(number) for number in range(3)]
+        self.recording = True
+
+    # A GET that sends back the ETag of the last response of the same path, as a browser would.
+    def revalidate(self, endpoint, path):
+        response = self.request(endpoint, 'GET', path, headers={'If-None-Match': self.etags.get(path, '')})
+        if response is not None and 'ETag' in response.headers:
+            self.etags[path] = response.headers['ETag']
+        return response
+
+    def register_login(self):
+        self.register_and_login(f'{self.name}-{next(self.counter)}')
+
+    def upload_pdf(self):
+        response = self.request('POST /docs/pdf', 'POST', '/docs/pdf',
+                                files={'pdf': ('report.pdf', self.pdf, 'application/pdf')})
+        if response is None or response.status_code != 202:
+            return
+        data = response.json()
+        self.wait_for_job(data['job_id'])
+        self.request('GET /docs/<id>', 'GET', f'/docs/{data["document_id"]}')
+
+    def poll_details(self):
+        document_id = self.documents[next(self.counter) % len(self.documents)]
+        self.revalidate('GET /docs/<id>', f'/docs/{document_id}')
+        self.revalidate('GET /docs/scores/<id>', f'/docs/scores/{document_id}')
+
+    def accept(self):
+        number = next(self.counter) % len(self.documents)
+        document_id = self.documents[number]
+        response = self.request('GET /fix/<id>', 'GET', f'/fix/{document_id}')
+        if response is not None and response.status_code == 200:
+            sentence_id = response.json()[0]['sentence_id']
+            self.request('PUT /fix/<id>/<sentence_id>', 'PUT', f'/fix/{document_id}/{sentence_id}')
+        elif response is not None and response.status_code == 404:
+            # Every suggestion was accepted, put the original text back to get them again
+            self.request('PUT /docs/<id>', 'PUT', f'/docs/{document_id}', json={'text': document_text(number)})
+
+    def search(self):
+        word = WORDS[next(self.counter) % len(WORDS)]
+        self.request('GET /api/search', 'GET', '/api/search', params={'q': word})
+
+    def run(self, scenario, stop):
+        step = getattr(self, scenario)
+        while not stop.is_set():
+            start = time.perf_counter()
+            step()
+            self.recorder.record_iteration(scenario, time.perf_counter() - start)
+
+
+# Serve the app on a free port, with gunicorn or in this process, until stop() is called.
+class Server:
+    def __init__(self, database_uri, stub_url, workers, port):
+        env = {**SERVER_CONFIG, 'SQLALCHEMY_DATABASE_URI': database_uri, 'GC_FUNCTIONS_URL': stub_url}
+        self.url = f'http://127.0.0.1:{port}'
+        if workers:
+            self.process = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+                 '--workers', str(workers), 'wsgi:app'],
+                env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            self.server = None
+        else:
+            self.process = None
+            self.server = make_server('127.0.0.1', port, create_app(env), threaded=True)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait_until_ready(self):
+        # Gunicorn accepts connections before its workers have loaded the app
+        for _ in range(300):
+            try:
+                requests.get(f'{self.url}/docs/jobs/none', timeout=5)
+                return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError('The server did not start')
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        else:
+            self.server.shutdown()
+
+
+def run(args):
+    scenarios = SCENARIOS if args.scenarios == 'all' else args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise SystemExit(f'Unknown scenario {scenario}, pick from {", ".join(SCENARIOS)}')
+
+    stub = CloudFunctionStub(latency=args.latency).start()
+    recorder = Recorder()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = Server(f'sqlite:///{os.path.join(tmp, "load.db")}', stub.url, args.workers, args.port)
+        try:
+            server.wait_until_ready()
+            pdf = make_pdf()
+            clients = [(Client(server.url, f'client{number}', recorder, pdf), scenarios[number % len(scenarios)])
+                       for number in range(args.clients)]
+            for client, _ in clients:
+                client.setup()
+
+            stop = threading.Event()
+            threads = [threading.Thread(target=client.run, args=(scenario, stop)) for client, scenario in clients]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            server.stop()
+            stub.stop()
+
+    return {
+        'config': {'seconds': args.seconds, 'clients': args.clients, 'scenarios': list(scenarios),
+                   'cloud_latency_seconds': args.latency, 'workers': args.workers,
+                   'cloud_requests': stub.requests},
+        # Iterations still running when the time was up finish late, rates are over the time actually taken
+        'elapsed_seconds': round(elapsed, 2),
+        **recorder.report(elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test every blueprint with scripted client scenarios and report throughput and tail latency.')
+    parser.add_argument('--seconds', type=float, default=30, help='how long the clients run')
+    parser.add_argument('--clients', type=int, default=10, help='clients, spread evenly over the scenarios')
+    parser.add_argument('--scenarios', default='all', help=f'comma separated, from {", ".join(SCENARIOS)}')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds each cloud function call takes')
+    parser.add_argument('--workers', type=int, default=min(4, (os.cpu_count() or 1) + 1),
+                        help='gunicorn workers, 0 for the development server in this process')
+    parser.add_argument('--port', type=int, default=5078)
+    parser.add_argument('--output', help='file to write the JSON report to, instead of printing it')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+# Gunicorn settings for running wsgi:app in production, each can be overridden from the environment.
+import os
+import subprocess
+import sys
+
+bind = os.environ.get('BIND', f'0.0.0.0:{os.environ.get("PORT", 5000)}')
+
+# Worker processes each with a few request threads, so event streams and requests waiting on the database
+# don't hold a whole process. Every worker also runs its own processing and password hashing pools.
+workers = int(os.environ.get('WEB_CONCURRENCY', min(4, (os.cpu_count() or 1) + 1)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Event streams stay open for as long as processing takes, the heartbeat keeps them alive
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+
+
+# Create the database schema once before the workers start, so they don't race each other to create it and
+# start without checking it. The app is loaded in a separate process, its thread and process pools must not
+# be inherited by the workers.
+def on_starting(server):
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'wsgi', 'init-db'], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, 'DB_CREATE_ON_START': 'false'})
+    os.environ.setdefault('DB_CREATE_ON_START', 'false')
@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local stand-in for the entry_pointGPT and entry_pointSA cloud functions.
+# Rewrites upper-case the text so every sentence comes back as a suggestion, scores are fixed.
+class CloudFunctionStub:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.failures = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Make the next len(statuses) requests fail with the given HTTP status codes.
+    def fail_next(self, *statuses):
+        with self.lock:
+            self.failures.extend(statuses)
+
+    def rewrite(self, text):
+        return text.upper()
+
+    def score(self, text):
+        return [50.0, 60.0, 70.0, 80.0]
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with stub.lock:
+                    stub.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stub.lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    status = stub.failures.pop(0) if stub.failures else 200
+                try:
+                    if stub.latency:
+                        time.sleep(stub.latency)
+                    payload = json.loads(body or b'{}')
+                    if status != 200:
+                        self._send(status, 'text/plain', b'stub failure')
+                    elif self.path.startswith('/entry_pointGPT'):
+                        self._send(200, 'text/plain', stub.rewrite(payload['text']).encode())
+                    elif self.path.startswith('/entry_pointSA'):
+                        self._send(200, 'application/json', json.dumps(stub.score(payload['text'])).encode())
+                    else:
+                        self._send(404, 'text/plain', b'not found')
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting, as in the timeout tests
+                    pass
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+
+            def _send(self, status, content_type, data):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
@@ -1,11 +1,16 @@
+import time
 import unittest
+from flask_jwt_extended import decode_token
+from sqlalchemy import event
 from api_project import create_app, db
-from api_project.models import User
+from api_project.models import User, RevokedTokenModel
+from api_project.passwords import password_hasher
+from api_project.process_pools import get_pool
 
 class AuthTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = create_app()
+        self.app = create_app({'DB_CREATE_ON_START': False})
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -95,5 +100,96 @@ class AuthTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('Access token has been revoked', response.get_data(as_text=True))
 
+    def test_revoked_token_is_rejected(self):
+        token = self.login_and_get_token('testuser', 'testpassword')
+        headers = {'Authorization': f'Bearer {token}'}
+        self.assertEqual(self.client.get('/docs/stats', headers=headers).status_code, 200)
+
+        self.client.post('/auth/logout', headers=headers)
+        response = self.client.get('/docs/stats', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('Token has been revoked', response.get_data(as_text=True))
+
+        # Other tokens of the same user keep working
+        other_token = self.login_and_get_token('testuser', 'testpassword')
+        response = self.client.get('/docs/stats', headers={'Authorization': f'Bearer {other_token}'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_revocation_by_another_process_propagates(self):
+        self.app.config['TOKEN_BLOCKLIST_REFRESH_SECONDS'] = 0.2
+        token = self.login_and_get_token('testuser', 'testpassword')
+        headers = {'Authorization': f'Bearer {token}'}
+        self.assertEqual(self.client.get('/docs/stats', headers=headers).status_code, 200)
+
+        # Another worker revokes the token through the table only
+        db.session.add(RevokedTokenModel(jti=decode_token(token)['jti']))
+        db.session.commit()
+
+        time.sleep(0.3)
+        self.assertEqual(self.client.get('/docs/stats', headers=headers).status_code, 401)
+
+    def test_blocklist_check_does_not_query_per_request(self):
+        token = self.login_and_get_token('testuser', 'testpassword')
+        headers = {'Authorization': f'Bearer {token}'}
+        self.client.get('/docs/stats', headers=headers)
+
+        statements = []
+        capture = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            for _ in range(5):
+                self.assertEqual(self.client.get('/docs/stats', headers=headers).status_code, 200)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        self.assertFalse([statement for statement in statements if 'revoked_token_model' in statement])
+
+    def test_password_rehashed_on_login_when_parameters_change(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        password_hasher.init_app(self.app)
+        user = User.query.filter_by(username='testuser').first()
+        user.set_password('testpassword')
+        db.session.commit()
+        self.assertTrue(user.password.startswith('pbkdf2:sha256:1000$'))
+
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        password_hasher.init_app(self.app)
+        self.assertEqual(self.login_user_helper('testuser', 'testpassword').status_code, 200)
+        db.session.expire_all()
+        self.assertTrue(User.query.filter_by(username='testuser').first().password.startswith('pbkdf2:sha256:2000$'))
+
+        # The new hash still accepts the password, and a wrong password does not trigger a rehash
+        self.assertEqual(self.login_user_helper('testuser', 'testpassword').status_code, 200)
+        self.assertEqual(self.login_user_helper('anotheruser', 'wrongpassword').status_code, 401)
+        self.assertTrue(User.query.filter_by(username='anotheruser').first().password.startswith('scrypt:'))
+
+    def test_login_and_register_rejected_when_hash_queue_full(self):
+        slots = self.app.extensions['password_hasher'].slots
+        held = 0
+        while slots.acquire(blocking=False):
+            held += 1
+        try:
+            response = self.login_user_helper('testuser', 'testpassword')
+            self.assertEqual(response.status_code, 503)
+            response = self.client.post('/auth/register', json={
+                'username': 'newuser',
+                'email': 'newuser@example.com',
+                'password': 'newpassword'
+            })
+            self.assertEqual(response.status_code, 503)
+            self.assertIsNone(User.query.filter_by(username='newuser').first())
+        finally:
+            for _ in range(held):
+                slots.release()
+        self.assertEqual(self.login_user_helper('testuser', 'testpassword').status_code, 200)
+
+    def test_hash_pools_follow_each_apps_workers(self):
+        self.assertIs(get_pool('passwords', 1), get_pool('passwords', 1))
+        self.assertIsNot(get_pool('passwords', 1), get_pool('passwords', 2))
+        self.assertIsNot(get_pool('passwords', 1), get_pool('pdf_extract', 1))
+
+    def test_invalid_hash_method_is_rejected_at_startup(self):
+        with self.assertRaises(ValueError):
+            create_app({'PASSWORD_HASH_METHOD': 'md5'})
+
 if __name__ == '__main__':
     unittest.main()
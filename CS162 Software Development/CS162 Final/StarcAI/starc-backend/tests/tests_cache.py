@@ -0,0 +1,101 @@
+import unittest
+from datetime import datetime, timedelta
+from api_project import create_app, db
+from api_project.cache import content_cache, content_key
+from api_project.jobs import jobs
+from api_project.models import User, CachedText
+from stub_server import CloudFunctionStub
+
+class ContentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'CACHE_MEMORY_ENTRIES': 4,
+                               'DB_CREATE_ON_START': False, 'METRICS_TOKEN': 'scraper-token'})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        test_user = User(username='testuser', email='test@example.com')
+        test_user.set_password('testpassword')
+        db.session.add(test_user)
+        db.session.commit()
+        self.jwt_token = self.get_jwt_token_for_test_user()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+
+    def get_jwt_token_for_test_user(self):
+        response = self.client.post('/auth/login', json={
+            'login_identifier': 'testuser',
+            'password': 'testpassword'
+        })
+        return response.get_json().get('access_token')
+
+    def create_document(self, title, text):
+        response = self.client.post('/docs', json={
+            'title': title,
+            'text': text
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        return response.get_json()['document_id']
+
+    def test_repeated_content_skips_rewrite(self):
+        self.create_document('First Upload', 'The same text. Uploaded twice.')
+        self.create_document('Second Upload', 'The  same text.\nUploaded twice.')
+        self.assertEqual(self.stub.requests, 1)
+
+        response = self.client.get('/metrics/cache', headers={'Authorization': 'Bearer scraper-token'})
+        self.assertEqual(response.status_code, 200)
+        stats = response.get_json()
+        self.assertGreater(stats['memory_hits'], 0)
+        self.assertGreater(stats['misses'], 0)
+
+    def test_cached_scores_are_reused(self):
+        first = content_cache.rewrite_and_score(['Some text.'])
+        second = content_cache.rewrite_and_score(['Some text.'])
+        self.assertEqual(first, second)
+
+    def test_persistent_table_survives_memory_eviction(self):
+        content_cache.rewrite_and_score(['Keep me.'])
+        content_cache.rewrite_and_score([f'Filler text {i}.' for i in range(4)])
+        requests_before = self.stub.requests
+
+        rewrites, _, _ = content_cache.rewrite_and_score(['Keep me.'])
+        self.assertEqual(rewrites, ['KEEP ME.'])
+        self.assertEqual(self.stub.requests, requests_before)
+        self.assertGreater(content_cache.stats()['db_hits'], 0)
+        self.assertLessEqual(content_cache.stats()['memory_entries'], 4)
+
+    def test_lookup_leaves_the_callers_session_alone(self):
+        content_cache.rewrite_and_score(['Keep me.'])
+        self.app.extensions['content_cache'].memory.clear()
+        used = db.session.get(CachedText, content_key('Keep me.')).last_used
+
+        db.session.add(User(username='pending', email='pending@example.com', password='x'))
+        content_cache.rewrite_and_score(['Keep me.'])
+        db.session.rollback()
+        self.assertIsNone(User.query.filter_by(username='pending').first())
+
+        # The read is recorded by the cache's next write
+        content_cache.rewrite_and_score(['Other text.'])
+        self.assertGreater(db.session.get(CachedText, content_key('Keep me.')).last_used, used)
+
+    def test_evict_by_age_and_size(self):
+        content_cache.rewrite_and_score(['Old text.', 'New text.'])
+        old = db.session.get(CachedText, content_key('Old text.'))
+        old.created_on = datetime.utcnow() - timedelta(days=365)
+        db.session.commit()
+
+        self.app.extensions['content_cache'].max_entries = 2
+        removed = content_cache.evict()
+        self.assertGreaterEqual(removed, 1)
+        self.assertIsNone(db.session.get(CachedText, content_key('Old text.')))
+        self.assertLessEqual(CachedText.query.count(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
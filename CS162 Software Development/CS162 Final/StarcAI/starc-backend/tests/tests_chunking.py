@@ -0,0 +1,116 @@
+import unittest
+from api_project import create_app, db
+from api_project.chunking import split_into_chunks
+from api_project.jobs import jobs
+from api_project.models import User, Document, TextChunks
+from api_project.pipeline import store_chunks
+from stub_server import CloudFunctionStub
+
+LONG_TEXT = '''First paragraph opens the report. It talks about revenue.
+
+Second paragraph covers costs. Costs went down this quarter. Margins improved.
+
+Third paragraph is the outlook. We expect growth next year.'''
+
+class SplitIntoChunksTestCase(unittest.TestCase):
+
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(split_into_chunks('One sentence. Two sentences.', 100), ['One sentence. Two sentences.'])
+
+    def test_splits_on_paragraphs_within_budget(self):
+        chunks = split_into_chunks(LONG_TEXT, 90)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 90 for chunk in chunks))
+        self.assertEqual(chunks[0], 'First paragraph opens the report. It talks about revenue.')
+
+    def test_splits_long_paragraph_on_sentences(self):
+        chunks = split_into_chunks('Costs went down this quarter. Margins improved a lot. Growth is expected.', 35)
+        self.assertEqual(chunks, ['Costs went down this quarter.', 'Margins improved a lot.', 'Growth is expected.'])
+
+    def test_keeps_all_words_in_order(self):
+        chunks = split_into_chunks(LONG_TEXT, 40)
+        self.assertEqual(' '.join(chunks).split(), LONG_TEXT.split())
+
+    def test_hard_wraps_overlong_sentence(self):
+        chunks = split_into_chunks('word ' * 50, 30)
+        self.assertTrue(all(len(chunk) <= 30 for chunk in chunks))
+        self.assertEqual(' '.join(chunks).split(), ['word'] * 50)
+
+class ChunkedDocumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'CHUNK_MAX_CHARS': 90, 'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        test_user = User(username='testuser', email='test@example.com')
+        test_user.set_password('testpassword')
+        db.session.add(test_user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={
+            'login_identifier': 'testuser',
+            'password': 'testpassword'
+        })
+        self.headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+        response = self.client.post('/docs', json={'title': 'Report', 'text': LONG_TEXT}, headers=self.headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        self.document_id = response.get_json()['document_id']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+
+    def test_document_is_stored_in_several_chunks(self):
+        document = db.session.get(Document, self.document_id)
+        self.assertEqual(len(document.text_chunks), len(split_into_chunks(LONG_TEXT, 90)))
+        self.assertEqual(self.stub.requests, len(document.text_chunks))
+
+    def test_details_include_every_chunk(self):
+        response = self.client.get(f'/docs/{self.document_id}', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        combined = response.get_json()['sentences_combined']
+        self.assertIn('revenue', combined)
+        self.assertIn('growth next year', combined)
+
+    def test_scores_for_every_chunk(self):
+        response = self.client.get(f'/docs/scores/{self.document_id}', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()), len(split_into_chunks(LONG_TEXT, 90)))
+
+    def test_suggestions_from_every_chunk_in_order(self):
+        response = self.client.get(f'/fix/{self.document_id}', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        originals = [s['original_sentence'] for s in response.get_json()]
+        self.assertEqual(originals[0], 'First paragraph opens the report.')
+        self.assertEqual(originals[-1], 'We expect growth next year.')
+
+    def test_stored_chunks_are_paired_with_their_results(self):
+        # The document already has chunks, only the new ones are paired with the results
+        results = [{'text': f'Chunk {number}.', 'rewritten_text': f'CHUNK {number}.', 'original_scores': [number] * 4,
+                    'rewritten_scores': [number] * 4, 'sentences': [(f'Chunk {number}.', f'CHUNK {number}.')]}
+                   for number in range(3)]
+        ids = store_chunks(self.document_id, results)
+        db.session.commit()
+
+        self.assertEqual(len(ids), 3)
+        for text_chunk_id, result in zip(ids, results):
+            text_chunk = db.session.get(TextChunks, text_chunk_id)
+            self.assertEqual(text_chunk.input_text_chunk, result['text'])
+            self.assertEqual(text_chunk.initial_score.score, result['original_scores'][0])
+            self.assertEqual([s.original_text for s in text_chunk.sentences], [result['text']])
+
+    def test_accept_all_updates_every_chunk(self):
+        response = self.client.put(f'/fix/{self.document_id}/all', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        document = db.session.get(Document, self.document_id)
+        self.assertTrue(all(chunk.input_text_chunk.isupper() for chunk in document.text_chunks))
+        self.assertEqual(document.word_count, len(LONG_TEXT.split()))
+
+if __name__ == '__main__':
+    unittest.main()
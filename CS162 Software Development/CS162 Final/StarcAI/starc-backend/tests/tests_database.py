@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy import text
+from api_project import create_app, db
+from api_project.database import engine_options
+
+POOL_CONFIG = {'DB_POOL_SIZE': 5, 'DB_MAX_OVERFLOW': 10, 'DB_POOL_RECYCLE': 600}
+
+class DatabaseSettingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uri = f'sqlite:///{os.path.join(self.directory, "settings.db")}'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pragmas(self, **config):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.uri, **config})
+        with app.app_context():
+            values = {pragma: db.session.execute(text(f'PRAGMA {pragma}')).scalar()
+                      for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size')}
+            db.session.remove()
+            db.engine.dispose()
+        return values
+
+    def test_sqlite_pragmas_are_set_on_every_connection(self):
+        self.assertEqual(self.pragmas(SQLITE_BUSY_TIMEOUT_MS='2500', SQLITE_MMAP_SIZE='1048576'), {
+            'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 2500, 'mmap_size': 1048576})
+
+    def test_empty_pragmas_keep_sqlite_defaults(self):
+        pragmas = self.pragmas(SQLITE_JOURNAL_MODE='', SQLITE_SYNCHRONOUS='', SQLITE_MMAP_SIZE='')
+        self.assertEqual(pragmas['journal_mode'], 'delete')
+        self.assertEqual(pragmas['synchronous'], 2)
+        self.assertEqual(pragmas['mmap_size'], 0)
+
+    def test_server_databases_get_a_checked_pool(self):
+        self.assertEqual(engine_options({'SQLALCHEMY_DATABASE_URI': self.uri, **POOL_CONFIG}), {})
+        options = engine_options({'SQLALCHEMY_DATABASE_URI': 'postgresql://starc@localhost/starc', **POOL_CONFIG})
+        self.assertEqual(options, {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 600, 'pool_pre_ping': True})
+
+if __name__ == '__main__':
+    unittest.main()
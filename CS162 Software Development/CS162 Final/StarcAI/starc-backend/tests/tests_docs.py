@@ -1,12 +1,19 @@
+import time
 import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import text
 from api_project import create_app, db
-from api_project.models import User, Document
+from api_project.jobs import jobs, ORPHANED_ERROR
+from api_project.models import User, Document, ProcessingJob, create_missing_columns
+from api_project.response_cache import response_cache
 from api_project.routes.documents import process_document
+from stub_server import CloudFunctionStub
 
 class DocumentBlueprintTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = create_app()
+        self.stub = CloudFunctionStub().start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'DB_CREATE_ON_START': False})
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -23,6 +30,7 @@ class DocumentBlueprintTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        self.stub.stop()
 
     def get_jwt_token_for_test_user(self):
         response = self.client.post('/auth/login', json={
@@ -33,13 +41,18 @@ class DocumentBlueprintTestCase(unittest.TestCase):
         token = response.get_json().get('access_token')
         return token
 
+    def wait_for_job(self, response):
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+
     def test_create_document_success(self):
         response = self.client.post('/docs', json={
             'title': 'Test Title',
             'text': 'Test Text.'
         }, headers={'Authorization': f'Bearer {self.jwt_token}'})
-        self.assertEqual(response.status_code, 200)
-        self.assertIn('Document and text chunk processed successfully', response.get_data(as_text=True))
+        self.wait_for_job(response)
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('Document accepted for processing', response.get_data(as_text=True))
+        self.assertIn('job_id', response.get_json())
 
     def test_create_document_missing_title(self):
         response = self.client.post('/docs', json={
@@ -70,6 +83,7 @@ class DocumentBlueprintTestCase(unittest.TestCase):
             'title': 'Test Document',
             'text': 'New Text'
         }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(post_response)
 
         post_data = post_response.get_json()
         document_id = post_data['document_id']
@@ -87,6 +101,7 @@ class DocumentBlueprintTestCase(unittest.TestCase):
             'title': 'Test Document',
             'text': 'New Text'
         }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(post_response)
 
         post_data = post_response.get_json()
         document_id = post_data['document_id']
@@ -110,8 +125,9 @@ class DocumentBlueprintTestCase(unittest.TestCase):
             'title': 'Test Document',
             'text': 'Jumps and jumps the jumps over lazy a fox the. Fox lazy quick a runs fox dog into the lazy. And jumps quick the brown the and runs lazy field. Fox over lazy runs a into lazy field field jumps. Quick the runs jumps field into jumps jumps and a.'
         }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 202)
         json_data = response.get_json()
         document_id = json_data['document_id']
         
@@ -132,8 +148,9 @@ class DocumentBlueprintTestCase(unittest.TestCase):
             'title': 'Test Document',
             'text': 'Sample text for document details test.'
         }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
 
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 202)
         json_data = response.get_json()
         document_id = json_data['document_id']
 
@@ -145,5 +162,243 @@ class DocumentBlueprintTestCase(unittest.TestCase):
         self.assertTrue('word_count' in details_data)
         self.assertIsInstance(details_data['sentences_combined'], str)
 
+    def test_update_text_only_rewrites_changed_sentences(self):
+        response = self.client.post('/docs', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell. We expect growth.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        document_id = response.get_json()['document_id']
+        self.assertEqual(self.stub.requests, 1)
+
+        response = self.client.put(f'/docs/{document_id}', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell sharply. We expect growth.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['rewritten_sentences'], 1)
+        self.assertEqual(self.stub.requests, 2)
+
+        response = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        suggestions = {s['original_sentence']: s['rewritten_sentence'] for s in response.get_json()}
+        self.assertEqual(suggestions, {
+            'Revenue grew.': 'REVENUE GREW.',
+            'Costs fell sharply.': 'COSTS FELL SHARPLY.',
+            'We expect growth.': 'WE EXPECT GROWTH.',
+        })
+
+    def test_update_text_rewrites_neighbouring_changes_together(self):
+        response = self.client.post('/docs', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell. We expect growth. Margins held.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        document_id = response.get_json()['document_id']
+
+        response = self.client.put(f'/docs/{document_id}', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell sharply. We expect more growth. Margins held. Debt is low.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.get_json()['rewritten_sentences'], 3)
+        # One call for the two neighbouring changes and one for the new last sentence
+        self.assertEqual(self.stub.requests, 3)
+
+        response = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual([s['rewritten_sentence'] for s in response.get_json()], [
+            'REVENUE GREW.', 'COSTS FELL SHARPLY.', 'WE EXPECT MORE GROWTH.', 'MARGINS HELD.', 'DEBT IS LOW.',
+        ])
+
+    def test_update_text_rewrites_a_run_again_when_sentences_merge(self):
+        response = self.client.post('/docs', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell. Margins held.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        document_id = response.get_json()['document_id']
+
+        # The rewrite joins the sentences it is given into one
+        self.stub.rewrite = lambda text: text.upper().replace('. ', '; ')
+        self.client.put(f'/docs/{document_id}', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell sharply. Margins held steady.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(self.stub.requests, 4)
+
+        response = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual([s['rewritten_sentence'] for s in response.get_json()], [
+            'REVENUE GREW.', 'COSTS FELL SHARPLY.', 'MARGINS HELD STEADY.',
+        ])
+
+    def test_update_text_keeps_reset_suggestions(self):
+        response = self.client.post('/docs', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        document_id = response.get_json()['document_id']
+
+        response = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        sentence_id = response.get_json()[0]['sentence_id']
+        self.client.delete(f'/fix/{document_id}/{sentence_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+
+        self.client.put(f'/docs/{document_id}', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell. Margins improved.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+
+        response = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        originals = [s['original_sentence'] for s in response.get_json()]
+        self.assertEqual(originals, ['Costs fell.', 'Margins improved.'])
+
+    def test_update_title_only(self):
+        response = self.client.post('/docs', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        document_id = response.get_json()['document_id']
+
+        self.client.put(f'/docs/{document_id}', json={'title': 'Renamed'},
+                        headers={'Authorization': f'Bearer {self.jwt_token}'})
+        response = self.client.get(f'/docs/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.get_json()['title'], 'Renamed')
+
+        # Sending only the text keeps the title
+        response = self.client.put(f'/docs/{document_id}', json={'text': 'Revenue grew. Costs fell sharply.'},
+                                   headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertIn('Text updated successfully', response.get_data(as_text=True))
+        response = self.client.get(f'/docs/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.get_json()['title'], 'Renamed')
+
+    def test_read_endpoints_answer_not_modified(self):
+        response = self.client.post('/docs', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        document_id = response.get_json()['document_id']
+
+        for url in (f'/docs/{document_id}', f'/docs/scores/{document_id}', f'/fix/{document_id}'):
+            with self.subTest(url=url):
+                response = self.client.get(url, headers={'Authorization': f'Bearer {self.jwt_token}'})
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers['ETag']
+
+                response = self.client.get(url, headers={'Authorization': f'Bearer {self.jwt_token}',
+                                                         'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.get_data(), b'')
+                self.assertEqual(response.headers['ETag'], etag)
+
+                # Another client without the tag gets the same body from the cache
+                hits = response_cache.stats()['hits']
+                response = self.client.get(url, headers={'Authorization': f'Bearer {self.jwt_token}',
+                                                         'If-None-Match': '"stale"'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers['ETag'], etag)
+                self.assertEqual(response_cache.stats()['hits'], hits + 1)
+
+    def test_every_change_bumps_the_version(self):
+        response = self.client.post('/docs', json={
+            'title': 'Test Document',
+            'text': 'Revenue grew. Costs fell.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        document_id = response.get_json()['document_id']
+
+        def etag():
+            response = self.client.get(f'/docs/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+            return response.headers['ETag']
+
+        seen = [etag()]
+
+        def change(method, url, body=None):
+            self.client.open(url, method=method, json=body, headers={'Authorization': f'Bearer {self.jwt_token}'})
+            seen.append(etag())
+            self.assertNotIn(seen[-1], seen[:-1], f'{method} {url}')
+
+        change('PUT', f'/docs/{document_id}', {'title': 'Renamed'})
+        change('PUT', f'/docs/{document_id}', {'text': 'Revenue grew. Costs fell. Margins improved.'})
+        sentence_ids = [s['sentence_id'] for s in self.client.get(
+            f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'}).get_json()]
+        change('PUT', f'/fix/{document_id}/{sentence_ids[0]}')
+        change('DELETE', f'/fix/{document_id}/{sentence_ids[1]}')
+        change('PUT', f'/fix/{document_id}/all')
+
+        # Accepting with nothing left to accept changes nothing
+        self.client.put(f'/fix/{document_id}/all', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(etag(), seen[-1])
+        # Storing the processed text was the first change
+        self.assertEqual(db.session.get(Document, document_id).version, len(seen) + 1)
+
+    def test_create_missing_columns(self):
+        document = Document(title='Test Document', user_id=self.test_user_id)
+        db.session.add(document)
+        db.session.commit()
+        document_id = document.id
+
+        # A database created before documents had a version
+        db.session.execute(text('ALTER TABLE document DROP COLUMN version'))
+        db.session.commit()
+        db.session.remove()
+
+        create_missing_columns()
+        self.assertEqual(db.session.get(Document, document_id).version, 1)
+
+    def test_get_job_status(self):
+        response = self.client.post('/docs', json={
+            'title': 'Job Document',
+            'text': 'Text to be processed in the background.'
+        }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.wait_for_job(response)
+        job_id = response.get_json()['job_id']
+
+        response = self.client.get(f'/docs/jobs/{job_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 200)
+        job_data = response.get_json()
+        self.assertEqual(job_data['job_id'], job_id)
+        self.assertEqual(job_data['status'], 'completed')
+        self.assertIsNone(job_data['error'])
+        self.assertIsNotNone(job_data['finished_on'])
+
+    def test_job_of_a_stopped_process_fails(self):
+        document = Document(title='Orphaned', user_id=self.test_user_id)
+        db.session.add(document)
+        db.session.commit()
+        long_ago = datetime.utcnow() - timedelta(hours=1)
+        db.session.add_all([
+            ProcessingJob(id='orphaned', document_id=document.id, user_id=self.test_user_id, status='running',
+                          created_on=long_ago, heartbeat_on=long_ago),
+            ProcessingJob(id='alive', document_id=document.id, user_id=self.test_user_id, status='running',
+                          created_on=long_ago),
+        ])
+        db.session.commit()
+
+        response = self.client.get('/docs/jobs/orphaned', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        job_data = response.get_json()
+        self.assertEqual(job_data['status'], 'failed')
+        self.assertEqual(job_data['error'], ORPHANED_ERROR)
+        self.assertIsNotNone(job_data['finished_on'])
+        response = self.client.get('/docs/jobs/alive', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.get_json()['status'], 'running')
+
+    def test_running_jobs_keep_a_heartbeat(self):
+        self.app.config['JOB_HEARTBEAT_SECONDS'] = 0.05
+        self.stub.latency = 0.5
+        response = self.client.post('/docs', json={'title': 'Slow', 'text': 'Text to be processed slowly.'},
+                                    headers={'Authorization': f'Bearer {self.jwt_token}'})
+        job_id = response.get_json()['job_id']
+        time.sleep(0.3)
+        db.session.expire_all()
+        job = db.session.get(ProcessingJob, job_id)
+        self.assertEqual(job.status, 'running')
+        self.assertGreater(job.heartbeat_on, job.created_on + timedelta(seconds=0.1))
+        self.wait_for_job(response)
+
+    def test_get_job_status_not_found(self):
+        response = self.client.get('/docs/jobs/missing', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('Job not found or access denied', response.get_data(as_text=True))
+
 if __name__ == '__main__':
     unittest.main()
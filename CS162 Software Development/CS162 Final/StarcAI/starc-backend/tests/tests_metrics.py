@@ -0,0 +1,106 @@
+import os
+import unittest
+from api_project import create_app, db
+from api_project.jobs import jobs
+from api_project.metrics import timed
+from api_project.models import User
+from stub_server import CloudFunctionStub
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'TOKEN_BLOCKLIST_REFRESH_SECONDS': 3600,
+                               'DB_CREATE_ON_START': False, 'METRICS_TOKEN': 'scraper-token'})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        user = User(username='testuser', email='test@example.com')
+        user.set_password('testpassword')
+        db.session.add(user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={'login_identifier': 'testuser', 'password': 'testpassword'})
+        self.headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+
+    # Samples of /metrics by name and labels, without this process's pid label.
+    def scrape(self):
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer scraper-token'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        samples = {}
+        for line in response.get_data(as_text=True).splitlines():
+            if line and not line.startswith('#'):
+                key, value = line.rsplit(' ', 1)
+                samples[key.replace(f'pid="{os.getpid()}",', '').replace(f'{{pid="{os.getpid()}"}}', '')] = float(value)
+        return samples
+
+    def test_requests_are_timed_by_endpoint(self):
+        before = self.scrape()
+        response = self.client.post('/docs', json={'title': 'Report', 'text': 'Revenue grew. Costs fell.'},
+                                    headers=self.headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        self.client.get('/docs/stats', headers=self.headers)
+        after = self.scrape()
+
+        # Metrics are kept for the whole process, other tests count too
+        change = lambda key: after[key] - before.get(key, 0)
+
+        labels = 'blueprint="docs",endpoint="docs.create_document",method="POST"'
+        self.assertEqual(change(f'starc_requests_total{{{labels},status="202"}}'), 1)
+        self.assertEqual(change(f'starc_request_duration_seconds_count{{{labels}}}'), 1)
+        self.assertEqual(change(f'starc_request_duration_seconds_bucket{{{labels},le="+Inf"}}'), 1)
+        self.assertGreater(change(f'starc_request_db_queries_sum{{{labels}}}'), 0)
+
+        # Reading the statistics is a single query
+        labels = 'blueprint="docs",endpoint="docs.get_user_stats",method="GET"'
+        self.assertEqual(change(f'starc_request_db_queries_sum{{{labels}}}'), 1)
+        self.assertEqual(change(f'starc_request_db_queries_bucket{{{labels},le="1.0"}}'), 1)
+        self.assertEqual(change(f'starc_request_db_queries_bucket{{{labels},le="0.0"}}'), 0)
+
+        # The processing job's calls are timed too
+        for function in ('chunking.split_into_chunks', 'processing.get_rewrite'):
+            self.assertGreater(change(f'starc_call_duration_seconds_count{{function="{function}"}}'), 0, function)
+
+    def test_cache_counters(self):
+        samples = self.scrape()
+        for key in ('starc_cache_events_total{cache="content",event="misses"}',
+                    'starc_cache_events_total{cache="response",event="hits"}',
+                    'starc_cache_entries{cache="response"}', 'starc_response_cache_bytes'):
+            self.assertIn(key, samples)
+
+    def test_failed_calls_are_counted(self):
+        @timed
+        def failing_call():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            failing_call()
+        samples = self.scrape()
+        self.assertEqual(samples['starc_call_errors_total{function="tests_metrics.failing_call"}'], 1)
+        self.assertEqual(samples['starc_call_duration_seconds_count{function="tests_metrics.failing_call"}'], 1)
+
+    def test_metrics_token(self):
+        for path in ('/metrics', '/metrics/cache'):
+            self.assertEqual(self.client.get(path).status_code, 401, path)
+            response = self.client.get(path, headers={'Authorization': 'Bearer wrong-token'})
+            self.assertEqual(response.status_code, 401, path)
+            response = self.client.get(path, headers={'Authorization': 'Bearer scraper-token'})
+            self.assertEqual(response.status_code, 200, path)
+        self.assertIn('misses', response.get_json())
+
+    def test_metrics_are_closed_without_token(self):
+        self.app.config['METRICS_TOKEN'] = None
+        for path in ('/metrics', '/metrics/cache'):
+            self.assertEqual(self.client.get(path).status_code, 401, path)
+            self.assertEqual(self.client.get(path, headers={'Authorization': 'Bearer None'}).status_code, 401, path)
+
+if __name__ == '__main__':
+    unittest.main()
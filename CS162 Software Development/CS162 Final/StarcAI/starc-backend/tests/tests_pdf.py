@@ -0,0 +1,204 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from pypdf import PdfReader
+from reportlab.pdfgen import canvas
+from api_project import create_app, db
+from api_project.jobs import jobs
+from api_project.models import User, Document
+from api_project.pdf_extract import count_pages, extract_text, spool_upload, PdfTooLarge
+from stub_server import CloudFunctionStub
+
+def make_pdf(page_count):
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer)
+    for number in range(page_count):
+        pdf.drawString(72, 720, f'Page {number} says hello.')
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+class PdfExtractTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = spool_upload(io.BytesIO(make_pdf(10)), 10 * 1024 * 1024)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_extract_text_in_page_order(self):
+        text = extract_text(self.path)
+        self.assertEqual([line for line in text.splitlines() if line], [f'Page {number} says hello.' for number in range(10)])
+
+    def test_extract_text_in_process_pool(self):
+        progress = []
+        text = extract_text(self.path, workers=2, pages_per_task=3, progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(text, extract_text(self.path))
+        self.assertEqual(progress[-1], (10, 10))
+        self.assertEqual(len(progress), 4)
+
+    def test_process_pool_switches_files(self):
+        other = spool_upload(io.BytesIO(make_pdf(4)), 10 * 1024 * 1024)
+        try:
+            self.assertEqual(extract_text(self.path, workers=2, pages_per_task=2).count('says hello'), 10)
+            self.assertEqual(extract_text(other, workers=2, pages_per_task=2).count('says hello'), 4)
+        finally:
+            os.unlink(other)
+
+    def test_page_limits(self):
+        self.assertEqual(count_pages(self.path, 10), 10)
+        with self.assertRaises(PdfTooLarge):
+            count_pages(self.path, 9)
+        with self.assertRaises(PdfTooLarge):
+            extract_text(self.path, max_pages=9)
+
+    def test_spool_upload_enforces_size(self):
+        with self.assertRaises(PdfTooLarge):
+            spool_upload(io.BytesIO(make_pdf(10)), 100)
+
+class PdfUploadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'PDF_MAX_PAGES': 20, 'PDF_EXTRACT_WORKERS': 1,
+                               'PDF_PAGES_PER_TASK': 2, 'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        test_user = User(username='testuser', email='test@example.com')
+        test_user.set_password('testpassword')
+        db.session.add(test_user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={
+            'login_identifier': 'testuser',
+            'password': 'testpassword'
+        })
+        self.headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+
+    def upload(self, data, filename='report.pdf'):
+        return self.client.post('/docs/pdf', data={'pdf': (io.BytesIO(data), filename)},
+                                headers=self.headers, content_type='multipart/form-data')
+
+    def test_upload_pdf_reports_page_progress(self):
+        response = self.upload(make_pdf(5))
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        jobs.wait(job_id, timeout=30)
+
+        response = self.client.get(f'/docs/jobs/{job_id}', headers=self.headers)
+        job_data = response.get_json()
+        self.assertEqual(job_data['status'], 'completed')
+        self.assertEqual((job_data['pages_done'], job_data['pages_total']), (5, 5))
+
+        document = db.session.get(Document, job_data['document_id'])
+        self.assertEqual(document.title, 'report.pdf')
+        self.assertEqual(document.word_count, 20)
+        self.assertIn('Page 4 says hello.', document.text_chunks[0].input_text_chunk)
+
+    def test_upload_pdf_too_many_pages(self):
+        response = self.upload(make_pdf(21))
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(Document.query.count(), 0)
+
+    def test_upload_pdf_too_large(self):
+        self.app.config['PDF_MAX_BYTES'] = 100
+        response = self.upload(make_pdf(1))
+        self.assertEqual(response.status_code, 413)
+
+    def test_upload_unreadable_pdf(self):
+        response = self.upload(b'not a pdf')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Could not read PDF file', response.get_data(as_text=True))
+
+class PdfExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'PDF_EXPORT_CACHE_DIR': self.cache_dir,
+                               'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        test_user = User(username='testuser', email='test@example.com')
+        test_user.set_password('testpassword')
+        db.session.add(test_user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={
+            'login_identifier': 'testuser',
+            'password': 'testpassword'
+        })
+        self.headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+        text = ' '.join(f'Sentence number {number} of a long report.' for number in range(300))
+        response = self.client.post('/docs', json={'title': 'Long Report', 'text': text}, headers=self.headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        self.document_id = response.get_json()['document_id']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def download(self, query=''):
+        response = self.client.get(f'/docs/pdf/{self.document_id}{query}', headers=self.headers)
+        data = response.get_data()
+        response.close()
+        return response, data
+
+    def test_export_wraps_and_paginates(self):
+        response, data = self.download()
+        self.assertEqual(response.status_code, 200)
+        reader = PdfReader(io.BytesIO(data))
+        self.assertGreater(len(reader.pages), 1)
+        text = ''.join(page.extract_text() for page in reader.pages)
+        self.assertIn('Sentence number 0 of', text)
+        self.assertIn('number 299 of a long report.', text)
+
+    def test_export_side_by_side(self):
+        response, data = self.download('?layout=side_by_side')
+        self.assertEqual(response.status_code, 200)
+        text = PdfReader(io.BytesIO(data)).pages[0].extract_text()
+        self.assertIn('Rewritten', text)
+        self.assertIn('SENTENCE NUMBER 0', text)
+
+    def test_export_is_cached_until_document_changes(self):
+        _, first = self.download()
+        cached = os.listdir(self.cache_dir)
+        _, second = self.download()
+        self.assertEqual(first, second)
+        self.assertEqual(os.listdir(self.cache_dir), cached)
+
+        self.client.put(f'/fix/{self.document_id}/all', headers=self.headers)
+        _, third = self.download()
+        self.assertNotEqual(first, third)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_export_survives_eviction(self):
+        # Every rendered file is evicted straight away, before the response is sent
+        self.app.config['PDF_EXPORT_CACHE_MAX_FILES'] = 0
+        response, data = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(PdfReader(io.BytesIO(data)).pages), 1)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_export_invalid_layout(self):
+        response, _ = self.download('?layout=sideways')
+        self.assertEqual(response.status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
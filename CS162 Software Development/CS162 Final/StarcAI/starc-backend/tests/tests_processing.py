@@ -0,0 +1,131 @@
+import threading
+import time
+import unittest
+from api_project import create_app, processing
+from api_project.cloud_client import CloudFunctionClient, CloudFunctionError
+from stub_server import CloudFunctionStub
+
+class CloudFunctionClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.client = CloudFunctionClient(self.stub.url, timeout=2, max_retries=2, backoff=0.01)
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def test_post_returns_rewrite(self):
+        response = self.client.post('entry_pointGPT', {'text': 'Some text'})
+        self.assertEqual(response.text, 'SOME TEXT')
+
+    def test_connection_is_reused(self):
+        for _ in range(5):
+            self.client.post('entry_pointSA', {'text': 'Some text'})
+        self.assertEqual(self.stub.requests, 5)
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_retries_transient_failures(self):
+        self.stub.fail_next(503, 502)
+        response = self.client.post('entry_pointSA', {'text': 'Some text'})
+        self.assertEqual(response.json(), [50.0, 60.0, 70.0, 80.0])
+        self.assertEqual(self.stub.requests, 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.stub.fail_next(503, 503, 503)
+        with self.assertRaises(CloudFunctionError):
+            self.client.post('entry_pointSA', {'text': 'Some text'})
+        self.assertEqual(self.stub.requests, 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.stub.fail_next(400)
+        with self.assertRaises(CloudFunctionError):
+            self.client.post('entry_pointSA', {'text': 'Some text'})
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_timeout(self):
+        self.stub.latency = 0.5
+        client = CloudFunctionClient(self.stub.url, timeout=0.1, max_retries=0)
+        with self.assertRaises(CloudFunctionError):
+            client.post('entry_pointSA', {'text': 'Some text'})
+        client.close()
+
+    def test_read_timeouts_retried_only_when_idempotent(self):
+        self.stub.latency = 0.3
+        client = CloudFunctionClient(self.stub.url, timeout=0.1, max_retries=2, backoff=0.01)
+        with self.assertRaises(CloudFunctionError):
+            client.post('entry_pointSA', {'text': 'Some text'})
+        self.assertEqual(self.stub.requests, 3)
+        with self.assertRaises(CloudFunctionError):
+            client.post('entry_pointGPT', {'text': 'Some text'}, idempotent=False)
+        self.assertEqual(self.stub.requests, 4)
+        client.close()
+
+    def test_server_errors_retried_when_not_idempotent(self):
+        self.stub.fail_next(503)
+        response = self.client.post('entry_pointGPT', {'text': 'Some text'}, idempotent=False)
+        self.assertEqual(response.text, 'SOME TEXT')
+        self.assertEqual(self.stub.requests, 2)
+
+    def test_connection_errors_retried_when_not_idempotent(self):
+        self.stub.stop()
+        client = CloudFunctionClient(self.stub.url, timeout=0.5, max_retries=1, backoff=0.01)
+        with self.assertRaises(CloudFunctionError) as raised:
+            client.post('entry_pointGPT', {'text': 'Some text'}, idempotent=False)
+        self.assertIn('after 2 attempts', str(raised.exception))
+        client.close()
+        self.stub = CloudFunctionStub().start()
+
+    def test_in_flight_cap(self):
+        self.stub.latency = 0.05
+        client = CloudFunctionClient(self.stub.url, max_in_flight=2, pool_size=2)
+        threads = [threading.Thread(target=client.post, args=('entry_pointSA', {'text': 'Some text'}))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+        self.assertEqual(self.stub.requests, 8)
+        self.assertLessEqual(self.stub.max_in_flight, 2)
+
+class BatchProcessingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        processing.configure_client(self.stub.url, max_retries=0)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_get_scores_batch_one_result_per_text(self):
+        scores = processing.get_scores_batch(['First text.', 'Second text.'])
+        self.assertEqual(len(scores), 2)
+        self.assertTrue(all(len(s) == 4 for s in scores))
+
+    def test_rewrite_and_score_keeps_order(self):
+        rewrites, original_scores, rewritten_scores = processing.rewrite_and_score(['one.', 'two.', 'three.'])
+        self.assertEqual(rewrites, ['ONE.', 'TWO.', 'THREE.'])
+        self.assertEqual(len(original_scores), 3)
+        self.assertEqual(len(rewritten_scores), 3)
+
+    def test_each_app_keeps_its_client(self):
+        other_stub = CloudFunctionStub().start()
+        first = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'DB_CREATE_ON_START': False})
+        second = create_app({'GC_FUNCTIONS_URL': other_stub.url, 'DB_CREATE_ON_START': False})
+        with first.app_context():
+            self.assertEqual(processing.rewrite_many(['one.', 'two.']), ['ONE.', 'TWO.'])
+        with second.app_context():
+            processing.rewrite_many(['three.'])
+        other_stub.stop()
+        self.assertEqual((self.stub.requests, other_stub.requests), (2, 1))
+
+    def test_rewrite_and_score_runs_rewrites_concurrently(self):
+        self.stub.latency = 0.2
+        start = time.perf_counter()
+        processing.rewrite_and_score(['one.', 'two.', 'three.', 'four.'])
+        self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertGreater(self.stub.max_in_flight, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from api_project import create_app, db
+from api_project.jobs import jobs
+from api_project.models import User
+from api_project.profiling import CAPTURE_HEADER
+from stub_server import CloudFunctionStub
+
+class ProfilingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.profile_dir = tempfile.mkdtemp()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'PROFILE_DIR': self.profile_dir,
+                               'TOKEN_BLOCKLIST_REFRESH_SECONDS': 3600, 'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.admin_headers = self.login('admin', is_admin=True)
+        self.headers = self.login('testuser')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+        shutil.rmtree(self.profile_dir)
+
+    def login(self, username, is_admin=False):
+        user = User(username=username, email=f'{username}@example.com', is_admin=is_admin)
+        user.set_password('testpassword')
+        db.session.add(user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={'login_identifier': username, 'password': 'testpassword'})
+        return {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+    def create_document(self, headers):
+        response = self.client.post('/docs', json={'title': 'Report', 'text': 'Revenue grew. Costs fell.'},
+                                    headers=headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        return response
+
+    def test_admin_requests_are_profiled_with_their_job(self):
+        response = self.create_document({**self.admin_headers, 'X-Profile': '1'})
+        capture_id = response.headers[CAPTURE_HEADER]
+        admin_id = User.query.filter_by(username='admin').one().id
+
+        captures = self.client.get('/admin/profiles', headers=self.admin_headers).get_json()
+        self.assertEqual(len(captures), 2)
+        job_capture, request_capture = captures
+        self.assertEqual(request_capture['id'], capture_id)
+        self.assertEqual((request_capture['endpoint'], request_capture['method'], request_capture['path']),
+                         ('docs.create_document', 'POST', '/docs'))
+        self.assertEqual((request_capture['user_id'], request_capture['status']), (admin_id, 202))
+        self.assertIn('created_on', request_capture)
+        self.assertGreater(request_capture['duration_ms'], 0)
+
+        # The processing job queued by the request is a capture of its own
+        self.assertEqual(job_capture['endpoint'], 'job.process_document_text')
+        self.assertEqual(job_capture['job_id'], response.get_json()['job_id'])
+        self.assertEqual(job_capture['user_id'], admin_id)
+
+        response = self.client.get(f'/admin/profiles/{job_capture["id"]}', headers=self.admin_headers)
+        self.assertEqual(response.status_code, 200)
+        path = os.path.join(self.profile_dir, 'downloaded.prof')
+        with open(path, 'wb') as downloaded:
+            downloaded.write(response.get_data())
+        response.close()
+        functions = {name for _, _, name in pstats.Stats(path).stats}
+        self.assertIn('process_document_text', functions)
+
+        response = self.client.get(f'/admin/profiles/{capture_id}?format=text', headers=self.admin_headers)
+        self.assertIn('create_document', response.get_data(as_text=True))
+
+    def test_only_admins_profile(self):
+        response = self.create_document({**self.headers, 'X-Profile': '1'})
+        self.assertNotIn(CAPTURE_HEADER, response.headers)
+        response = self.client.get('/docs/stats', headers=self.admin_headers)
+        self.assertNotIn(CAPTURE_HEADER, response.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+        self.assertEqual(self.client.get('/admin/profiles', headers=self.headers).status_code, 403)
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 401)
+
+    def test_one_capture_at_a_time(self):
+        state = self.app.extensions['profiling']
+        with state.lock:
+            response = self.client.get('/docs/stats', headers={**self.admin_headers, 'X-Profile': '1'})
+        self.assertEqual(response.headers[CAPTURE_HEADER], 'busy')
+        self.assertEqual(self.client.get('/admin/profiles', headers=self.admin_headers).get_json(), [])
+
+    def test_oldest_captures_are_removed(self):
+        self.app.extensions['profiling'].max_files = 2
+        ids = [self.client.get('/docs/stats', headers={**self.admin_headers, 'X-Profile': '1'}).headers[CAPTURE_HEADER]
+               for _ in range(3)]
+        captures = self.client.get('/admin/profiles', headers=self.admin_headers).get_json()
+        self.assertEqual([capture['id'] for capture in captures], ids[:0:-1])
+        self.assertEqual(len(os.listdir(self.profile_dir)), 4)
+
+    def test_set_admin_command(self):
+        runner = self.app.test_cli_runner()
+        self.assertEqual(runner.invoke(args=['set-admin', 'testuser']).exit_code, 0)
+        self.assertEqual(self.client.get('/admin/profiles', headers=self.headers).status_code, 200)
+        self.assertEqual(runner.invoke(args=['set-admin', 'testuser', '--revoke']).exit_code, 0)
+        self.assertEqual(self.client.get('/admin/profiles', headers=self.headers).status_code, 403)
+        self.assertNotEqual(runner.invoke(args=['set-admin', 'nobody']).exit_code, 0)
+
+    def test_unknown_capture(self):
+        for capture_id in ('20240101T000000000000-abcdef12', '..%2Fsite.db', 'nothing'):
+            response = self.client.get(f'/admin/profiles/{capture_id}', headers=self.admin_headers)
+            self.assertEqual(response.status_code, 404, capture_id)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from sqlalchemy import event
+from api_project import create_app, db
+from api_project.jobs import jobs
+from api_project.models import User
+from stub_server import CloudFunctionStub
+
+# Most statements each endpoint may run, for any number of chunks and sentences.
+MAX_QUERIES = {
+    'GET /docs/jobs/<id>': 1,
+    'GET /docs/<id>': 4,
+    'GET /docs/<id> cached': 1,
+    'GET /docs/<id> not modified': 1,
+    'GET /docs/scores/<id>': 3,
+    'GET /docs/scores/<id> cached': 1,
+    'GET /docs/pdf/<id>': 4,
+    'GET /docs/pdf/<id> cached': 1,
+    'GET /fix/<id>': 4,
+    'GET /fix/<id> cached': 1,
+    'GET /fix/<id>/stream': 5,
+    'PUT /fix/<id>/<sentence_id>': 6,
+    'DELETE /fix/<id>/<sentence_id>': 5,
+    'PUT /fix/<id>/all': 5,
+    'DELETE /fix/<id>/all': 3,
+    'PUT /docs/<id>': 17,
+    'DELETE /docs/<id>': 9,
+}
+
+class QueryCountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.cache_dir = tempfile.mkdtemp()
+        # Short chunks give a document one chunk per sentence, revoked tokens are loaded once
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'PDF_EXPORT_CACHE_DIR': self.cache_dir,
+                               'CHUNK_MAX_CHARS': 40, 'TOKEN_BLOCKLIST_REFRESH_SECONDS': 3600,
+                               'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        user = User(username='testuser', email='test@example.com')
+        user.set_password('testpassword')
+        db.session.add(user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={'login_identifier': 'testuser', 'password': 'testpassword'})
+        self.headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+        shutil.rmtree(self.cache_dir)
+
+    # Statements one request runs on this thread, starting from an empty session like a new request would.
+    def count_queries(self, method, url, **kwargs):
+        db.session.remove()
+        statements = []
+        thread = threading.get_ident()
+
+        def capture(conn, cursor, statement, *args):
+            if threading.get_ident() == thread:
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            response = self.client.open(url, method=method, **{'headers': self.headers, **kwargs})
+            response.get_data()
+            response.close()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        self.assertTrue(response.status_code < 300 or response.status_code == 304, f'{method} {url}')
+        return len(statements)
+
+    def create_document(self, sentence_count):
+        text = ' '.join(f'Sentence number {number} of the report.' for number in range(sentence_count))
+        response = self.client.post('/docs', json={'title': 'Report', 'text': text}, headers=self.headers)
+        data = response.get_json()
+        jobs.wait(data['job_id'], timeout=30)
+        return data['document_id'], data['job_id'], text
+
+    # Query counts of every endpoint on a document of sentence_count sentences, in as many chunks.
+    def endpoint_counts(self, sentence_count):
+        document_id, job_id, text = self.create_document(sentence_count)
+        # The first read of each endpoint builds the response, the next ones come from the caches
+        counts = {
+            'GET /docs/jobs/<id>': self.count_queries('GET', f'/docs/jobs/{job_id}'),
+            'GET /docs/<id>': self.count_queries('GET', f'/docs/{document_id}'),
+            'GET /docs/<id> cached': self.count_queries('GET', f'/docs/{document_id}'),
+            'GET /docs/scores/<id>': self.count_queries('GET', f'/docs/scores/{document_id}'),
+            'GET /docs/scores/<id> cached': self.count_queries('GET', f'/docs/scores/{document_id}'),
+            'GET /docs/pdf/<id>': self.count_queries('GET', f'/docs/pdf/{document_id}?layout=side_by_side'),
+            'GET /docs/pdf/<id> cached': self.count_queries('GET', f'/docs/pdf/{document_id}?layout=side_by_side'),
+            'GET /fix/<id>': self.count_queries('GET', f'/fix/{document_id}'),
+            'GET /fix/<id> cached': self.count_queries('GET', f'/fix/{document_id}'),
+        }
+        etag = self.client.get(f'/docs/{document_id}', headers=self.headers).headers['ETag']
+        sentence_ids = [sentence['sentence_id'] for sentence in
+                        self.client.get(f'/fix/{document_id}', headers=self.headers).get_json()]
+        return {
+            **counts,
+            'GET /docs/<id> not modified': self.count_queries('GET', f'/docs/{document_id}', headers={
+                **self.headers, 'If-None-Match': etag}),
+            'GET /fix/<id>/stream': self.count_queries('GET', f'/fix/{document_id}/stream'),
+            'PUT /fix/<id>/<sentence_id>': self.count_queries('PUT', f'/fix/{document_id}/{sentence_ids[0]}'),
+            'DELETE /fix/<id>/<sentence_id>': self.count_queries('DELETE', f'/fix/{document_id}/{sentence_ids[1]}'),
+            'PUT /fix/<id>/all': self.count_queries('PUT', f'/fix/{document_id}/all'),
+            'DELETE /fix/<id>/all': self.count_queries('DELETE', f'/fix/{document_id}/all'),
+            'PUT /docs/<id>': self.count_queries('PUT', f'/docs/{document_id}', json={
+                'title': 'Report', 'text': f'{text} One more sentence about {sentence_count}.'}),
+            'DELETE /docs/<id>': self.count_queries('DELETE', f'/docs/{document_id}'),
+        }
+
+    def test_query_counts_do_not_grow_with_the_document(self):
+        small = self.endpoint_counts(3)
+        large = self.endpoint_counts(12)
+        for endpoint, limit in MAX_QUERIES.items():
+            with self.subTest(endpoint=endpoint):
+                self.assertEqual(small[endpoint], large[endpoint],
+                                 f'{endpoint} runs a query per chunk or sentence')
+                self.assertLessEqual(large[endpoint], limit)
+
+if __name__ == '__main__':
+    unittest.main()
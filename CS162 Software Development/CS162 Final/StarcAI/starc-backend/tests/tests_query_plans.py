@@ -0,0 +1,133 @@
+import io
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from sqlalchemy import event
+from api_project import create_app, db
+from api_project.jobs import jobs
+from api_project.models import User
+from stub_server import CloudFunctionStub
+
+# Statements worth a query plan, inserts of plain values never scan.
+PLANNED = re.compile(r'^\s*(SELECT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+# Plan steps naming the derived tables (subqueries and CTEs) of a statement, scanning those is expected.
+DERIVED = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\S+)')
+
+class QueryPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'PDF_EXPORT_CACHE_DIR': self.cache_dir,
+                               'CHUNK_MAX_CHARS': 60, 'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        # Every statement run through the engine, from requests and from the job threads
+        self.statements = []
+        self.lock = threading.Lock()
+        event.listen(db.engine, 'before_cursor_execute', self.capture)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.capture)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def capture(self, conn, cursor, statement, parameters, context, executemany):
+        if PLANNED.match(statement):
+            with self.lock:
+                self.statements.append((statement, parameters[0] if executemany else parameters))
+
+    # Full scans of real tables in the plans of every captured statement.
+    def full_scans(self):
+        with self.lock:
+            statements = list(dict.fromkeys((statement, tuple(parameters) if isinstance(parameters, (list, tuple))
+                                             else parameters) for statement, parameters in self.statements))
+        scans = []
+        with db.engine.connect() as conn:
+            for statement, parameters in statements:
+                steps = [row[3] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+                derived = {match.group(1) for match in map(DERIVED.match, steps) if match}
+                for step in steps:
+                    words = step.split()
+                    if words[0] != 'SCAN' or 'VIRTUAL' in words or words[1] in derived or step == 'SCAN CONSTANT ROW':
+                        continue
+                    scans.append(f'{step} in: {" ".join(statement.split())}')
+        return scans
+
+    # Send a request and check its status, every route must have run to completion to show its queries.
+    def call(self, method, url, status, **kwargs):
+        response = self.client.open(url, method=method, **kwargs)
+        self.assertEqual(response.status_code, status, f'{method} {url}')
+        return response
+
+    def login(self, username):
+        user = User(username=username, email=f'{username}@example.com')
+        user.set_password('testpassword')
+        db.session.add(user)
+        db.session.commit()
+        response = self.call('POST', '/auth/login', 200,
+                             json={'login_identifier': username, 'password': 'testpassword'})
+        return {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+    def create_document(self, headers, title, text):
+        response = self.call('POST', '/docs', 202, json={'title': title, 'text': text}, headers=headers)
+        job_id = response.get_json()['job_id']
+        jobs.wait(job_id, timeout=30)
+        job = self.call('GET', f'/docs/jobs/{job_id}', 200, headers=headers).get_json()
+        self.assertEqual(job['status'], 'completed', job['error'])
+        return response.get_json()
+
+    def test_routes_use_indexes(self):
+        # Other users' rows make a missing index show up as a scan instead of a lookup in a tiny table
+        other_headers = self.login('otheruser')
+        self.create_document(other_headers, 'Their Report', 'Numbers went up. Costs went down.')
+        headers = self.login('testuser')
+        self.call('POST', '/auth/register', 201,
+                  json={'username': 'newuser', 'email': 'new@example.com', 'password': 'newpassword'})
+
+        text = ' '.join(f'Sentence number {number} of the report.' for number in range(6))
+        submitted = self.create_document(headers, 'Quarterly Report', text)
+        document_id = submitted['document_id']
+        self.create_document(headers, 'Second Report', 'Another short text.')
+        # An unreadable PDF is turned away after it was checked
+        self.call('POST', '/docs/pdf', 400, data={'pdf': (io.BytesIO(b'not a pdf'), 'broken.pdf')},
+                  headers=headers, content_type='multipart/form-data')
+
+        self.call('GET', f'/docs/{document_id}', 200, headers=headers)
+        self.call('GET', f'/docs/scores/{document_id}', 200, headers=headers)
+        self.call('GET', f'/docs/pdf/{document_id}', 200, headers=headers).close()
+        self.call('PUT', f'/docs/{document_id}', 200, json={'title': 'Renamed Report'}, headers=headers)
+        self.call('PUT', f'/docs/{document_id}', 200, json={'title': 'Renamed Report', 'text': text + ' One more.'},
+                  headers=headers)
+
+        sentences = self.call('GET', f'/fix/{document_id}', 200, headers=headers).get_json()
+        self.call('PUT', f'/fix/{document_id}/{sentences[0]["sentence_id"]}', 200, headers=headers)
+        self.call('DELETE', f'/fix/{document_id}/{sentences[1]["sentence_id"]}', 200, headers=headers)
+        self.call('GET', f'/fix/{document_id}/stream', 200, headers=headers).get_data()
+        self.call('PUT', f'/fix/{document_id}/all', 200, headers=headers)
+        self.call('DELETE', f'/fix/{document_id}/all', 200, headers=headers)
+
+        data = self.call('GET', '/api/search?q=report&limit=1&include_total=1', 200, headers=headers).get_json()
+        self.call('GET', f'/api/search?q=report&limit=1&cursor={data["next_cursor"]}', 200, headers=headers)
+        data = self.call('GET', '/api/search?q=&limit=1&include_total=1', 200, headers=headers).get_json()
+        self.call('GET', f'/api/search?q=&limit=1&cursor={data["next_cursor"]}', 200, headers=headers)
+        self.call('GET', '/docs/stats', 200, headers=headers)
+
+        self.call('DELETE', f'/docs/{document_id}', 200, headers=headers)
+        self.call('POST', '/auth/logout', 200, headers=headers)
+
+        self.assertGreater(len(self.statements), 50)
+        scans = self.full_scans()
+        self.assertFalse(scans, 'Full table scans:\n' + '\n'.join(scans))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,19 @@
 import json
 import unittest
+from unittest.mock import MagicMock, patch
+from sqlalchemy.dialects import postgresql
 from api_project import create_app, db
-from api_project.models import User
+from api_project.chunking import split_into_chunks
+from api_project.jobs import jobs
+from api_project.models import User, Document, ProcessingJob
+from api_project.pipeline import accept_suggestions
+from stub_server import CloudFunctionStub
 
 class RewriteBlueprintTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = create_app()
+        self.stub = CloudFunctionStub().start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'DB_CREATE_ON_START': False})
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -22,6 +29,7 @@ class RewriteBlueprintTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        self.stub.stop()
 
     def get_jwt_token_for_test_user(self):
         response = self.client.post('/auth/login', json={
@@ -36,6 +44,7 @@ class RewriteBlueprintTestCase(unittest.TestCase):
             'title': title,
             'text': text
         }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        jobs.wait(response.get_json()['job_id'], timeout=30)
         return response.get_json()['document_id']
 
     def test_get_rewritten_sentences(self):
@@ -76,11 +85,177 @@ class RewriteBlueprintTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('All suggestions deleted successfully', response.get_data(as_text=True))
 
+    # A document of six sentences in several chunks, whose rewrites are a word longer than the originals.
+    def create_multi_chunk_document(self):
+        self.app.config['CHUNK_MAX_CHARS'] = 40
+        self.stub.rewrite = lambda text: text.replace('.', ' indeed.')
+        text = ' '.join(f'Sentence number {number} here.' for number in range(6))
+        return self.create_document('Test Document', text), len(text.split())
+
+    def stored_document(self, document_id):
+        db.session.expire_all()
+        document = db.session.get(Document, document_id)
+        return document, document.text_chunks
+
+    def test_accept_all_rebuilds_chunk_text_and_word_count(self):
+        document_id, word_count = self.create_multi_chunk_document()
+        response = self.client.put(f'/fix/{document_id}/all', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 200)
+
+        document, text_chunks = self.stored_document(document_id)
+        self.assertGreater(len(text_chunks), 1)
+        for text_chunk in text_chunks:
+            self.assertEqual(text_chunk.input_text_chunk, ' '.join(s.original_text for s in text_chunk.sentences))
+            self.assertTrue(all(s.original_text == s.rewritten_text for s in text_chunk.sentences))
+        self.assertEqual(text_chunks[0].input_text_chunk.split('.')[0], 'Sentence number 0 here indeed')
+        self.assertEqual(document.word_count, word_count + 6)
+
+        response = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_accept_one_sentence_updates_its_chunk(self):
+        document_id, word_count = self.create_multi_chunk_document()
+        sentences = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'}).get_json()
+        accepted = sentences[-1]
+        self.client.put(f'/fix/{document_id}/{accepted["sentence_id"]}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+
+        document, text_chunks = self.stored_document(document_id)
+        self.assertEqual(document.word_count, word_count + 1)
+        self.assertIn(accepted['rewritten_sentence'], text_chunks[-1].input_text_chunk)
+        self.assertTrue(all('indeed' not in text_chunk.input_text_chunk for text_chunk in text_chunks[:-1]))
+        remaining = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'}).get_json()
+        self.assertEqual([s['sentence_id'] for s in remaining], [s['sentence_id'] for s in sentences[:-1]])
+
+        # Accepting it again changes nothing
+        self.client.put(f'/fix/{document_id}/{accepted["sentence_id"]}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(self.stored_document(document_id)[0].word_count, word_count + 1)
+
+    def test_accept_statements_render_on_postgres(self):
+        statements = []
+        execute = MagicMock(side_effect=lambda stmt: statements.append(stmt) or MagicMock(rowcount=1))
+        with patch.object(db.engine.dialect, 'name', 'postgresql'), patch.object(db.session, 'execute', execute):
+            accept_suggestions(1, sentence_id=2)
+        sql = ' '.join(str(stmt.compile(dialect=postgresql.dialect())) for stmt in statements)
+        self.assertIn('string_agg(CASE WHEN', sql)
+        self.assertIn('ORDER BY sentence.id)', sql)
+        self.assertIn('regexp_split_to_array', sql)
+        for sqlite_only in ('group_concat', 'iif', 'word_count('):
+            self.assertNotIn(sqlite_only, sql)
+
+    def test_reset_all_keeps_chunk_text(self):
+        document_id, word_count = self.create_multi_chunk_document()
+        _, text_chunks = self.stored_document(document_id)
+        chunk_texts = [text_chunk.input_text_chunk for text_chunk in text_chunks]
+        self.client.delete(f'/fix/{document_id}/all', headers={'Authorization': f'Bearer {self.jwt_token}'})
+
+        document, text_chunks = self.stored_document(document_id)
+        self.assertEqual([text_chunk.input_text_chunk for text_chunk in text_chunks], chunk_texts)
+        self.assertTrue(all(s.original_text == s.rewritten_text for c in text_chunks for s in c.sentences))
+        self.assertEqual(document.word_count, word_count)
+
+    def test_sentence_of_another_document_is_not_found(self):
+        document_id = self.create_document('Test Document', 'Some text')
+        other_id = self.create_document('Other Document', 'Other text')
+        sentence_id = self.get_first_sentence_id(other_id)
+        response = self.client.put(f'/fix/{document_id}/{sentence_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.delete(f'/fix/{document_id}/{sentence_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 404)
+
     def get_first_sentence_id(self, document_id):
         response = self.client.get(f'/fix/{document_id}', headers={'Authorization': f'Bearer {self.jwt_token}'})
         sentences = response.get_json()
         return sentences[0]['sentence_id'] if sentences else None    
 
+def parse_events(body):
+    events = []
+    for block in body.split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+        if 'event' in lines:
+            events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+class RewriteStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub(latency=0.2).start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'CHUNK_MAX_CHARS': 60, 'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        test_user = User(username='testuser', email='test@example.com')
+        test_user.set_password('testpassword')
+        db.session.add(test_user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={
+            'login_identifier': 'testuser',
+            'password': 'testpassword'
+        })
+        self.headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+        self.text = ' '.join(f'Sentence number {number} of the report.' for number in range(6))
+        self.chunk_count = len(split_into_chunks(self.text, 60))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+
+    def submit(self):
+        response = self.client.post('/docs', json={'title': 'Report', 'text': self.text}, headers=self.headers)
+        return response.get_json()
+
+    def test_stream_while_processing(self):
+        submitted = self.submit()
+        response = self.client.get(f'/fix/{submitted["document_id"]}/stream', headers=self.headers, buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+
+        # The first rewrite arrives while the job is still waiting on the scoring call
+        body = iter(response.response)
+        first = next(body).decode()
+        self.assertTrue(first.startswith('event: rewrite'))
+        db.session.expire_all()
+        self.assertNotEqual(db.session.get(ProcessingJob, submitted['job_id']).status, 'completed')
+
+        events = parse_events(first + ''.join(part.decode() for part in body))
+        response.close()
+        names = [name for name, _ in events]
+        self.assertEqual(names.count('rewrite'), self.chunk_count)
+        self.assertEqual(names.count('scores'), self.chunk_count)
+        self.assertEqual(names[-1], 'completed')
+        rewrites = [data for name, data in events if name == 'rewrite']
+        self.assertEqual(sorted(data['chunk_index'] for data in rewrites), list(range(self.chunk_count)))
+        self.assertEqual(rewrites[0]['sentences'][0]['rewritten_sentence'],
+                         rewrites[0]['sentences'][0]['original_sentence'].upper())
+
+        # The ids of the sentences follow once they are stored, in the order they were sent in
+        stored = {data['chunk_index']: data['sentence_ids'] for name, data in events if name == 'stored'}
+        self.assertEqual(sorted(stored), list(range(self.chunk_count)))
+        self.assertLess(names.index('stored'), names.index('completed'))
+        for data in rewrites:
+            self.assertEqual(len(stored[data['chunk_index']]), len(data['sentences']))
+        sentences = self.client.get(f'/fix/{submitted["document_id"]}', headers=self.headers).get_json()
+        self.assertEqual([sentence['sentence_id'] for sentence in sentences],
+                         [sentence_id for index in sorted(stored) for sentence_id in stored[index]])
+
+    def test_stream_after_processing_replays_stored_results(self):
+        submitted = self.submit()
+        jobs.wait(submitted['job_id'], timeout=30)
+        response = self.client.get(f'/fix/{submitted["document_id"]}/stream', headers=self.headers)
+        events = parse_events(response.get_data(as_text=True))
+        self.assertEqual([name for name, _ in events], ['rewrite', 'scores', 'stored'] * self.chunk_count + ['completed'])
+        self.assertIn('sentence_id', events[0][1]['sentences'][0])
+        self.assertEqual(events[2][1]['sentence_ids'],
+                         [sentence['sentence_id'] for sentence in events[0][1]['sentences']])
+        self.assertEqual(set(events[1][1]), {'chunk_index', 'initial_score', 'final_score'})
+
+    def test_stream_document_not_found(self):
+        response = self.client.get('/fix/999/stream', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,16 @@
 import json
 import unittest
-from api_project import create_app, db
-from api_project.models import User
+from unittest.mock import patch
+from api_project import create_app, db, search_index
+from api_project.jobs import jobs
+from api_project.models import User, Document
+from stub_server import CloudFunctionStub
 
 class SearchBlueprintTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = create_app()
+        self.stub = CloudFunctionStub().start()
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'DB_CREATE_ON_START': False})
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -22,6 +26,7 @@ class SearchBlueprintTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        self.stub.stop()
 
     def get_jwt_token_for_test_user(self):
         response = self.client.post('/auth/login', json={
@@ -32,10 +37,12 @@ class SearchBlueprintTestCase(unittest.TestCase):
         return token
 
     def create_document(self, title, text):
-        return self.client.post('/docs', json={
+        response = self.client.post('/docs', json={
             'title': title,
             'text': text
         }, headers={'Authorization': f'Bearer {self.jwt_token}'})
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        return response
 
     def test_search_exact_match(self):
         self.create_document('Exact Match Document', 'Some text')
@@ -85,5 +92,130 @@ class SearchBlueprintTestCase(unittest.TestCase):
         data = response.get_json()
         self.assertTrue(any('Special@#!$ Document' in d['title'] for d in data['results']))
 
+    def test_search_matches_document_text(self):
+        self.create_document('Quarterly Report', 'Revenue grew strongly in every region.')
+        self.create_document('Annual Report', 'Costs were flat.')
+        response = self.client.get('api/search?q=revenue', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        data = response.get_json()
+        self.assertEqual([d['title'] for d in data['results']], ['Quarterly Report'])
+        self.assertIn('<mark>Revenue</mark>', data['results'][0]['snippet'])
+
+    def test_search_snippets_are_escaped(self):
+        self.create_document('Notes', 'Revenue <script>alert("x")</script> & more')
+        response = self.client.get('api/search?q=revenue', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        snippet = response.get_json()['results'][0]['snippet']
+        self.assertIn('<mark>Revenue</mark>', snippet)
+        self.assertNotIn('<script>', snippet)
+        self.assertIn('&lt;script&gt;', snippet)
+
+    def test_title_snippets_are_escaped(self):
+        self.create_document('<b>Plan</b> & more', 'Some text.')
+        response = self.client.get('api/search?q=%26', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        result = response.get_json()['results'][0]
+        self.assertEqual(result['title'], '<b>Plan</b> & more')
+        self.assertEqual(result['snippet'], '&lt;b&gt;Plan&lt;/b&gt; &amp; more')
+
+    def test_search_ranks_most_recent_candidates(self):
+        for number in range(4):
+            self.create_document(f'Forecast {number}', 'Numbers.')
+        with patch.object(search_index, 'MAX_CANDIDATES', 2):
+            response = self.client.get('api/search?q=forecast&include_total=true',
+                                       headers={'Authorization': f'Bearer {self.jwt_token}'})
+        data = response.get_json()
+        self.assertEqual(sorted(d['title'] for d in data['results']), ['Forecast 2', 'Forecast 3'])
+        self.assertEqual(data['total_items'], 2)
+
+    def test_search_ranks_title_matches_first(self):
+        self.create_document('Notes', 'The forecast was discussed at length.')
+        self.create_document('Forecast', 'Numbers for next year.')
+        response = self.client.get('api/search?q=forecast&include_total=true', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        data = response.get_json()
+        self.assertEqual([d['title'] for d in data['results']], ['Forecast', 'Notes'])
+        self.assertEqual(data['total_items'], 2)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_search_prefix_and_all_words(self):
+        self.create_document('Strategic Forecasts', 'Some text')
+        self.create_document('Strategic Plan', 'Some text')
+        response = self.client.get('api/search?q=strategic fore', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual([d['title'] for d in response.get_json()['results']], ['Strategic Forecasts'])
+
+    def test_search_only_own_documents(self):
+        self.create_document('Shared Word', 'Some text')
+        other = User(username='other', email='other@example.com')
+        other.set_password('otherpassword')
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Document(title='Their own', user_id=other.id))
+        db.session.commit()
+        token = self.client.post('/auth/login', json={
+            'login_identifier': 'other',
+            'password': 'otherpassword'
+        }).get_json()['access_token']
+        response = self.client.get('api/search?q=shared', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.get_json(), {"message": "No matching documents found"})
+
+    def test_search_follows_title_edits_and_deletes(self):
+        document_id = self.create_document('Draft', 'Some text').get_json()['document_id']
+        headers = {'Authorization': f'Bearer {self.jwt_token}'}
+        db.session.get(Document, document_id).title = 'Final'
+        db.session.commit()
+        response = self.client.get('api/search?q=final', headers=headers)
+        self.assertEqual(len(response.get_json()['results']), 1)
+
+        self.client.delete(f'/docs/{document_id}', headers=headers)
+        response = self.client.get('api/search?q=some', headers=headers)
+        self.assertEqual(response.status_code, 204)
+
+    def get_all_pages(self, query):
+        titles, cursor, pages = [], None, 0
+        while True:
+            url = f'api/search?{query}&limit=2' + (f'&cursor={cursor}' if cursor else '')
+            data = self.client.get(url, headers={'Authorization': f'Bearer {self.jwt_token}'}).get_json()
+            titles.extend(d['title'] for d in data['results'])
+            pages += 1
+            cursor = data['next_cursor']
+            if cursor is None:
+                return titles, pages
+
+    def test_search_cursor_pages_through_matches(self):
+        for number in range(5):
+            self.create_document(f'Report {number}', 'Some text')
+        self.create_document('Unrelated', 'Other words')
+        titles, pages = self.get_all_pages('q=report')
+        self.assertEqual(sorted(titles), [f'Report {number}' for number in range(5)])
+        self.assertEqual(pages, 3)
+
+        titles, pages = self.get_all_pages('q=')
+        self.assertEqual(titles, [f'Report {number}' for number in range(5)] + ['Unrelated'])
+        self.assertEqual(pages, 3)
+
+    def test_search_total_is_optional(self):
+        for number in range(3):
+            self.create_document(f'Report {number}', 'Some text')
+        headers = {'Authorization': f'Bearer {self.jwt_token}'}
+        data = self.client.get('api/search?q=report&limit=2', headers=headers).get_json()
+        self.assertNotIn('total_items', data)
+        data = self.client.get(f'api/search?q=report&limit=2&include_total=1&cursor={data["next_cursor"]}',
+                               headers=headers).get_json()
+        self.assertEqual(data['total_items'], 3)
+        data = self.client.get('api/search?q=&limit=2&include_total=1', headers=headers).get_json()
+        self.assertEqual(data['total_items'], 3)
+
+    def test_search_invalid_cursor(self):
+        self.create_document('Report', 'Some text')
+        response = self.client.get('api/search?q=report&cursor=not-a-cursor', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_no_docs_for_user(self):
+        other = User(username='other', email='other@example.com')
+        other.set_password('otherpassword')
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Document(title='Not mine', user_id=other.id))
+        db.session.commit()
+        response = self.client.get('api/search?q=', headers={'Authorization': f'Bearer {self.jwt_token}'})
+        self.assertEqual(response.status_code, 204)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from api_project import create_app, db
+from api_project.models import Document, ProcessingJob, User
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class StartupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.uri = f'sqlite:///{os.path.join(self.tmp, "startup.db")}'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    # Names of the tables and triggers in the database, from the app's own connection.
+    def schema(self, app):
+        with app.app_context():
+            names = set(db.session.scalars(text("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")))
+            db.session.remove()
+            db.engine.dispose()
+        return names
+
+    def test_heavy_libraries_load_on_first_use(self):
+        code = ('import sys\n'
+                'from api_project import create_app\n'
+                'import api_project.routes.documents, api_project.routes.rewrites\n'
+                f'create_app({{"SQLALCHEMY_DATABASE_URI": {self.uri!r}}})\n'
+                'print(",".join(name for name in ("nltk", "pypdf", "reportlab") if name in sys.modules))\n')
+        output = subprocess.run([sys.executable, '-c', code], cwd=BACKEND_DIR, capture_output=True, text=True,
+                                check=True)
+        self.assertEqual(output.stdout.strip(), '')
+
+    def test_schema_is_left_to_init_db(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.uri, 'DB_CREATE_ON_START': False})
+        self.assertEqual(self.schema(app), set())
+
+        runner = app.test_cli_runner()
+        self.assertEqual(runner.invoke(args=['init-db']).exit_code, 0)
+        names = self.schema(app)
+        for name in ('user', 'document', 'sentence', 'user_stats', 'document_title_fts', 'text_chunk_fts'):
+            self.assertIn(name, names)
+        self.assertTrue(any(name.startswith('user_stats_') for name in names), names)
+
+        # Running it again on the existing database changes nothing
+        self.assertEqual(runner.invoke(args=['init-db']).exit_code, 0)
+        self.assertEqual(self.schema(app), names)
+
+    def test_schema_is_created_on_start_by_default(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.uri})
+        self.assertIn('document', self.schema(app))
+
+    def test_jobs_left_behind_fail_on_start(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.uri})
+        long_ago = datetime.utcnow() - timedelta(hours=1)
+        with app.app_context():
+            user = User(username='testuser', email='test@example.com', password='unused')
+            db.session.add(user)
+            db.session.flush()
+            document = Document(title='Report', user_id=user.id)
+            db.session.add(document)
+            db.session.flush()
+            for job_id, status, heartbeat_on in (('running', 'running', long_ago), ('queued', 'queued', long_ago),
+                                                 ('alive', 'running', datetime.utcnow()),
+                                                 ('completed', 'completed', long_ago)):
+                db.session.add(ProcessingJob(id=job_id, document_id=document.id, user_id=user.id, status=status,
+                                             created_on=long_ago, heartbeat_on=heartbeat_on))
+            # A job queued before heartbeats were kept has none
+            db.session.flush()
+            db.session.execute(db.update(ProcessingJob).where(ProcessingJob.id == 'queued').values(heartbeat_on=None))
+            db.session.commit()
+            db.session.remove()
+            db.engine.dispose()
+
+        # The process that queued them stopped, the next one to start fails them
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.uri})
+        with app.app_context():
+            statuses = dict(db.session.execute(db.select(ProcessingJob.id, ProcessingJob.status)).all())
+            self.assertEqual(statuses, {'running': 'failed', 'queued': 'failed', 'alive': 'running',
+                                        'completed': 'completed'})
+            self.assertIsNotNone(db.session.get(ProcessingJob, 'queued').error)
+            self.assertIsNone(db.session.get(ProcessingJob, 'completed').error)
+            db.session.remove()
+            db.engine.dispose()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import unittest
+from sqlalchemy import event, select
+from api_project import create_app, db, user_stats
+from api_project.jobs import jobs
+from api_project.models import User, Document, TextChunks, InitialScore, FinalScore, UserStats
+from stub_server import CloudFunctionStub
+
+class UserStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        # Rewrites are a word longer than the originals
+        self.stub.rewrite = lambda text: text.replace('.', ' indeed.')
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'CHUNK_MAX_CHARS': 40, 'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.headers = self.login('testuser')
+        self.other_headers = self.login('otheruser')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+
+    def login(self, username):
+        user = User(username=username, email=f'{username}@example.com')
+        user.set_password('testpassword')
+        db.session.add(user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={'login_identifier': username, 'password': 'testpassword'})
+        return {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+    def create_document(self, headers, title, text):
+        response = self.client.post('/docs', json={'title': title, 'text': text}, headers=headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        return response.get_json()['document_id']
+
+    def get_stats(self, headers):
+        response = self.client.get('/docs/stats', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    # Average score over the chunks of a user's documents, from the score rows themselves.
+    def average_score(self, model, username):
+        scores = db.session.scalars(
+            select(model.score).join(TextChunks, TextChunks.id == model.text_chunk_id)
+            .join(Document, Document.id == TextChunks.document_id).join(User, User.id == Document.user_id)
+            .where(User.username == username)).all()
+        return sum(scores) / len(scores)
+
+    # The maintained rows, then the rows recomputed from scratch by the reconciliation.
+    def maintained_and_rebuilt(self):
+        rows = lambda: {row.user_id: row._asdict() for row in db.session.execute(select(UserStats.__table__))}
+        maintained = rows()
+        user_stats.rebuild()
+        return maintained, rows()
+
+    def assertStatsEqual(self, first, second):
+        self.assertEqual(first.keys(), second.keys())
+        for user_id in first:
+            for key, value in first[user_id].items():
+                self.assertAlmostEqual(value, second[user_id][key], msg=f'user {user_id} {key}')
+
+    def test_stats_without_documents(self):
+        self.assertEqual(self.get_stats(self.headers), {
+            'document_count': 0, 'word_count': 0, 'average_initial_score': None, 'average_final_score': None})
+
+    def test_stats_follow_created_documents(self):
+        self.create_document(self.headers, 'First', 'One two three. Four five six.')
+        self.create_document(self.headers, 'Second', 'Seven eight nine ten.')
+        self.create_document(self.other_headers, 'Theirs', 'Not counted for the test user.')
+
+        stats = self.get_stats(self.headers)
+        self.assertEqual(stats['document_count'], 2)
+        self.assertEqual(stats['word_count'], 10)
+        self.assertAlmostEqual(stats['average_initial_score'], self.average_score(InitialScore, 'testuser'))
+        self.assertAlmostEqual(stats['average_final_score'], self.average_score(FinalScore, 'testuser'))
+        self.assertEqual(self.get_stats(self.other_headers)['document_count'], 1)
+
+    def test_stats_follow_edits_and_deletes(self):
+        document_id = self.create_document(self.headers, 'First', 'One two three. Four five six.')
+        other_id = self.create_document(self.headers, 'Second', 'Seven eight nine ten.')
+        self.create_document(self.other_headers, 'Theirs', 'Not counted for the test user.')
+
+        self.client.put(f'/docs/{document_id}', json={'title': 'First', 'text': 'One two three. Something new here now.'},
+                        headers=self.headers)
+        stats = self.get_stats(self.headers)
+        self.assertEqual(stats['word_count'], 11)
+        self.assertAlmostEqual(stats['average_initial_score'], self.average_score(InitialScore, 'testuser'))
+
+        # Accepting the suggestions makes every chunk a word longer
+        self.client.put(f'/fix/{other_id}/all', headers=self.headers)
+        self.assertEqual(self.get_stats(self.headers)['word_count'], 12)
+
+        self.client.delete(f'/docs/{other_id}', headers=self.headers)
+        stats = self.get_stats(self.headers)
+        self.assertEqual(stats['document_count'], 1)
+        self.assertEqual(stats['word_count'], 7)
+        self.assertAlmostEqual(stats['average_initial_score'], self.average_score(InitialScore, 'testuser'))
+        self.assertAlmostEqual(stats['average_final_score'], self.average_score(FinalScore, 'testuser'))
+
+        maintained, rebuilt = self.maintained_and_rebuilt()
+        self.assertStatsEqual(maintained, rebuilt)
+
+    def test_rebuild_corrects_drift(self):
+        self.create_document(self.headers, 'First', 'One two three. Four five six.')
+        expected = self.get_stats(self.headers)
+
+        # Totals lost, as on a database created before the table existed
+        db.session.execute(UserStats.__table__.delete())
+        db.session.commit()
+        self.assertEqual(self.get_stats(self.headers)['document_count'], 0)
+
+        user_stats.rebuild()
+        stats = self.get_stats(self.headers)
+        for key, value in expected.items():
+            self.assertAlmostEqual(stats[key], value)
+
+    def test_deleting_a_user_removes_their_stats(self):
+        self.create_document(self.headers, 'First', 'One two three.')
+        self.create_document(self.other_headers, 'Theirs', 'Four five six.')
+        db.session.delete(User.query.filter_by(username='testuser').first())
+        db.session.commit()
+        user_ids = db.session.scalars(select(UserStats.user_id)).all()
+        self.assertEqual(user_ids, [User.query.filter_by(username='otheruser').first().id])
+
+    def test_stats_are_read_in_one_query(self):
+        for number in range(5):
+            self.create_document(self.headers, f'Document {number}', 'One two three. Four five six.')
+        db.session.remove()
+
+        statements = []
+        capture = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            self.get_stats(self.headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        self.assertEqual(len(statements), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from api_project import create_app, db
+from api_project.jobs import jobs
+from api_project.models import User
+from api_project.tracing import span
+from stub_server import CloudFunctionStub
+from tests_pdf import make_pdf
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = CloudFunctionStub().start()
+        self.trace_dir = tempfile.mkdtemp()
+        self.trace_file = os.path.join(self.trace_dir, 'traces', 'spans.jsonl')
+        self.app = create_app({'GC_FUNCTIONS_URL': self.stub.url, 'TRACE_FILE': self.trace_file,
+                               'PDF_EXTRACT_WORKERS': 1, 'TOKEN_BLOCKLIST_REFRESH_SECONDS': 3600,
+                               'DB_CREATE_ON_START': False})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        user = User(username='testuser', email='test@example.com')
+        user.set_password('testpassword')
+        db.session.add(user)
+        db.session.commit()
+        response = self.client.post('/auth/login', json={'login_identifier': 'testuser', 'password': 'testpassword'})
+        self.headers = {'Authorization': f'Bearer {response.get_json()["access_token"]}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+        shutil.rmtree(self.trace_dir)
+
+    def spans(self):
+        if not os.path.exists(self.trace_file):
+            return []
+        with open(self.trace_file) as spans:
+            return [json.loads(line) for line in spans]
+
+    # The spans of the trace the last span of the given name belongs to, by name, each name holding a list.
+    def trace_of(self, name):
+        spans = self.spans()
+        trace_id = [s for s in spans if s['name'] == name][-1]['traceId']
+        by_name = {}
+        for s in spans:
+            if s['traceId'] == trace_id:
+                by_name.setdefault(s['name'], []).append(s)
+        return by_name
+
+    def assertChildOf(self, child, parent):
+        self.assertEqual(child['parentSpanId'], parent['spanId'], child['name'])
+
+    def test_processing_job_continues_the_request_trace(self):
+        text = 'Revenue grew. Costs fell. Margins improved.'
+        response = self.client.post('/docs', json={'title': 'Report', 'text': text}, headers=self.headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+
+        trace = self.trace_of('docs.create_document')
+        request_span = trace['docs.create_document'][0]
+        self.assertEqual(request_span['parentSpanId'], '')
+        self.assertEqual(request_span['attributes'], {'http.method': 'POST', 'http.route': '/docs',
+                                                      'http.status_code': 202})
+        self.assertEqual(request_span['status'], {'code': 'STATUS_CODE_OK'})
+        self.assertGreaterEqual(request_span['endTimeUnixNano'], request_span['startTimeUnixNano'])
+
+        job = trace['job'][0]
+        self.assertChildOf(job, request_span)
+        self.assertEqual(job['attributes']['function'], 'process_document_text')
+        processing = trace['pipeline.process_document_text'][0]
+        self.assertChildOf(processing, job)
+        self.assertEqual(processing['attributes']['text_length'], len(text))
+
+        # The creation commit belongs to the request, the others to the job
+        self.assertEqual([c['parentSpanId'] for c in trace['commit']], [request_span['spanId'], processing['spanId']])
+        for name in ('chunking', 'rewrite', 'score', 'store'):
+            self.assertChildOf(trace[name][0], processing)
+        self.assertChildOf(trace['tokenize'][0], trace['rewrite'][0])
+        self.assertEqual(trace['tokenize'][0]['attributes']['sentences'], 3)
+        self.assertEqual(trace['store'][0]['attributes']['sentences'], 3)
+
+    def test_pdf_upload_stages(self):
+        response = self.client.post('/docs/pdf', data={'pdf': (io.BytesIO(make_pdf(3)), 'report.pdf')},
+                                    headers=self.headers, content_type='multipart/form-data')
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+
+        trace = self.trace_of('docs.upload_pdf')
+        upload = trace['pipeline.process_pdf_upload'][0]
+        extract = trace['pdf_extract'][0]
+        self.assertChildOf(extract, upload)
+        self.assertEqual(extract['attributes']['pages'], 3)
+        self.assertEqual(trace['word_count'][0]['attributes']['words'], 12)
+        self.assertChildOf(trace['pipeline.process_document_text'][0], upload)
+
+    def test_edit_stages(self):
+        response = self.client.post('/docs', json={'title': 'Report', 'text': 'Revenue grew. Costs fell.'},
+                                    headers=self.headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        document_id = response.get_json()['document_id']
+
+        self.client.put(f'/docs/{document_id}', json={'text': 'Revenue grew. Costs rose.'}, headers=self.headers)
+        trace = self.trace_of('docs.update_document')
+        reprocessing = trace['pipeline.reprocess_document_text'][0]
+        self.assertChildOf(reprocessing, trace['docs.update_document'][0])
+        self.assertEqual(trace['diff'][0]['attributes']['changed_sentences'], 1)
+        for name in ('chunking', 'tokenize', 'rewrite', 'score', 'store', 'commit'):
+            self.assertChildOf(trace[name][0], reprocessing)
+
+        self.client.put(f'/docs/{document_id}', json={'title': 'Renamed'}, headers=self.headers)
+        trace = self.trace_of('docs.update_document')
+        self.assertChildOf(trace['commit'][0], trace['docs.update_document'][0])
+
+    def test_failed_spans(self):
+        with self.assertRaises(ValueError), span('failing', size=3):
+            raise ValueError('failed')
+        failing = self.spans()[-1]
+        self.assertEqual(failing['name'], 'failing')
+        self.assertEqual(failing['attributes'], {'size': 3})
+        self.assertEqual(failing['status'], {'code': 'STATUS_CODE_ERROR', 'message': 'ValueError: failed'})
+
+    def test_sampling(self):
+        self.app.extensions['tracing'].sample_rate = 0
+        response = self.client.post('/docs', json={'title': 'Report', 'text': 'Revenue grew.'}, headers=self.headers)
+        jobs.wait(response.get_json()['job_id'], timeout=30)
+        with span('unsampled'):
+            pass
+        self.assertEqual([s['name'] for s in self.spans()], ['auth.login'])
+
+    def test_tracing_off_without_file(self):
+        app = create_app({'GC_FUNCTIONS_URL': self.stub.url})
+        self.assertNotIn('tracing', app.extensions)
+        with app.app_context(), span('untraced') as untraced:
+            self.assertFalse(untraced.sampled)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,13 @@
+# Entry point for production WSGI servers, run with several worker processes:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# app.py runs the Flask development server instead.
+
+# Load environment variables from .env file
+from dotenv import load_dotenv
+load_dotenv()
+
+# Import the application factory function
+from api_project import create_app
+
+# Create an instance of the Flask app
+app = create_app()